@@ -1,65 +1,321 @@
+import asyncio
 import base64
+import logging
+import os
+import random
+import threading
+import time
 
-import requests
+import httpx
 
 API_BASE = "/backend/api/v1"
+FORMATS_TTL = float(os.getenv("OCR_FORMATS_TTL", "300"))
 
+BACKEND_MAX_CONNECTIONS = int(os.getenv("OCR_BACKEND_MAX_CONNECTIONS", "10"))
+BACKEND_RETRIES = int(os.getenv("OCR_BACKEND_RETRIES", "3"))
+BACKEND_BACKOFF = float(os.getenv("OCR_BACKEND_BACKOFF", "0.5"))
+BREAKER_THRESHOLD = int(os.getenv("OCR_BACKEND_BREAKER_THRESHOLD", "5"))
+BREAKER_RESET_TIMEOUT = float(os.getenv("OCR_BACKEND_BREAKER_RESET", "30"))
+FORMAT_CHECK_TIMEOUT = float(os.getenv("OCR_FORMAT_CHECK_TIMEOUT", "2"))
+RETRY_STATUS_CODES = {502, 503, 504}
 
-def get_format(backend_url, auth_token, format_name=None, format_id=None, timeout=10):
-    url = f"{backend_url.rstrip('/')}{API_BASE}/formats"
-    headers = {}
-    if auth_token:
-        headers["Authorization"] = auth_token
-
-    resp = requests.get(url, headers=headers, timeout=timeout)
-    resp.raise_for_status()
-    data = resp.json()
-
-    if not isinstance(data, list):
-        raise ValueError("Unexpected formats response payload (expected a list)")
-
-    for item in data:
-        if isinstance(item, dict):
-            if format_name and str(item.get("format", "")).lower() == format_name.lower():
-                return item
-            if format_id and item.get("id") == format_id:
-                return item
-
-    return None
-
-
-def send_file(
-    backend_url,
-    auth_token,
-    owner_id,
-    format_id,
-    generation,
-    content_bytes,
-    primary_file_id=None,
-    timeout=15,
-):
-    if not backend_url:
-        raise ValueError("backend_url is required")
-
-    if not auth_token:
-        raise ValueError("auth_token is required")
-
-    url = f"{backend_url.rstrip('/')}{API_BASE}/stored_files"
-    headers = {
-        "Authorization": auth_token,
-        "Content-Type": "application/json",
-    }
 
-    content_b64 = base64.b64encode(content_bytes).decode("utf-8")
+class BackendUnavailableError(RuntimeError):
+    pass
+
+
+class FormatCache:
+    """Process-wide copy of the backend format table, indexed by id and by lower-cased name.
+
+    Tables are kept per backend URL. After ``ttl`` seconds a table is revalidated with ``If-None-Match``,
+    so an unchanged table costs a ``304`` instead of a full download.
+    """
+
+    def __init__(self, ttl=FORMATS_TTL):
+        self.ttl = ttl
+        self._tables = {}
+        self._lock = threading.Lock()
+
+    def is_fresh(self, backend_url):
+        table = self._tables.get(backend_url)
+        return table is not None and time.monotonic() - table["fetched_at"] < self.ttl
+
+    def conditional_headers(self, backend_url):
+        table = self._tables.get(backend_url)
+        if table is None or not table["etag"]:
+            return {}
+        return {"If-None-Match": table["etag"]}
+
+    def store(self, backend_url, data, etag=None):
+        if not isinstance(data, list):
+            raise ValueError("Unexpected formats response payload (expected a list)")
+
+        by_id = {}
+        by_name = {}
+        for item in data:
+            if isinstance(item, dict):
+                if item.get("id") is not None:
+                    by_id.setdefault(item["id"], item)
+                name = str(item.get("format", "")).lower()
+                if name:
+                    by_name.setdefault(name, item)
+
+        with self._lock:
+            self._tables[backend_url] = {
+                "etag": etag,
+                "fetched_at": time.monotonic(),
+                "by_id": by_id,
+                "by_name": by_name,
+            }
+
+    def touch(self, backend_url):
+        with self._lock:
+            table = self._tables.get(backend_url)
+            if table is not None:
+                table["fetched_at"] = time.monotonic()
+
+    def find(self, backend_url, format_name=None, format_id=None):
+        table = self._tables.get(backend_url)
+        if table is None:
+            return None
+        if format_name and format_name.lower() in table["by_name"]:
+            return table["by_name"][format_name.lower()]
+        if format_id and format_id in table["by_id"]:
+            return table["by_id"][format_id]
+        return None
 
-    payload = {
+    def invalidate(self, backend_url=None):
+        with self._lock:
+            if backend_url is None:
+                self._tables.clear()
+            else:
+                self._tables.pop(backend_url, None)
+
+
+FORMAT_CACHE = FormatCache()
+
+
+def _formats_url(backend_url):
+    return f"{backend_url.rstrip('/')}{API_BASE}/formats"
+
+
+def _stored_files_url(backend_url):
+    return f"{backend_url.rstrip('/')}{API_BASE}/stored_files"
+
+
+def _stored_file_payload(owner_id, format_id, generation, content_bytes, primary_file_id):
+    return {
         "ownerId": owner_id,
         "formatId": format_id,
         "generation": generation + 1,
         "primaryFileId": primary_file_id,
-        "content": content_b64,
+        "content": base64.b64encode(content_bytes).decode("utf-8"),
     }
 
-    resp = requests.post(url, headers=headers, json=payload, timeout=timeout)
-    resp.raise_for_status()
-    return resp.json()
+
+def invalidate_formats(backend_url=None, cache=FORMAT_CACHE):
+    cache.invalidate(backend_url)
+
+
+class CircuitBreaker:
+    """Fails calls fast after ``threshold`` consecutive failures, for ``reset_timeout`` seconds.
+
+    Once the timeout passes a single trial call is let through (half-open); its outcome closes or reopens the circuit.
+    """
+
+    def __init__(self, threshold=BREAKER_THRESHOLD, reset_timeout=BREAKER_RESET_TIMEOUT):
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self._trial_running = False
+
+    @property
+    def state(self):
+        if self.opened_at is None:
+            return "closed"
+        if time.monotonic() - self.opened_at >= self.reset_timeout:
+            return "half-open"
+        return "open"
+
+    def before_call(self):
+        """Raises when the circuit is open; returns whether the call is the half-open trial."""
+        state = self.state
+        if state == "open" or (state == "half-open" and self._trial_running):
+            raise BackendUnavailableError("Backend circuit breaker is open")
+        if state == "half-open":
+            self._trial_running = True
+            return True
+        return False
+
+    def record_success(self):
+        self.failures = 0
+        self.opened_at = None
+        self._trial_running = False
+
+    def record_failure(self):
+        self.failures += 1
+        self._trial_running = False
+        if self.opened_at is not None or self.failures >= self.threshold:
+            if self.opened_at is None:
+                logging.warning(f"Backend circuit breaker opened after {self.failures} failures")
+            self.opened_at = time.monotonic()
+
+    def abort_trial(self):
+        # a trial that ended without an outcome counts as failed, so the next one waits for the reset timeout
+        if self._trial_running:
+            self.record_failure()
+
+
+class AsyncBackendClient:
+    """Backend client sharing one keep-alive connection pool between all jobs.
+
+    Requests are retried with exponential backoff on connection errors and ``502``/``503``/``504`` responses.
+    Uploads are not idempotent, so they are only retried when the request could not have reached the backend.
+    """
+
+    def __init__(
+        self,
+        timeout=15,
+        max_connections=BACKEND_MAX_CONNECTIONS,
+        retries=BACKEND_RETRIES,
+        backoff=BACKEND_BACKOFF,
+        breaker_threshold=BREAKER_THRESHOLD,
+        breaker_reset_timeout=BREAKER_RESET_TIMEOUT,
+        format_cache=FORMAT_CACHE,
+        transport=None,
+    ):
+        self.retries = retries
+        self.backoff = backoff
+        self.breaker_threshold = breaker_threshold
+        self.breaker_reset_timeout = breaker_reset_timeout
+        self.breakers = {}
+        self.format_cache = format_cache
+        self._client = httpx.AsyncClient(
+            timeout=timeout,
+            limits=httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_connections),
+            transport=transport,
+        )
+
+    async def aclose(self):
+        await self._client.aclose()
+
+    def breaker_for(self, url):
+        # one breaker per backend, so probing an unreachable URL does not trip the others
+        key = str(httpx.URL(url).copy_with(path="/", query=None, fragment=None))
+        if key not in self.breakers:
+            self.breakers[key] = CircuitBreaker(self.breaker_threshold, self.breaker_reset_timeout)
+        return self.breakers[key]
+
+    async def _request(self, method, url, idempotent=True, retries=None, **kwargs):
+        retries = self.retries if retries is None else retries
+        breaker = self.breaker_for(url)
+        trial = breaker.before_call()
+        try:
+            return await self._request_with_retries(breaker, method, url, idempotent, retries, **kwargs)
+        except BaseException:
+            # a cancelled or otherwise aborted trial would keep the circuit half-open and rejecting forever
+            if trial:
+                breaker.abort_trial()
+            raise
+
+    async def _request_with_retries(self, breaker, method, url, idempotent, retries, **kwargs):
+        attempt = 0
+        while True:
+            try:
+                resp = await self._client.request(method, url, **kwargs)
+            except (httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout) as e:
+                error = e
+            except httpx.TransportError as e:
+                if not idempotent:
+                    breaker.record_failure()
+                    raise
+                error = e
+            else:
+                if resp.status_code not in RETRY_STATUS_CODES:
+                    breaker.record_success()
+                    return resp
+                if not idempotent:
+                    breaker.record_failure()
+                    return resp
+                error = httpx.HTTPStatusError(
+                    f"Backend responded with {resp.status_code}", request=resp.request, response=resp
+                )
+
+            if attempt >= retries:
+                breaker.record_failure()
+                raise error
+            delay = self.backoff * (2**attempt) * (1 + random.random())
+            attempt += 1
+            logging.warning(f"{method} {url} failed ({error}), retry {attempt}/{retries} in {delay:.2f}s")
+            await asyncio.sleep(delay)
+
+    async def refresh_formats(self, backend_url, auth_token, **kwargs):
+        headers = self.format_cache.conditional_headers(backend_url)
+        if auth_token:
+            headers["Authorization"] = auth_token
+
+        resp = await self._request("GET", _formats_url(backend_url), headers=headers, **kwargs)
+        if resp.status_code == 304:
+            self.format_cache.touch(backend_url)
+            return
+        resp.raise_for_status()
+        self.format_cache.store(backend_url, resp.json(), etag=resp.headers.get("ETag"))
+
+    async def get_format(self, backend_url, auth_token, format_name=None, format_id=None):
+        refreshed = False
+        if not self.format_cache.is_fresh(backend_url):
+            await self.refresh_formats(backend_url, auth_token)
+            refreshed = True
+
+        item = self.format_cache.find(backend_url, format_name=format_name, format_id=format_id)
+        if item is None and not refreshed:
+            await self.refresh_formats(backend_url, auth_token)
+            item = self.format_cache.find(backend_url, format_name=format_name, format_id=format_id)
+        return item
+
+    async def find_formats_quickly(self, backend_url, auth_token, format_names, timeout=FORMAT_CHECK_TIMEOUT):
+        """``{name: format or None}`` of ``format_names``, or ``None`` when that is not known right away.
+
+        Meant for checks on a request path: a cached table answers without a request, otherwise the table is
+        fetched once with ``timeout`` and without retries. Nothing is sent while the backend's circuit is not closed.
+        """
+        known = self.format_cache.is_fresh(backend_url) and all(
+            self.format_cache.find(backend_url, format_name=name) is not None for name in format_names
+        )
+        if not known:
+            if self.breaker_for(_formats_url(backend_url)).state != "closed":
+                return None
+            try:
+                await self.refresh_formats(backend_url, auth_token, retries=0, timeout=timeout)
+            except Exception as e:
+                logging.warning(f"Could not look up the backend formats: {e}")
+                return None
+        return {name: self.format_cache.find(backend_url, format_name=name) for name in format_names}
+
+    async def send_file(
+        self,
+        backend_url,
+        auth_token,
+        owner_id,
+        format_id,
+        generation,
+        content_bytes,
+        primary_file_id=None,
+    ):
+        if not backend_url:
+            raise ValueError("backend_url is required")
+
+        if not auth_token:
+            raise ValueError("auth_token is required")
+
+        payload = _stored_file_payload(owner_id, format_id, generation, content_bytes, primary_file_id)
+        resp = await self._request(
+            "POST",
+            _stored_files_url(backend_url),
+            idempotent=False,
+            headers={"Authorization": auth_token},
+            json=payload,
+        )
+        resp.raise_for_status()
+        return resp.json()
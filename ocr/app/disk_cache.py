@@ -0,0 +1,123 @@
+from __future__ import annotations
+
+import hashlib
+import json
+import logging
+import os
+import tempfile
+from functools import lru_cache
+from pathlib import Path
+
+RESCAN_EVERY = 100
+
+
+class DiskLRUCache:
+    """JSON values stored as one file per key, evicted least recently used first once ``max_bytes`` is exceeded.
+
+    Safe to share between the OCR worker processes: entries are written atomically and a hit refreshes the
+    file's mtime, which is what the eviction order is based on.
+
+    The directory is only scanned when the running size total goes over budget, or every ``rescan_every`` puts
+    to pick up the entries written by the other processes, so a put does not stat every entry.
+    """
+
+    def __init__(self, directory, max_bytes, rescan_every=RESCAN_EVERY):
+        self.directory = Path(directory)
+        self.max_bytes = max_bytes
+        self.rescan_every = max(1, rescan_every)
+        # size of the directory at the last scan plus what this process wrote since, None until the first scan
+        self._size = None
+        self._puts_since_scan = 0
+
+    @property
+    def enabled(self):
+        return self.max_bytes > 0
+
+    def _path(self, key):
+        return self.directory / f"{key}.json"
+
+    def get(self, key):
+        if not self.enabled:
+            return None
+        path = self._path(key)
+        try:
+            value = json.loads(path.read_text(encoding="utf-8"))
+            os.utime(path)
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError) as e:
+            logging.warning(f"Dropping unreadable cache entry {path.name}: {e}")
+            path.unlink(missing_ok=True)
+            return None
+        return value
+
+    def put(self, key, value):
+        if not self.enabled:
+            return
+        self.directory.mkdir(parents=True, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "w", encoding="utf-8") as f:
+                json.dump(value, f)
+                size = f.tell()
+            os.replace(tmp_path, self._path(key))
+        except BaseException:
+            Path(tmp_path).unlink(missing_ok=True)
+            raise
+        self._puts_since_scan += 1
+        if self._size is not None:
+            # a replaced entry is counted twice, which at worst brings the next scan forward
+            self._size += size
+        if self._size is None or self._size > self.max_bytes or self._puts_since_scan >= self.rescan_every:
+            self.evict()
+
+    def evict(self):
+        entries = []
+        total = 0
+        with os.scandir(self.directory) as it:
+            for entry in it:
+                if entry.name.endswith(".json"):
+                    stat = entry.stat()
+                    entries.append((stat.st_mtime, stat.st_size, entry.path))
+                    total += stat.st_size
+        if total > self.max_bytes:
+            for _, size, path in sorted(entries):
+                Path(path).unlink(missing_ok=True)
+                total -= size
+                if total <= self.max_bytes:
+                    break
+        self._size = total
+        self._puts_since_scan = 0
+
+    def clear(self):
+        if self.directory.exists():
+            for path in self.directory.glob("*.json"):
+                path.unlink(missing_ok=True)
+        self._size = None
+
+
+def image_sha256(im):
+    digest = hashlib.sha256(f"{im.mode}:{im.width}x{im.height}:".encode())
+    digest.update(im.tobytes())
+    return digest.hexdigest()
+
+
+@lru_cache(maxsize=64)
+def _file_sha256(path, mtime_ns, size):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def file_sha256(path):
+    """Hash of a model or handler file, memoized per process until the file changes."""
+    if path is None or not Path(path).is_file():
+        return None
+    stat = os.stat(path)
+    return _file_sha256(str(Path(path).resolve()), stat.st_mtime_ns, stat.st_size)
+
+
+def make_key(*parts):
+    return hashlib.sha256("|".join(str(p) for p in parts).encode()).hexdigest()
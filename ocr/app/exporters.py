@@ -0,0 +1,207 @@
+"""Text outputs built straight from the recognized pages, without rendering a PDF.
+
+Every exporter takes the pages as returned by ``ocr_page_file`` (``{"index", "width", "height", "lines"}`` with
+``{"text", "bbox", "baseline", "confidence"}`` lines, in page order) and returns the encoded file.
+"""
+
+from __future__ import annotations
+
+import io
+import os
+import zipfile
+from enum import StrEnum
+
+from lxml import etree
+
+try:
+    from app.file_converter import lines_to_docx_bytes, sort_reading_order
+except Exception:
+    try:
+        from file_converter import lines_to_docx_bytes, sort_reading_order
+    except Exception as e:
+        raise ImportError("Failed to import necessary modules. Ensure the package structure is correct.") from e
+
+
+class OutputFormat(StrEnum):
+    """Output formats, named as in the backend format table."""
+
+    PDF = "pdf"
+    DOCX = "docx"
+    TXT = "txt"
+    HOCR = "hocr"
+    ALTO = "alto"
+    PAGE = "page"
+
+
+DEFAULT_OUTPUT_FORMATS = [OutputFormat(name.strip()) for name in os.getenv("OCR_OUTPUT_FORMATS", "pdf,docx").split(",")]
+
+XHTML_NS = "http://www.w3.org/1999/xhtml"
+HOCR_DOCTYPE = (
+    '<!DOCTYPE html PUBLIC "-//W3C//DTD XHTML 1.0 Transitional//EN" '
+    '"http://www.w3.org/TR/xhtml1/DTD/xhtml1-transitional.dtd">'
+)
+ALTO_NS = "http://www.loc.gov/standards/alto/ns-v4#"
+# same schema version as the PAGE XML of the segmentation training data (model_training/json_to_page.py)
+PAGE_NS = "http://schema.primaresearch.org/PAGE/gts/pagecontent/2013-07-15"
+
+
+def _page_lines(page):
+    return [line for line in sort_reading_order(page["lines"]) if line["text"].strip()]
+
+
+def _union_bbox(lines):
+    return (
+        min(line["bbox"][0] for line in lines),
+        min(line["bbox"][1] for line in lines),
+        max(line["bbox"][2] for line in lines),
+        max(line["bbox"][3] for line in lines),
+    )
+
+
+def _to_bytes(root):
+    return etree.tostring(root, pretty_print=True, xml_declaration=True, encoding="UTF-8")
+
+
+def pages_to_text(pages):
+    """Plain UTF-8 text, one line per recognized line in reading order and a form feed between pages."""
+    return "\f".join("\n".join(line["text"] for line in _page_lines(page)) + "\n" for page in pages).encode()
+
+
+def pages_to_docx(pages):
+    return lines_to_docx_bytes([page["lines"] for page in pages])
+
+
+def pages_to_hocr(pages):
+    html = etree.Element("html", nsmap={None: XHTML_NS})
+    head = etree.SubElement(html, "head")
+    etree.SubElement(head, "title").text = "OCR"
+    etree.SubElement(head, "meta", {"http-equiv": "Content-Type", "content": "text/html; charset=utf-8"})
+    etree.SubElement(head, "meta", name="ocr-system", content="archive_digitalisation")
+    etree.SubElement(head, "meta", name="ocr-capabilities", content="ocr_page ocr_line")
+    body = etree.SubElement(html, "body")
+
+    for page_number, page in enumerate(pages, start=1):
+        div = etree.SubElement(
+            body,
+            "div",
+            {"class": "ocr_page", "id": f"page_{page_number}"},
+            title=f"bbox 0 0 {page['width']} {page['height']}; ppageno {page_number - 1}",
+        )
+        for line_number, line in enumerate(_page_lines(page), start=1):
+            title = "bbox {} {} {} {}".format(*map(int, line["bbox"]))
+            if line.get("confidence") is not None:
+                title += f"; x_wconf {round(line['confidence'] * 100)}"
+            span = etree.SubElement(
+                div, "span", {"class": "ocr_line", "id": f"line_{page_number}_{line_number}"}, title=title
+            )
+            span.text = line["text"]
+
+    return etree.tostring(html, pretty_print=True, xml_declaration=True, encoding="UTF-8", doctype=HOCR_DOCTYPE)
+
+
+def _alto_box(element, bbox):
+    x0, y0, x1, y1 = map(int, bbox)
+    element.set("HPOS", str(x0))
+    element.set("VPOS", str(y0))
+    element.set("WIDTH", str(x1 - x0))
+    element.set("HEIGHT", str(y1 - y0))
+    return element
+
+
+def pages_to_alto(pages):
+    alto = etree.Element("alto", nsmap={None: ALTO_NS})
+    description = etree.SubElement(alto, "Description")
+    etree.SubElement(description, "MeasurementUnit").text = "pixel"
+    layout = etree.SubElement(alto, "Layout")
+
+    for page_number, page in enumerate(pages, start=1):
+        page_el = etree.SubElement(
+            layout,
+            "Page",
+            ID=f"page_{page_number}",
+            PHYSICAL_IMG_NR=str(page_number),
+            WIDTH=str(page["width"]),
+            HEIGHT=str(page["height"]),
+        )
+        print_space = _alto_box(etree.SubElement(page_el, "PrintSpace"), (0, 0, page["width"], page["height"]))
+        lines = _page_lines(page)
+        if not lines:
+            continue
+        block = _alto_box(etree.SubElement(print_space, "TextBlock", ID=f"block_{page_number}"), _union_bbox(lines))
+        for line_number, line in enumerate(lines, start=1):
+            line_id = f"line_{page_number}_{line_number}"
+            line_el = _alto_box(etree.SubElement(block, "TextLine", ID=line_id), line["bbox"])
+            string = _alto_box(etree.SubElement(line_el, "String", ID=f"{line_id}_s"), line["bbox"])
+            string.set("CONTENT", line["text"])
+            if line.get("confidence") is not None:
+                string.set("WC", f"{line['confidence']:.3f}")
+
+    return _to_bytes(alto)
+
+
+def _points(x0, y0, x1, y1):
+    return f"{x0},{y0} {x1},{y0} {x1},{y1} {x0},{y1}"
+
+
+def page_to_page_xml(page, image_filename=""):
+    """PAGE XML of one page, in the layout of ``model_training/json_to_page.make_page_xml``."""
+    root = etree.Element("PcGts", nsmap={None: PAGE_NS})
+    page_el = etree.SubElement(
+        root, "Page", imageFilename=image_filename, imageWidth=str(page["width"]), imageHeight=str(page["height"])
+    )
+    lines = _page_lines(page)
+    if not lines:
+        return _to_bytes(root)
+
+    region = etree.SubElement(page_el, "TextRegion", id="r1")
+    etree.SubElement(region, "Coords", points=_points(*map(int, _union_bbox(lines))))
+    for i, line in enumerate(lines):
+        x0, y0, x1, y1 = map(int, line["bbox"])
+        text_line = etree.SubElement(region, "TextLine", id=f"l{i:04d}")
+        etree.SubElement(text_line, "Coords", points=_points(x0, y0, x1, y1))
+        # without a segmented baseline, the bottom edge of the bbox
+        baseline = line.get("baseline") or [(x0, y1), (x1, y1)]
+        etree.SubElement(text_line, "Baseline", points=" ".join(f"{int(x)},{int(y)}" for x, y in baseline))
+        text_equiv = etree.SubElement(text_line, "TextEquiv")
+        if line.get("confidence") is not None:
+            text_equiv.set("conf", f"{line['confidence']:.3f}")
+        etree.SubElement(text_equiv, "Unicode").text = line["text"]
+    return _to_bytes(root)
+
+
+def pages_to_page_xml(pages):
+    """PAGE XML holds a single page, so a multi-page document becomes a ZIP of ``page_0001.xml``, ... files."""
+    if len(pages) == 1:
+        return page_to_page_xml(pages[0])
+    buf = io.BytesIO()
+    with zipfile.ZipFile(buf, "w", compression=zipfile.ZIP_DEFLATED) as archive:
+        for page in pages:
+            archive.writestr(f"page_{page['index'] + 1:04d}.xml", page_to_page_xml(page))
+    return buf.getvalue()
+
+
+MEDIA_TYPES = {
+    OutputFormat.PDF: ("application/pdf", "pdf"),
+    OutputFormat.DOCX: ("application/vnd.openxmlformats-officedocument.wordprocessingml.document", "docx"),
+    OutputFormat.TXT: ("text/plain; charset=utf-8", "txt"),
+    OutputFormat.HOCR: ("application/xhtml+xml", "hocr"),
+    OutputFormat.ALTO: ("application/xml", "alto.xml"),
+    OutputFormat.PAGE: ("application/xml", "page.xml"),
+}
+
+
+def media_type(output_format, content):
+    """Media type and file extension of an exported ``content``."""
+    if output_format == OutputFormat.PAGE and content[:2] == b"PK":
+        return "application/zip", "page.zip"
+    return MEDIA_TYPES[OutputFormat(output_format)]
+
+
+# every format but the PDF, which needs the page images and fonts (see ocr.render_pdf)
+EXPORTERS = {
+    OutputFormat.DOCX: pages_to_docx,
+    OutputFormat.TXT: pages_to_text,
+    OutputFormat.HOCR: pages_to_hocr,
+    OutputFormat.ALTO: pages_to_alto,
+    OutputFormat.PAGE: pages_to_page_xml,
+}
@@ -1,11 +1,13 @@
 import io
 import logging
+import os
+from enum import StrEnum
+from functools import lru_cache
 from pathlib import Path
 
 import fitz
+import numpy as np
 from docx import Document
-from pdfminer.high_level import extract_text
-from pdfminer.layout import LAParams
 from PIL import Image
 
 try:
@@ -19,142 +21,336 @@ except Exception:
 SCRIPT_DIR = Path(__file__).resolve().parent
 OUT_DIR = SCRIPT_DIR / ".." / "temp" / "pdf_pages"
 
+IMAGE_FORMATS = ["jpeg", "jpg", "tiff", "bmp", "gif"]
+MULTI_FRAME_FORMATS = ["tiff", "gif"]
+
+PDF_RENDER_DPI = int(os.getenv("OCR_PDF_DPI", "300"))
+# minimal part of the page an embedded image has to cover to be taken as the page scan
+SCAN_PAGE_COVERAGE = 0.9
+OVERLAY_FONT = "helv"
+
+
+class PdfProfile(StrEnum):
+    """How the output PDF is built. ``text`` holds the recognized text only, the others also show the page scan."""
+
+    TEXT = "text"
+    # page scan deflated, lossless
+    LOSSLESS = "lossless"
+    # photos and grayscale scans
+    JPEG = "jpeg"
+    JPX = "jpx"
+    # binarized text pages, CCITT G4
+    BILEVEL = "bilevel"
+
+
+PDF_PROFILE = PdfProfile(os.getenv("OCR_PDF_PROFILE", PdfProfile.TEXT))
+PDF_JPEG_QUALITY = int(os.getenv("OCR_PDF_JPEG_QUALITY", "75"))
+# target compression ratio of the JPEG 2000 codestream
+PDF_JPX_RATE = float(os.getenv("OCR_PDF_JPX_RATE", "40"))
+
+
+def pixmap_to_pil(pix):
+    if pix.colorspace is not None and pix.colorspace.n > 3:
+        pix = fitz.Pixmap(fitz.csRGB, pix)
+    if pix.alpha:
+        pix = fitz.Pixmap(pix, 0)
+    mode = "L" if pix.n == 1 else "RGB"
+    return Image.frombytes(mode, (pix.width, pix.height), pix.samples)
+
+
+def _embedded_scan_xref(page):
+    # a scanned page holds a single, upright image covering (almost) the whole page
+    images = page.get_images(full=True)
+    if len(images) != 1 or page.rotation != 0:
+        return None
+    xref = images[0][0]
+    placements = page.get_image_rects(xref, transform=True)
+    if len(placements) != 1:
+        return None
+    rect, matrix = placements[0]
+    if abs(matrix.b) > 1e-3 or abs(matrix.c) > 1e-3 or matrix.a <= 0 or matrix.d <= 0:
+        return None
+    if (rect & page.rect).get_area() < SCAN_PAGE_COVERAGE * page.rect.get_area():
+        return None
+    return xref
+
+
+def load_pdf_page_image(pdf_doc, page_index=0, dpi=PDF_RENDER_DPI, debug=False, debug_indent=0):
+    page = pdf_doc.load_page(page_index)
+
+    xref = _embedded_scan_xref(page)
+    if xref is not None:
+        try:
+            im = pixmap_to_pil(fitz.Pixmap(pdf_doc, xref))
+            scan_dpi = round(im.width / (page.rect.width / 72))
+            im.info["dpi"] = (scan_dpi, scan_dpi)
+            if debug:
+                logging.debug(
+                    get_frontline(debug_indent) + f"Extracted embedded scan {im.width}x{im.height} (~{scan_dpi} dpi)"
+                )
+            return im
+        except Exception as e:
+            logging.warning(f"Failed to extract embedded image of page {page_index}, rendering it instead: {e}")
+
+    im = pixmap_to_pil(page.get_pixmap(dpi=dpi))
+    im.info["dpi"] = (dpi, dpi)
+    if debug:
+        logging.debug(get_frontline(debug_indent) + f"Rendered PDF page at {dpi} dpi: {im.width}x{im.height}")
+    return im
+
+
+def otsu_threshold(gray):
+    """Gray level separating ink from paper in the 8-bit array ``gray``, by Otsu's method."""
+    return otsu_threshold_from_histogram(np.bincount(gray.ravel(), minlength=256))
+
+
+def otsu_threshold_from_histogram(hist):
+    hist = np.asarray(hist, dtype=np.float64)
+    levels = np.arange(256)
+    weight = np.cumsum(hist)
+    mean = np.cumsum(hist * levels)
+    total, total_mean = weight[-1], mean[-1]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        between = (total_mean * weight - mean * total) ** 2 / (weight * (total - weight))
+    if np.isnan(between).all():
+        # a single gray level, e.g. a blank page
+        return int(np.argmax(hist)) - 1 if hist[0] == 0 else 0
+    return int(np.nanargmax(between))
 
-def pil_to_pixmap(image):
-    if image.mode == "1":
-        image = image.convert("L")
 
-    if image.mode == "L":
-        colorspace = fitz.csGRAY
-        alpha = False
-    elif image.mode in ("RGBA", "LA"):
-        image = image.convert("RGBA")
-        colorspace = fitz.csRGB
-        alpha = True
+def binarize(image):
+    gray = np.asarray(image.convert("L"))
+    return Image.fromarray(gray > otsu_threshold(gray))
+
+
+def encode_page_image(image, profile):
+    """The page scan encoded for the PDF ``profile``, or ``None`` when the profile shows no image.
+
+    JPEG and JPEG 2000 streams are embedded as they are; lossless and bilevel images are PNG here and get
+    recompressed by :func:`pdf_to_bytes`.
+    """
+    profile = PdfProfile(profile)
+    if profile == PdfProfile.TEXT:
+        return None
+    image = _normalize_mode(image)
+    buf = io.BytesIO()
+    if profile == PdfProfile.JPEG:
+        image.save(buf, "JPEG", quality=PDF_JPEG_QUALITY, optimize=True)
+    elif profile == PdfProfile.JPX:
+        image.save(buf, "JPEG2000", quality_mode="rates", quality_layers=[PDF_JPX_RATE])
+    elif profile == PdfProfile.BILEVEL:
+        binarize(image).save(buf, "PNG")
     else:
-        if image.mode != "RGB":
-            image = image.convert("RGB")
-        colorspace = fitz.csRGB
-        alpha = False
+        image.save(buf, "PNG", compress_level=1)
+    return buf.getvalue()
+
 
-    samples = image.tobytes()
-    width, height = image.size
-    return fitz.Pixmap(colorspace, width, height, samples, alpha)
+def add_page(pdf_doc, width, height, image_stream=None):
+    page = pdf_doc.new_page(width=width, height=height)
+    if image_stream is not None:
+        page.insert_image(page.rect, stream=image_stream)
+    return page
 
 
-def initialize_pdf_with_image(image, visible_image=True):
+def initialize_pdf_with_image(image, visible_image=True, profile=PdfProfile.LOSSLESS):
     pdf_doc = fitz.open()
-    rect = fitz.Rect(0, 0, image.width, image.height)
-    page = pdf_doc.new_page(width=image.width, height=image.height)
-    if visible_image:
-        pix = pil_to_pixmap(image)
-        page.insert_image(rect, pixmap=pix)
+    add_page(pdf_doc, image.width, image.height, encode_page_image(image, profile) if visible_image else None)
     return pdf_doc
 
 
-def measure_text_single_line(text, fontsize=11, fontname="helv"):
-    font = fitz.Font(fontname)
-    width = font.text_length(text, fontsize=fontsize)
-    height = fontsize
-    return width, height
-
+@lru_cache(maxsize=8)
+def get_font(fontname=OVERLAY_FONT):
+    return fitz.Font(fontname)
 
-def find_fontsize(line_height, line_width, text, fontname="helv"):
-    min_fontsize = 1
-    max_fontsize = line_height
 
-    fontsize = (min_fontsize + max_fontsize) / 2
+def measure_text_single_line(text, fontsize=11, fontname=OVERLAY_FONT):
+    width = get_font(fontname).text_length(text, fontsize=fontsize)
+    height = fontsize
+    return width, height
 
-    for _ in range(line_height):
-        width, height = measure_text_single_line(text, fontsize=fontsize, fontname=fontname)
 
-        if width >= line_width or height >= line_height:
-            max_fontsize = fontsize
-        else:
-            min_fontsize = fontsize
-        fontsize = (min_fontsize + max_fontsize) / 2
-        if max_fontsize - min_fontsize < 1:
-            break
+def find_fontsize(line_height, line_width, text, fontname=OVERLAY_FONT):
+    # text width grows linearly with the font size, so one measurement gives the largest size that fits
+    unit_width, _ = measure_text_single_line(text, fontsize=1, fontname=fontname)
+    limit = line_height if unit_width <= 0 else min(line_height, line_width / unit_width)
+    return int(limit) - 1
 
-    return int(fontsize) - 1
 
+def insert_lines(pdf_doc, lines_data, page_index=0, draw_rect=False, fontname=OVERLAY_FONT):
+    """Writes every ``{"text", "bbox"}`` line into its bbox on the page, sized to fit, in a single text batch."""
+    page = pdf_doc[page_index]
+    font = get_font(fontname)
+    writer = fitz.TextWriter(page.rect)
+    shape = page.new_shape() if draw_rect else None
 
-def insert_text_at_bbox(pdf_doc, text, bbox, visible_image=True, draw_rect=False):
-    page = pdf_doc[0]
-    x0, y0, x1, y1 = bbox
-    rect = fitz.Rect(x0, y0, x1, y1)
-    if draw_rect:
-        sh = page.new_shape()
-        sh.draw_rect(rect)
-        sh.finish(fill=None, color=(1, 0, 0))
-        sh.commit(overlay=True)
+    for item in lines_data:
+        text = item["text"]
+        x0, y0, x1, y1 = item["bbox"]
+        if shape is not None:
+            shape.draw_rect(fitz.Rect(x0, y0, x1, y1))
+        if not text:
+            continue
+        fs = max(1, find_fontsize(line_height=y1 - y0, line_width=x1 - x0, text=text, fontname=fontname))
+        writer.append(fitz.Point(x0, (y0 + y1 + fs) / 2), text, font=font, fontsize=fs)
 
-    fs = find_fontsize(line_height=y1 - y0, line_width=x1 - x0, text=text)
+    if shape is not None:
+        shape.finish(fill=None, color=(1, 0, 0))
+        shape.commit(overlay=True)
+    writer.write_text(page, color=0, opacity=1, overlay=True)
 
-    point_down = rect.bl
-    point_up = rect.tl
-    point = fitz.Point(point_down.x, ((min(point_down.y, point_up.y) + max(point_down.y, point_up.y)) + fs) / 2)
 
-    page.insert_text(point, text, fontsize=fs, fontname="helv", color=0, fill_opacity=1, overlay=True)
+def insert_text_at_bbox(pdf_doc, text, bbox, visible_image=True, draw_rect=False, page_index=0):
+    insert_lines(pdf_doc, [{"text": text, "bbox": bbox}], page_index=page_index, draw_rect=draw_rect)
 
 
-def pdf_to_bytes(pdf_doc):
-    return pdf_doc.write()
+def pdf_to_bytes(pdf_doc, profile=PdfProfile.TEXT):
+    """The document compacted for output: fonts subset to the used glyphs, unreferenced objects dropped and
+    streams deflated. Bilevel page images are recompressed as CCITT G4 (fax) on the way.
+    """
+    if profile == PdfProfile.BILEVEL:
+        pdf_doc.rewrite_images(bitonal=True, color=False, gray=False, lossy=False, lossless=True)
+    pdf_doc.subset_fonts()
+    return pdf_doc.write(garbage=3, deflate=True, deflate_images=True, deflate_fonts=True, use_objstms=1)
 
 def save_docx_to_path(docx_bytes, output_path) :
     with open(output_path, "wb") as f :
         f.write(docx_bytes)
 
-def pdf_to_docx_bytes(pdf_doc) :
-    pdf_bytes = pdf_to_bytes(pdf_doc)
+def sort_reading_order(lines_data):
+    """Lines top to bottom; lines whose vertical centre falls into the same row are ordered left to right."""
+    rows = []
+    for item in sorted(lines_data, key=lambda item: (item["bbox"][1], item["bbox"][0])):
+        x0, y0, x1, y1 = item["bbox"]
+        centre = (y0 + y1) / 2
+        if rows and rows[-1]["y0"] <= centre <= rows[-1]["y1"]:
+            rows[-1]["lines"].append(item)
+            rows[-1]["y1"] = max(rows[-1]["y1"], y1)
+        else:
+            rows.append({"y0": y0, "y1": y1, "lines": [item]})
+    return [item for row in rows for item in sorted(row["lines"], key=lambda item: item["bbox"][0])]
+
 
-    laparams = LAParams()
-    text = extract_text(io.BytesIO(pdf_bytes), laparams=laparams)
+def lines_to_docx_bytes(pages_lines):
+    """DOCX with one paragraph per recognized line, in reading order, and a page break between pages.
 
+    ``pages_lines`` is a list of pages, each a list of ``{"text", "bbox", ...}`` line dicts.
+    """
     doc = Document()
-    for line in text.splitlines() :
-        if line.strip() == "" :
-            continue
-        doc.add_paragraph(line)
+    for page_index, lines_data in enumerate(pages_lines):
+        if page_index > 0:
+            doc.add_page_break()
+        for item in sort_reading_order(lines_data):
+            if item["text"].strip():
+                doc.add_paragraph(item["text"])
 
     buf = io.BytesIO()
     doc.save(buf)
     return buf.getvalue()
 
-def convert_to_png_bytes(input_bytes, input_format, debug=False, debug_indent=0):
+def _is_bytes(source):
+    return isinstance(source, (bytes, bytearray, memoryview))
+
+
+def _open_pdf(source):
+    # input is either the file content or a path to it; a path lets fitz load pages lazily
+    if _is_bytes(source):
+        return fitz.open(stream=source, filetype="pdf")
+    return fitz.open(source, filetype="pdf")
+
+
+def _open_image(source):
+    return Image.open(io.BytesIO(source) if _is_bytes(source) else source)
+
+
+def count_pages(source, input_format):
+    if input_format["format"] == "pdf":
+        with _open_pdf(source) as pdf_doc:
+            return pdf_doc.page_count
+    elif input_format["format"] in MULTI_FRAME_FORMATS:
+        with _open_image(source) as im:
+            return getattr(im, "n_frames", 1)
+    elif input_format["format"] == "png" or input_format["format"] in IMAGE_FORMATS:
+        return 1
+    else:
+        raise ValueError(f"Unsupported input format: {input_format}")
+
+
+def estimate_page_pixels(source):
+    """Page count and pixel count of the largest page, read from the file headers without decoding pages.
+
+    The format is sniffed from the content, so the estimate is available before the job looks it up.
+    """
+    if _is_bytes(source):
+        is_pdf = bytes(source[:5]) == b"%PDF-"
+    else:
+        with open(source, "rb") as f:
+            is_pdf = f.read(5) == b"%PDF-"
+
+    if is_pdf:
+        scale = PDF_RENDER_DPI / 72
+        with _open_pdf(source) as pdf_doc:
+            sizes = (page.rect for page in pdf_doc)
+            return pdf_doc.page_count, max((int(r.width * scale) * int(r.height * scale) for r in sizes), default=0)
+    with _open_image(source) as im:
+        return getattr(im, "n_frames", 1), im.width * im.height
+
+
+def _16bit_to_l(im):
+    # convert() clips 16-bit samples to 255 instead of scaling them
+    gray = np.clip(np.asarray(im), 0, 0xFFFF).astype(np.uint16) >> 8
+    out = Image.fromarray(gray.astype(np.uint8), "L")
+    out.info = dict(im.info)
+    return out
+
+
+def _normalize_mode(im):
+    if im.mode == "1":
+        return im.convert("L")
+    if im.mode == "I" or im.mode.startswith("I;16"):
+        return _16bit_to_l(im)
+    if im.mode not in ("L", "RGB"):
+        return im.convert("RGB")
+    return im
+
+
+def as_pil_image(image):
+    """PIL image (mode ``L`` or ``RGB``) of a PIL image, a NumPy array or encoded image bytes."""
+    if isinstance(image, Image.Image):
+        return _normalize_mode(image)
+    if isinstance(image, np.ndarray):
+        return _normalize_mode(Image.fromarray(image))
+    if _is_bytes(image):
+        return _normalize_mode(Image.open(io.BytesIO(image)))
+    raise TypeError("image must be a PIL.Image.Image, a numpy array or encoded image bytes")
+
+
+def load_page_image(source, input_format, page_index=0, debug=False, debug_indent=0):
+    """Decodes one page of the input into a PIL image (mode ``L`` or ``RGB``), which the OCR stages use as is."""
     if debug:
-        logging.debug(get_frontline(debug_indent) + f"Converting input format '{input_format}' to PNG bytes")
-
-    if input_format["format"] == "png":
-        if debug:
-            logging.debug(get_frontline(debug_indent) + "Input is already PNG format, no conversion needed")
-        return input_bytes
-
-    elif input_format["format"] == "pdf":
-        if debug:
-            logging.debug(get_frontline(debug_indent) + "Converting PDF to PNG using fitz")
-        pdf_doc = fitz.open(stream=input_bytes, filetype="pdf")
-        page = pdf_doc.load_page(0)
-        pix = page.get_pixmap()
-        png_bytes = pix.tobytes("png")
-        if debug:
-            logging.debug(get_frontline(debug_indent) + f"Converted PDF to PNG bytes: {len(png_bytes)} bytes")
-        return png_bytes
-
-    elif input_format["format"] in ["jpeg", "jpg", "tiff", "bmp", "gif"]:
-        if debug:
-            logging.debug(get_frontline(debug_indent) +
-                          f"Converting image format '{input_format['format']}' to PNG using PIL")
-        im = Image.open(io.BytesIO(input_bytes))
-        with io.BytesIO() as output:
-            im.save(output, format="PNG")
-            png_bytes = output.getvalue()
-        if debug:
-            logging.debug(get_frontline(debug_indent) + f"Converted image to PNG bytes: {len(png_bytes)} bytes")
-        return png_bytes
+        logging.debug(get_frontline(debug_indent) + f"Loading page {page_index} of input format '{input_format}'")
+
+    if input_format["format"] == "pdf":
+        with _open_pdf(source) as pdf_doc:
+            im = load_pdf_page_image(pdf_doc, page_index, debug=debug, debug_indent=debug_indent + 1)
+
+    elif input_format["format"] == "png" or input_format["format"] in IMAGE_FORMATS:
+        im = _open_image(source)
+        if page_index:
+            im.seek(page_index)
+        if getattr(im, "n_frames", 1) > 1:
+            frame = im.copy()
+            im.close()
+            im = frame
+        else:
+            im.load()
 
     else:
-        raise ValueError(f"Unsupported input format for conversion to PNG: {input_format}")
+        raise ValueError(f"Unsupported input format: {input_format}")
+
+    im = _normalize_mode(im)
+    if debug:
+        logging.debug(get_frontline(debug_indent) + f"Loaded page image: {im.width}x{im.height} {im.mode}")
+    return im
 
 
 if __name__ == "__main__":
@@ -166,56 +362,68 @@ if __name__ == "__main__":
     pdf_doc = initialize_pdf_with_image(im, VISIBLE_IMAGE)
 
     out_path = OUT_DIR / "output.pdf"
+    lines_data = []
 
     text = "Though they may gather same Left -wing"
     bbox = (356, 789, 2319, 938)
     insert_text_at_bbox(pdf_doc, text, bbox, VISIBLE_IMAGE, VISIBLE_RECTS)
+    lines_data.append({"text": text, "bbox": bbox})
 
     text = "support, a large majority of Labour"
     bbox = (336, 962, 2209, 1103)
     insert_text_at_bbox(pdf_doc, text, bbox, VISIBLE_IMAGE, VISIBLE_RECTS)
+    lines_data.append({"text": text, "bbox": bbox})
 
     text = "M Ps are likely to turn down the Foot-"
     bbox = (333, 1147, 2248, 1284)
     insert_text_at_bbox(pdf_doc, text, bbox, VISIBLE_IMAGE, VISIBLE_RECTS)
+    lines_data.append({"text": text, "bbox": bbox})
 
     text = "Griffithus resolution. Mr. Foot's line will"
     bbox = (325, 1316, 2252, 1458)
     insert_text_at_bbox(pdf_doc, text, bbox, VISIBLE_IMAGE, VISIBLE_RECTS)
+    lines_data.append({"text": text, "bbox": bbox})
 
     text = "bthalas Labonr M Ps opposed the"
     bbox = (336, 1493, 2244, 1647)
     insert_text_at_bbox(pdf_doc, text, bbox, VISIBLE_IMAGE, VISIBLE_RECTS)
+    lines_data.append({"text": text, "bbox": bbox})
 
     text = "overnment Bill which brougut life peers"
     bbox = (321, 1674, 2366, 1820)
     insert_text_at_bbox(pdf_doc, text, bbox, VISIBLE_IMAGE, VISIBLE_RECTS)
+    lines_data.append({"text": text, "bbox": bbox})
 
     text = "mto existence, they schould not no ut"
     bbox = (325, 1847, 2347, 1993)
     insert_text_at_bbox(pdf_doc, text, bbox, VISIBLE_IMAGE, VISIBLE_RECTS)
+    lines_data.append({"text": text, "bbox": bbox})
 
     text = "forwad nominees. He believes that the"
     bbox = (344, 2028, 2347, 2174)
     insert_text_at_bbox(pdf_doc, text, bbox, VISIBLE_IMAGE, VISIBLE_RECTS)
+    lines_data.append({"text": text, "bbox": bbox})
 
     text = "House of Lords should be aboolished and"
     bbox = (340, 2213, 2343, 2351)
     insert_text_at_bbox(pdf_doc, text, bbox, VISIBLE_IMAGE, VISIBLE_RECTS)
+    lines_data.append({"text": text, "bbox": bbox})
 
     text = "that Labour should not take any steps"
     bbox = (325, 2394, 2319, 2532)
     insert_text_at_bbox(pdf_doc, text, bbox, VISIBLE_IMAGE, VISIBLE_RECTS)
+    lines_data.append({"text": text, "bbox": bbox})
 
     text = 'which would appear to "prop up an out.'
     bbox = (325, 2587, 2374, 2713)
     insert_text_at_bbox(pdf_doc, text, bbox, VISIBLE_IMAGE, VISIBLE_RECTS)
+    lines_data.append({"text": text, "bbox": bbox})
 
     pdf_doc.save(out_path)
 
     print(f"Saved PDF to: {out_path.resolve()}")
 
-    docx_bytes = pdf_to_docx_bytes(pdf_doc)
+    docx_bytes = lines_to_docx_bytes([lines_data])
     docx_path = OUT_DIR / "output.docx"
     save_docx_to_path(docx_bytes, docx_path)
     print(f"Saved DOCX to: {docx_path.resolve()}")
@@ -0,0 +1,67 @@
+from __future__ import annotations
+
+import binascii
+import os
+import re
+import shutil
+import tempfile
+from pathlib import Path
+
+SPOOL_DIR = Path(os.getenv("OCR_SPOOL_DIR", Path(__file__).resolve().parent / ".." / "temp" / "uploads"))
+CHUNK_SIZE = 1024 * 1024
+
+_BASE64_RE = re.compile(r"[A-Za-z0-9+/]*={0,2}")
+
+
+def is_valid_base64(value):
+    # same rules as base64.b64decode(validate=True), without building the decoded copy
+    return len(value) % 4 == 0 and _BASE64_RE.fullmatch(value) is not None
+
+
+def _new_spool_file():
+    SPOOL_DIR.mkdir(parents=True, exist_ok=True)
+    fd, path = tempfile.mkstemp(dir=SPOOL_DIR, prefix="input_")
+    return os.fdopen(fd, "wb"), Path(path)
+
+
+def new_spool_dir(prefix):
+    """Empty directory in the spool, for files a job passes between its worker processes."""
+    SPOOL_DIR.mkdir(parents=True, exist_ok=True)
+    return Path(tempfile.mkdtemp(dir=SPOOL_DIR, prefix=prefix))
+
+
+def spool_base64(content):
+    f, path = _new_spool_file()
+    try:
+        with f:
+            # decode in slices, so the decoded file is never held in memory at once
+            step = CHUNK_SIZE // 3 * 4
+            for start in range(0, len(content), step):
+                f.write(binascii.a2b_base64(content[start : start + step]))
+    except BaseException:
+        path.unlink(missing_ok=True)
+        raise
+    return path
+
+
+def spool_fileobj(fileobj):
+    f, path = _new_spool_file()
+    try:
+        with f:
+            shutil.copyfileobj(fileobj, f, CHUNK_SIZE)
+    except BaseException:
+        path.unlink(missing_ok=True)
+        raise
+    return path
+
+
+async def spool_stream(stream):
+    f, path = _new_spool_file()
+    try:
+        with f:
+            async for chunk in stream:
+                f.write(chunk)
+    except BaseException:
+        path.unlink(missing_ok=True)
+        raise
+    return path
@@ -0,0 +1,632 @@
+from __future__ import annotations
+
+import asyncio
+import heapq
+import itertools
+import logging
+import math
+import multiprocessing as mp
+import os
+import shutil
+import threading
+import time
+import uuid
+from collections.abc import Awaitable, Callable
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from dataclasses import dataclass, field
+from enum import StrEnum
+from pathlib import Path
+from typing import Any
+
+OCR_WORKERS = int(os.getenv("OCR_WORKERS", "2"))
+OCR_WORKER_START_METHOD = os.getenv("OCR_WORKER_START_METHOD", "spawn")
+JOB_RESULT_TTL = float(os.getenv("OCR_JOB_RESULT_TTL", "3600"))
+PAGES_IN_FLIGHT = int(os.getenv("OCR_PAGES_IN_FLIGHT", "0")) or OCR_WORKERS
+SCRATCH_DIR = Path(os.getenv("OCR_SCRATCH_DIR", Path(__file__).resolve().parent / ".." / "temp" / "jobs"))
+MAX_RUNNING_JOBS = int(os.getenv("OCR_MAX_RUNNING_JOBS", "0")) or OCR_WORKERS
+MAX_QUEUED_JOBS = int(os.getenv("OCR_MAX_QUEUED_JOBS", "100"))
+MEMORY_BUDGET = int(float(os.getenv("OCR_MEMORY_BUDGET_MB", "0")) * 1024 * 1024)
+# decoded page, its binarized and inverted copies and the segmentation tensors
+BYTES_PER_PIXEL = int(os.getenv("OCR_BYTES_PER_PIXEL", "32"))
+WARM_UP_POLL_INTERVAL = 0.5
+EVICT_INTERVAL = 60.0
+INITIAL_JOB_DURATION = 30.0
+MAX_RETRY_AFTER = 600
+
+_WARM_UP_REPORT = None
+_CPU_REPORT = None
+_EVENT_QUEUE = None
+
+FLUSH_EVENT = "flush"
+FLUSH_TIMEOUT = 10.0
+TERMINAL_EVENTS = ("done", "failed")
+# not kept once the job finished, their text is in the stored document
+TRANSIENT_EVENTS = ("line",)
+
+
+class JobRejectedError(RuntimeError):
+    def __init__(self, message, retry_after):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+def _parse_weights(value):
+    # "owner:weight,owner:weight", e.g. "12:4,7:0.5"
+    weights = {}
+    for item in filter(None, (part.strip() for part in value.split(","))):
+        owner, _, weight = item.partition(":")
+        weights[owner.strip()] = float(weight)
+    return weights
+
+
+OWNER_WEIGHTS = _parse_weights(os.getenv("OCR_OWNER_WEIGHTS", ""))
+
+
+class JobPriority(StrEnum):
+    # declaration order is the scheduling order
+    INTERACTIVE = "interactive"
+    BULK = "bulk"
+
+
+class JobStatus(StrEnum):
+    QUEUED = "queued"
+    RUNNING = "running"
+    DONE = "done"
+    FAILED = "failed"
+
+
+@dataclass
+class Job:
+    id: str
+    payload: Any
+    auth_header: str | None
+    input_path: Path | None = None
+    memory: int = 0
+    owner: str | None = None
+    priority: JobPriority = JobPriority.INTERACTIVE
+    cost: float = 1
+    events: list[dict] = field(default_factory=list, repr=False)
+    event_count: int = 0
+    scratch_dir: Path | None = None
+    # per-request output settings, passed through to the handler
+    options: dict[str, Any] = field(default_factory=dict)
+    # serialized page model the handler keeps for re-rendering, see app/page_model.py
+    document: bytes | None = field(default=None, repr=False)
+    status: JobStatus = JobStatus.QUEUED
+    result: Any = None
+    error: str | None = None
+    created_at: float = field(default_factory=time.time)
+    started_at: float | None = None
+    finished_at: float | None = None
+
+    @property
+    def debug(self):
+        return self.scratch_dir is not None
+
+    @property
+    def finished(self):
+        return self.status in (JobStatus.DONE, JobStatus.FAILED)
+
+    def info(self):
+        return {
+            "jobId": self.id,
+            "status": self.status.value,
+            "priority": self.priority.value,
+            "debug": self.debug,
+            "options": self.options,
+            "hasDocument": self.document is not None,
+            "createdAt": self.created_at,
+            "startedAt": self.started_at,
+            "finishedAt": self.finished_at,
+            "error": self.error,
+        }
+
+
+class FairJobQueue:
+    """Job queue doing weighted fair queuing across owners, within strict priority classes.
+
+    Every job gets a virtual finish tag of ``max(virtual time, owner's last tag) + cost / weight``, and the job
+    with the lowest tag of the highest non-empty class runs next. An owner with many queued jobs therefore gets
+    its share of the workers, but no more, while the jobs of one owner still run in arrival order.
+    """
+
+    def __init__(self, weights=None, default_weight=1.0):
+        self.weights = weights if weights is not None else OWNER_WEIGHTS
+        self.default_weight = default_weight
+        self._heaps = {priority: [] for priority in JobPriority}
+        self._virtual_time = 0.0
+        self._last_tags = {}
+        self._counter = itertools.count()
+        self._not_empty = asyncio.Event()
+
+    def qsize(self):
+        return sum(len(heap) for heap in self._heaps.values())
+
+    def weight(self, owner):
+        return max(self.weights.get(str(owner), self.default_weight), 1e-6)
+
+    def put_nowait(self, job):
+        start = max(self._virtual_time, self._last_tags.get(job.owner, 0.0))
+        finish = start + job.cost / self.weight(job.owner)
+        self._last_tags[job.owner] = finish
+        heapq.heappush(self._heaps[job.priority], (finish, next(self._counter), start, job))
+        self._not_empty.set()
+
+    async def get(self):
+        while True:
+            for heap in self._heaps.values():
+                if heap:
+                    _, _, start, job = heapq.heappop(heap)
+                    self._virtual_time = max(self._virtual_time, start)
+                    self._forget_idle_owners()
+                    return job
+            self._not_empty.clear()
+            await self._not_empty.wait()
+
+    def _forget_idle_owners(self):
+        # tags behind the virtual time carry no information, an owner coming back starts at the virtual time
+        if len(self._last_tags) > 1024:
+            self._last_tags = {o: t for o, t in self._last_tags.items() if t > self._virtual_time}
+
+    def depth(self):
+        """Number of queued jobs per owner and per priority class."""
+        owners = {}
+        priorities = {}
+        for priority, heap in self._heaps.items():
+            priorities[priority.value] = len(heap)
+            for *_, job in heap:
+                owners[job.owner] = owners.get(job.owner, 0) + 1
+        return {"owners": owners, "priorities": priorities}
+
+
+class JobEvents:
+    """Picklable ``on_event(event, data)`` callback sending progress of one job from a worker to the manager."""
+
+    def __init__(self, job_id):
+        self.job_id = job_id
+
+    def __call__(self, event, data=None):
+        if _EVENT_QUEUE is not None:
+            _EVENT_QUEUE.put((self.job_id, event, data))
+
+
+def _init_worker(log_level, warm_up=None, cpu_allocation=None, worker_counter=None, event_queue=None):
+    global _WARM_UP_REPORT, _CPU_REPORT, _EVENT_QUEUE
+    logging.basicConfig(level=log_level)
+    _EVENT_QUEUE = event_queue
+    if cpu_allocation is not None:
+        with worker_counter.get_lock():
+            index = worker_counter.value
+            worker_counter.value += 1
+        try:
+            _CPU_REPORT = cpu_allocation.apply_to_worker(index)
+        except Exception as e:
+            logging.exception("Applying the CPU allocation failed")
+            _CPU_REPORT = {"index": index, "error": str(e)}
+    if warm_up is not None:
+        # runs before the worker takes its first task, so no job ever waits for a cold model
+        start = time.perf_counter()
+        try:
+            _WARM_UP_REPORT = warm_up()
+        except Exception as e:
+            logging.exception("Worker warm-up failed")
+            _WARM_UP_REPORT = {"error": str(e)}
+        _WARM_UP_REPORT["seconds"] = round(time.perf_counter() - start, 3)
+
+
+def warm_up_ok(report):
+    """Whether a worker's warm-up report has no error and the segmentation and every recognizer loaded."""
+    if report.get("error"):
+        return False
+    if not report.get("segmentation", {}).get("loaded"):
+        return False
+    return all(model.get("loaded") for model in report.get("models", []))
+
+
+def _worker_report():
+    report = {"pid": os.getpid(), **(_WARM_UP_REPORT or {})}
+    if _CPU_REPORT is not None:
+        report["cpu"] = _CPU_REPORT
+    return report
+
+
+class JobManager:
+    """Queues OCR jobs and drains them with a bounded pool of worker processes.
+
+    ``handler`` is an ``async`` callable receiving ``(job, manager)``; it runs on the event loop and
+    should push CPU heavy work to the pool with :meth:`run_in_pool`. Its return value becomes the job result.
+
+    ``warm_up`` is called once in every worker process before it takes work; the reports it returns are
+    collected in :attr:`warm_up_reports` and :attr:`ready` turns true once every worker has reported all of its
+    models loaded (see :func:`warm_up_ok`). A worker reporting a failure makes the :attr:`state` ``failed``.
+    With the ``fork`` start method ``preload`` is called in this process before the workers are forked, so the
+    models it loads are inherited by all of them instead of being loaded once per worker.
+    A worker process dying (OOM kill, crash in a native library) breaks the whole pool: the pool calls running in
+    it fail with ``BrokenProcessPool``, failing their jobs, and the pool is replaced by a fresh one which warms up
+    again. A pool breaking during its warm-up is not replaced, it makes the :attr:`state` ``failed`` instead.
+    ``cpu_allocation`` (see :mod:`resources`) sets the torch threads and CPU affinity of every worker.
+
+    At most ``max_running`` jobs run at once. :meth:`submit` rejects a job with :class:`JobRejectedError` when
+    ``max_queued`` jobs are already waiting or when the estimated memory of all accepted jobs would exceed
+    ``memory_budget`` bytes (``0`` disables the budget).
+
+    A job submitted with ``debug`` gets its own :attr:`Job.scratch_dir` for debug artifacts, removed together
+    with the job once its result expired, which is checked on every submit and every ``EVICT_INTERVAL`` seconds.
+    :meth:`stop` removes the scratch dirs of all jobs, as they cannot be reached after a restart.
+
+    Progress of a job is recorded as a list of events, see :meth:`publish` and :meth:`iter_events`. Pool
+    functions report theirs through a :class:`JobEvents` callback, which forwards them over a pipe. Once a job
+    finished its ``line`` events are dropped from the history, so a replay only holds the other ones.
+    """
+
+    def __init__(
+        self,
+        handler: Callable[[Job, JobManager], Awaitable[Any]],
+        workers=OCR_WORKERS,
+        start_method=OCR_WORKER_START_METHOD,
+        result_ttl=JOB_RESULT_TTL,
+        pages_in_flight=PAGES_IN_FLIGHT,
+        warm_up=None,
+        preload=None,
+        cpu_allocation=None,
+        max_running=MAX_RUNNING_JOBS,
+        max_queued=MAX_QUEUED_JOBS,
+        memory_budget=MEMORY_BUDGET,
+        scratch_root=SCRATCH_DIR,
+    ):
+        self.handler = handler
+        self.workers = max(1, workers)
+        self.start_method = start_method
+        self.result_ttl = result_ttl
+        self.pages_in_flight = max(1, pages_in_flight)
+        self.warm_up = warm_up
+        self.preload = preload
+        self.cpu_allocation = cpu_allocation
+        self.max_running = max(1, max_running)
+        self.max_queued = max_queued
+        self.memory_budget = memory_budget
+        self.scratch_root = Path(scratch_root)
+        self._job_duration = INITIAL_JOB_DURATION
+        self.warm_up_reports: dict[int, dict] = {}
+        self.jobs: dict[str, Job] = {}
+        self._queue: FairJobQueue | None = None
+        self._pool: ProcessPoolExecutor | None = None
+        self.pool_error: str | None = None
+        self.pool_restarts = 0
+        self._tasks: list[asyncio.Task] = []
+        self._listeners: dict[str, set[asyncio.Queue]] = {}
+        self._events = None
+        self._events_reader: threading.Thread | None = None
+        self._flushes: dict[int, asyncio.Future] = {}
+        self._flush_ids = itertools.count()
+
+    async def start(self):
+        self._queue = FairJobQueue()
+        if self.preload is not None and self.start_method == "fork":
+            start = time.perf_counter()
+            self.preload()
+            logging.info(f"Preloaded models for forked workers in {time.perf_counter() - start:.1f}s")
+        mp_context = mp.get_context(self.start_method)
+        # a SimpleQueue writes synchronously, so an event is in the pipe before the pool call returns
+        self._events = mp_context.SimpleQueue()
+        self._events_reader = threading.Thread(
+            target=self._read_events, args=(asyncio.get_running_loop(), self._events), daemon=True
+        )
+        self._events_reader.start()
+        if self.cpu_allocation is not None:
+            logging.info(f"CPU allocation: {self.cpu_allocation.describe()}")
+        self._tasks = [asyncio.create_task(self._worker(i)) for i in range(self.max_running)]
+        self._tasks.append(asyncio.create_task(self._evict_periodically()))
+        self._start_pool()
+        logging.info(f"Started OCR job manager with {self.workers} worker processes ({self.start_method})")
+
+    def _start_pool(self):
+        mp_context = mp.get_context(self.start_method)
+        self._pool = ProcessPoolExecutor(
+            max_workers=self.workers,
+            mp_context=mp_context,
+            initializer=_init_worker,
+            initargs=(
+                logging.getLogger().level,
+                self.warm_up,
+                self.cpu_allocation,
+                mp_context.Value("i", 0),
+                self._events,
+            ),
+        )
+        self.warm_up_reports = {}
+        if self.warm_up is not None:
+            self._tasks.append(asyncio.create_task(self._collect_warm_up_reports(self._pool)))
+
+    def _replace_broken_pool(self, pool):
+        # every call running in the broken pool fails, only the first one to get here replaces it
+        if pool is not self._pool:
+            return
+        self.pool_restarts += 1
+        logging.error(f"An OCR worker process died, restarting the worker pool (restart {self.pool_restarts})")
+        pool.shutdown(wait=False, cancel_futures=True)
+        self._start_pool()
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        if self._pool is not None:
+            self._pool.shutdown(wait=False, cancel_futures=True)
+            self._pool = None
+        if self._events_reader is not None:
+            self._events.put(None)
+            self._events_reader.join(timeout=5)
+            self._events_reader = None
+        for job in self.jobs.values():
+            _remove_scratch_dir(job)
+
+    def estimate_memory(self, page_count, page_pixels):
+        # pages of one job are processed in a window, so only that many are decoded at once
+        return min(page_count, self.pages_in_flight) * page_pixels * BYTES_PER_PIXEL
+
+    @property
+    def committed_memory(self):
+        return sum(job.memory for job in self.jobs.values() if not job.finished)
+
+    def retry_after(self):
+        waiting = self._queue.qsize() if self._queue is not None else 0
+        seconds = self._job_duration * math.ceil((waiting + 1) / self.max_running)
+        return max(1, min(MAX_RETRY_AFTER, math.ceil(seconds)))
+
+    def check_admission(self, memory=0):
+        if self._queue is None:
+            raise RuntimeError("Job manager is not started")
+        if self._queue.qsize() >= self.max_queued:
+            raise JobRejectedError(f"OCR queue is full ({self.max_queued} jobs waiting)", self.retry_after())
+        committed = self.committed_memory
+        # a job larger than the whole budget is still accepted when nothing else is, or it could never run
+        if self.memory_budget > 0 and committed > 0 and committed + memory > self.memory_budget:
+            raise JobRejectedError(
+                f"OCR memory budget exhausted ({(committed + memory) // 2**20} of {self.memory_budget // 2**20} MB)",
+                self.retry_after(),
+            )
+
+    def submit(
+        self,
+        payload,
+        auth_header=None,
+        input_path=None,
+        memory=0,
+        owner=None,
+        priority=JobPriority.INTERACTIVE,
+        cost=1,
+        debug=False,
+        options=None,
+    ):
+        self._evict_expired()
+        self.check_admission(memory)
+        job = Job(
+            id=uuid.uuid4().hex,
+            payload=payload,
+            auth_header=auth_header,
+            input_path=input_path,
+            memory=memory,
+            owner=None if owner is None else str(owner),
+            priority=JobPriority(priority),
+            cost=max(cost, 1),
+            options=dict(options or {}),
+        )
+        if debug:
+            job.scratch_dir = self.scratch_root / job.id
+        self.jobs[job.id] = job
+        self.publish(job, "status", {"status": job.status.value})
+        self._queue.put_nowait(job)
+        logging.debug(f"Queued job {job.id} of owner {job.owner} (queue depth: {self._queue.qsize()})")
+        return job
+
+    def queue_metrics(self):
+        depth = self._queue.depth() if self._queue is not None else {"owners": {}, "priorities": {}}
+        running = {}
+        for job in self.jobs.values():
+            if job.status == JobStatus.RUNNING:
+                running[job.owner] = running.get(job.owner, 0) + 1
+        owners = {
+            str(owner): {"queued": depth["owners"].get(owner, 0), "running": running.get(owner, 0)}
+            for owner in depth["owners"].keys() | running.keys()
+        }
+        return {
+            "queued": sum(depth["priorities"].values()),
+            "running": sum(running.values()),
+            "priorities": depth["priorities"],
+            "owners": owners,
+        }
+
+    @property
+    def ready(self):
+        if self._pool is None:
+            return False
+        if self.warm_up is None:
+            return True
+        reports = self.warm_up_reports.values()
+        return len(reports) >= self.workers and all(map(warm_up_ok, reports))
+
+    @property
+    def state(self):
+        """``ready``, ``starting`` while workers are still warming up, or ``failed`` once one reported a failure
+        or the pool broke during its warm-up.
+        """
+        if self.pool_error is not None:
+            return "failed"
+        if self.ready:
+            return "ready"
+        if not all(map(warm_up_ok, self.warm_up_reports.values())):
+            return "failed"
+        return "starting"
+
+    async def _collect_warm_up_reports(self, pool):
+        # starts every worker process and waits until each of them finished its warm-up
+        loop = asyncio.get_running_loop()
+        while len(self.warm_up_reports) < self.workers:
+            missing = self.workers - len(self.warm_up_reports)
+            try:
+                reports = await asyncio.gather(*(loop.run_in_executor(pool, _worker_report) for _ in range(missing)))
+            except BrokenProcessPool as e:
+                if pool is self._pool:
+                    # a worker dying while it warms up would most likely die again, the orchestrator restarts us
+                    self.pool_error = str(e) or e.__class__.__name__
+                    logging.error(f"OCR worker pool broke during its warm-up: {self.pool_error}")
+                return
+            if pool is not self._pool:
+                return
+            for report in reports:
+                self.warm_up_reports[report["pid"]] = report
+            if len(self.warm_up_reports) < self.workers:
+                await asyncio.sleep(WARM_UP_POLL_INTERVAL)
+        if self.ready:
+            logging.info(f"All {self.workers} OCR worker processes are ready")
+        else:
+            logging.error("OCR worker warm-up failed, see /ready for the load state of every model")
+
+    def get(self, job_id):
+        return self.jobs.get(job_id)
+
+    async def run_in_pool(self, fn, *args):
+        loop = asyncio.get_running_loop()
+        pool = self._pool
+        try:
+            return await loop.run_in_executor(pool, fn, *args)
+        except BrokenProcessPool:
+            self._replace_broken_pool(pool)
+            raise
+
+    async def map_in_pool(self, fn, args_iter):
+        """Runs ``fn(*args)`` in the pool for every item of ``args_iter`` and returns the results in order.
+
+        At most ``pages_in_flight`` calls of one job are submitted at a time, so pages stream through the pool
+        and the memory of a job is bounded by that window rather than by the number of pages.
+        """
+        window = asyncio.Semaphore(self.pages_in_flight)
+
+        async def run(args):
+            async with window:
+                return await self.run_in_pool(fn, *args)
+
+        tasks = [asyncio.ensure_future(run(args)) for args in args_iter]
+        try:
+            return await asyncio.gather(*tasks)
+        except BaseException:
+            for task in tasks:
+                task.cancel()
+            raise
+
+    def publish(self, job, event, data=None):
+        entry = {"id": job.event_count, "event": event, "data": data}
+        job.event_count += 1
+        job.events.append(entry)
+        for listener in self._listeners.get(job.id, ()):
+            listener.put_nowait(entry)
+
+    def job_events(self, job):
+        return JobEvents(job.id)
+
+    async def iter_events(self, job, last_id=-1):
+        """Yields the events of ``job`` after ``last_id``, past ones first, until the job is done or failed."""
+        listener = asyncio.Queue()
+        self._listeners.setdefault(job.id, set()).add(listener)
+        try:
+            for entry in list(job.events):
+                if entry["id"] > last_id:
+                    last_id = entry["id"]
+                    yield entry
+                    if entry["event"] in TERMINAL_EVENTS:
+                        return
+            while True:
+                entry = await listener.get()
+                if entry["id"] <= last_id:
+                    continue
+                last_id = entry["id"]
+                yield entry
+                if entry["event"] in TERMINAL_EVENTS:
+                    return
+        finally:
+            listeners = self._listeners.get(job.id)
+            if listeners is not None:
+                listeners.discard(listener)
+                if not listeners:
+                    del self._listeners[job.id]
+
+    def _read_events(self, loop, events):
+        while True:
+            item = events.get()
+            if item is None:
+                return
+            loop.call_soon_threadsafe(self._deliver_event, *item)
+
+    def _deliver_event(self, job_id, event, data):
+        if event == FLUSH_EVENT:
+            future = self._flushes.pop(data, None)
+            if future is not None and not future.done():
+                future.set_result(None)
+            return
+        job = self.jobs.get(job_id)
+        if job is not None:
+            self.publish(job, event, data)
+
+    async def _flush_events(self):
+        # events of finished pool calls are already in the pipe, so they are delivered before the marker
+        if self._events_reader is None:
+            return
+        flush_id = next(self._flush_ids)
+        self._flushes[flush_id] = asyncio.get_running_loop().create_future()
+        self._events.put((None, FLUSH_EVENT, flush_id))
+        try:
+            await asyncio.wait_for(self._flushes[flush_id], FLUSH_TIMEOUT)
+        except TimeoutError:
+            # the reader thread is gone, late events are lost but the job still finishes
+            logging.warning(f"Worker events were not flushed within {FLUSH_TIMEOUT}s")
+            self._flushes.pop(flush_id, None)
+
+    async def _worker(self, index):
+        while True:
+            job = await self._queue.get()
+            job.status = JobStatus.RUNNING
+            job.started_at = time.time()
+            self.publish(job, "status", {"status": job.status.value})
+            try:
+                job.result = await self.handler(job, self)
+                job.status = JobStatus.DONE
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logging.exception(f"Job {job.id} failed on worker {index}")
+                job.error = str(e) or e.__class__.__name__
+                job.status = JobStatus.FAILED
+            finally:
+                job.payload = None
+                if job.input_path is not None:
+                    job.input_path.unlink(missing_ok=True)
+                    job.input_path = None
+                job.finished_at = time.time()
+                self._job_duration = 0.8 * self._job_duration + 0.2 * (job.finished_at - job.started_at)
+            await self._flush_events()
+            self.publish(job, job.status.value, {"status": job.status.value, "error": job.error})
+            job.events = [entry for entry in job.events if entry["event"] not in TRANSIENT_EVENTS]
+
+    def _evict_expired(self):
+        now = time.time()
+        expired = [
+            job_id
+            for job_id, job in self.jobs.items()
+            if job.finished and job.finished_at is not None and now - job.finished_at > self.result_ttl
+        ]
+        for job_id in expired:
+            _remove_scratch_dir(self.jobs.pop(job_id))
+
+    async def _evict_periodically(self):
+        # an idle service gets no submits, which would otherwise be the only time expired jobs are dropped
+        while True:
+            await asyncio.sleep(EVICT_INTERVAL)
+            self._evict_expired()
+
+
+def _remove_scratch_dir(job):
+    if job.scratch_dir is not None:
+        shutil.rmtree(job.scratch_dir, ignore_errors=True)
@@ -0,0 +1,91 @@
+from __future__ import annotations
+
+import logging
+import warnings
+
+from kraken import binarization, containers, rpred
+from kraken.lib.models import load_any
+
+TEXT_DIRECTION = "horizontal-lr"
+
+
+def silence_warnings():
+    warnings.filterwarnings(
+        "ignore", message="Using legacy polygon extractor, as the model was not trained with the new method."
+    )
+    logging.getLogger("kraken").setLevel(logging.ERROR)
+
+
+def baseline_line(index, seg_info):
+    """Kraken line of a segmented line, in page coordinates; lines without a polygon get a box-shaped one."""
+    x0, y0, x1, y1 = seg_info["bbox"]
+    baseline = seg_info.get("baseline")
+    boundary = seg_info.get("boundary")
+    if baseline and boundary and len(boundary) > 2:
+        # segmentator returns coordinates relative to the line crop
+        baseline = [(px + x0, py + y0) for px, py in baseline]
+        boundary = [(px + x0, py + y0) for px, py in boundary]
+    else:
+        baseline = [(x0, y1 - 1), (x1 - 1, y1 - 1)]
+        boundary = [(x0, y0), (x1 - 1, y0), (x1 - 1, y1 - 1), (x0, y1 - 1), (x0, y0)]
+    return containers.BaselineLine(id=str(seg_info.get("index", index)), baseline=baseline, boundary=boundary)
+
+
+class KrakenRecognizer:
+    """Page-level recognition shared by the kraken handlers, which only differ in their model file.
+
+    The model is loaded on first use, or up front by :meth:`load` when it is preloaded for forked workers.
+    """
+
+    def __init__(self, model_path, text_direction=TEXT_DIRECTION):
+        self.model_path = model_path
+        self.text_direction = text_direction
+        self.model = None
+
+    def load(self, model_path=None):
+        self.model = load_any(str(model_path or self.model_path), device="cpu")
+        return self.model
+
+    def get_model(self):
+        return self.model if self.model is not None else self.load()
+
+    def iter_page(self, image, lines, debug=False, frontline="", filter_warnings=False):
+        """Yields one ``{"text", "confidence"}`` per line of ``lines``, in order, as soon as it is recognized."""
+        model = self.get_model()
+
+        if debug:
+            logging.debug(frontline + f"Using model: {self.model_path.name} on {len(lines)} lines at once")
+        if filter_warnings:
+            silence_warnings()
+
+        if not lines:
+            return
+
+        bin_im = binarization.nlbin(image)
+        segmentation = containers.Segmentation(
+            type="baselines",
+            imagename="",
+            text_direction=self.text_direction,
+            script_detection=False,
+            lines=[baseline_line(i, item) for i, item in enumerate(lines)],
+            regions={},
+            line_orders=[list(range(len(lines)))],
+        )
+
+        # rpred yields the records in the order of the segmentation lines, so they are matched by position
+        count = 0
+        for rec in rpred.rpred(model, bin_im, segmentation):
+            if count >= len(lines):
+                break
+            confidences = list(rec.confidences)
+            yield {
+                "text": rec.prediction,
+                "confidence": sum(confidences) / len(confidences) if confidences else None,
+            }
+            count += 1
+
+        for _ in range(count, len(lines)):
+            yield {"text": "", "confidence": None}
+
+    def handle_page(self, image, lines, debug=False, frontline="", filter_warnings=False):
+        return list(self.iter_page(image, lines, debug=debug, frontline=frontline, filter_warnings=filter_warnings))
@@ -1,21 +1,38 @@
-import base64
+import asyncio
 import json
 import logging
 import os
+import shutil
+import time
+from contextlib import asynccontextmanager
+from typing import Annotated
 
 from dotenv import load_dotenv
-from fastapi import FastAPI, HTTPException, Request
-from pydantic import BaseModel, Field, field_validator
+from fastapi import FastAPI, HTTPException, Query, Request
+from fastapi.exceptions import RequestValidationError
+from fastapi.responses import FileResponse, JSONResponse, Response, StreamingResponse
+from pydantic import BaseModel, Field, ValidationError, field_validator
+from starlette.datastructures import UploadFile
 
 try:
-    from app.backend_client import get_format, send_file
-    from app.file_converter import convert_to_png_bytes
-    from app.ocr import get_model_list, run_ocr
+    from app.backend_client import AsyncBackendClient, invalidate_formats
+    from app.exporters import DEFAULT_OUTPUT_FORMATS, OutputFormat, media_type
+    from app.file_converter import PDF_PROFILE, PdfProfile, count_pages, estimate_page_pixels
+    from app.ingest import is_valid_base64, new_spool_dir, spool_base64, spool_fileobj, spool_stream
+    from app.jobs import JobManager, JobPriority, JobRejectedError, JobStatus
+    from app.ocr import get_model_list, ocr_page_file, preload_models, render_document, render_outputs, warm_up
+    from app.page_model import deserialize_document, serialize_document
+    from app.resources import plan_cpu_allocation
 except Exception:
     try:
-        from backend_client import get_format, send_file
-        from file_converter import convert_to_png_bytes
-        from ocr import get_model_list, run_ocr
+        from backend_client import AsyncBackendClient, invalidate_formats
+        from exporters import DEFAULT_OUTPUT_FORMATS, OutputFormat, media_type
+        from file_converter import PDF_PROFILE, PdfProfile, count_pages, estimate_page_pixels
+        from ingest import is_valid_base64, new_spool_dir, spool_base64, spool_fileobj, spool_stream
+        from jobs import JobManager, JobPriority, JobRejectedError, JobStatus
+        from ocr import get_model_list, ocr_page_file, preload_models, render_document, render_outputs, warm_up
+        from page_model import deserialize_document, serialize_document
+        from resources import plan_cpu_allocation
     except Exception as e:
         raise ImportError("Failed to import necessary modules. Ensure the package structure is correct.") from e
 
@@ -23,27 +40,38 @@ except Exception:
 load_dotenv()
 
 BACKEND_URL = None
+WARM_UP = os.getenv("OCR_WARM_UP", "1") == "1"
 
-app = FastAPI(title="OCR Service", version="1.0.5")
 
+# metadata headers of the application/octet-stream variant of /ocr/process/upload
+METADATA_HEADERS = {
+    "ownerId": "x-owner-id",
+    "formatId": "x-format-id",
+    "generation": "x-generation",
+    "primaryFileId": "x-primary-file-id",
+    "processingModelId": "x-processing-model-id",
+    "id": "x-file-id",
+}
 
-class IncomingFile(BaseModel):
+
+class FileMetadata(BaseModel):
     ownerId: int = Field(ge=1)
     formatId: int = Field(ge=1)
     generation: int = Field(ge=0)
     primaryFileId: int | None = None
     processingModelId: int | None
-    content: str
     id: int | None = None
 
+
+class IncomingFile(FileMetadata):
+    content: str
+
     @field_validator("content")
     @classmethod
     def validate_base64(cls, v):
-        try:
-            base64.b64decode(v, validate=True)
-        except Exception as e:
-            logging.error("Invalid base64 content: %s", e)
-            raise ValueError(f"Invalid base64 content: {e}") from e
+        if not is_valid_base64(v):
+            logging.error("Invalid base64 content")
+            raise ValueError("Invalid base64 content")
         return v
 
 def strip_content(data):
@@ -55,110 +83,378 @@ def strip_content(data):
         data = "[NON-JSON BODY]"
     return data
 
-def find_correct_backend_url(auth_header, format_id):
+async def find_correct_backend_url(auth_header, format_id):
     global BACKEND_URL
-    if BACKEND_URL is None :
-        try:
-            backend_base_url = os.getenv("BACKEND_BASE_URL_DOCKER")
-            get_format(backend_base_url, auth_header, format_id=format_id)
-            BACKEND_URL = backend_base_url
-        except Exception:
+    if BACKEND_URL is None:
+        for env_name in ("BACKEND_BASE_URL_DOCKER", "BACKEND_BASE_URL"):
+            backend_base_url = os.getenv(env_name)
             try:
-                backend_base_url = os.getenv("BACKEND_BASE_URL")
-                get_format(backend_base_url, auth_header, format_id=format_id)
+                await BACKEND_CLIENT.get_format(backend_base_url, auth_header, format_id=format_id)
                 BACKEND_URL = backend_base_url
+                break
             except Exception as e:
-                logging.critical("Failed to find backend URL: %s", e)
+                logging.debug("Backend URL from %s is not reachable: %s", env_name, e)
+        else:
+            logging.critical("Failed to find backend URL")
     return BACKEND_URL
 
+
+async def upload_result(backend_base_url, auth_header, payload, format_name, content_bytes):
+    out_format = await BACKEND_CLIENT.get_format(backend_base_url, auth_header, format_name=format_name)
+    if not out_format:
+        logging.critical("%s format not found in backend formats", format_name.upper())
+        raise ValueError(f"{format_name.upper()} format not found in backend formats")
+    logging.info("Sending OCR result as %s format (%s) to backend", format_name.upper(), out_format)
+
+    result = await BACKEND_CLIENT.send_file(
+        backend_url=backend_base_url,
+        auth_token=auth_header,
+        owner_id=payload.ownerId,
+        format_id=out_format["id"],
+        generation=payload.generation,
+        content_bytes=content_bytes,
+        primary_file_id=payload.id,
+    )
+    logging.info("Sent OCR result back to backend, got response: %s", strip_content(result))
+    return result
+
+
+async def process_job(job, manager):
+    payload = job.payload
+    auth_header = job.auth_header
+    formats = job.options.get("formats", DEFAULT_OUTPUT_FORMATS)
+    # the page images are only encoded when a PDF is going to show them
+    pdf_profile = job.options.get("pdfProfile", PDF_PROFILE) if OutputFormat.PDF in formats else PdfProfile.TEXT
+    input_bytes = job.input_path.stat().st_size
+
+    backend_base_url = await find_correct_backend_url(auth_header=auth_header, format_id=payload.formatId)
+    if backend_base_url is None:
+        raise RuntimeError("Backend URL could not be determined")
+
+    in_format = await BACKEND_CLIENT.get_format(backend_base_url, auth_header, format_id=payload.formatId)
+    if not in_format:
+        raise ValueError(f"Input format {payload.formatId} not found in backend formats")
+    # before the pages are recognized, the submit only checks them when the backend answers right away
+    for output_format in formats:
+        if not await BACKEND_CLIENT.get_format(backend_base_url, auth_header, format_name=output_format):
+            raise ValueError(f"{str(output_format).upper()} format not found in backend formats")
+
+    page_count = await manager.run_in_pool(count_pages, job.input_path, in_format)
+    if page_count == 0:
+        raise ValueError("Input document has no pages")
+    logging.info("Job %s has %d pages", job.id, page_count)
+    manager.publish(job, "pages", {"count": page_count})
+
+    on_event = manager.job_events(job)
+    # the workers leave the encoded page scans here, render_outputs reads them back one by one
+    image_dir = None if pdf_profile == PdfProfile.TEXT else await asyncio.to_thread(new_spool_dir, f"pages_{job.id}_")
+    try:
+        pages = await manager.map_in_pool(
+            ocr_page_file,
+            (
+                (
+                    job.input_path,
+                    in_format,
+                    index,
+                    payload.processingModelId,
+                    job.debug,
+                    1,
+                    on_event,
+                    job.scratch_dir,
+                    pdf_profile,
+                    image_dir,
+                )
+                for index in range(page_count)
+            ),
+        )
+        # kept before rendering, so a job failing later on can still be re-rendered
+        job.document = await asyncio.to_thread(serialize_document, pages)
+        logging.debug("Stored page model of job %s: %d bytes", job.id, len(job.document))
+        outputs = await manager.run_in_pool(render_outputs, pages, formats, job.debug, 1, job.scratch_dir, pdf_profile)
+    finally:
+        if image_dir is not None:
+            await asyncio.to_thread(shutil.rmtree, image_dir, ignore_errors=True)
+    sizes = {"input": input_bytes, **{output_format: len(content) for output_format, content in outputs.items()}}
+    logging.info("OCR processing completed for job %s", job.id)
+    logging.debug("OCR produced outputs: %s", sizes)
+    manager.publish(job, "output", {"pdfProfile": pdf_profile, "sizes": sizes})
+
+    async def upload(format_name, content_bytes):
+        result = await upload_result(backend_base_url, auth_header, payload, format_name, content_bytes)
+        file_id = result.get("id") if isinstance(result, dict) else None
+        manager.publish(job, "upload", {"format": format_name, "fileId": file_id})
+        return result
+
+    results = await asyncio.gather(*(upload(output_format, content) for output_format, content in outputs.items()))
+    return {**dict(zip(outputs, results, strict=True)), "pdfProfile": pdf_profile, "sizes": sizes}
+
+
+BACKEND_CLIENT = AsyncBackendClient()
+JOB_MANAGER = JobManager(
+    process_job,
+    warm_up=warm_up if WARM_UP else None,
+    preload=preload_models,
+    cpu_allocation=plan_cpu_allocation(),
+)
+
+
+@asynccontextmanager
+async def lifespan(app):
+    await JOB_MANAGER.start()
+    try:
+        yield
+    finally:
+        await JOB_MANAGER.stop()
+        await BACKEND_CLIENT.aclose()
+
+
+app = FastAPI(title="OCR Service", version="1.1.0", lifespan=lifespan)
+
+
+@app.exception_handler(JobRejectedError)
+async def job_rejected_handler(request: Request, exc: JobRejectedError):
+    logging.warning(f"Rejected OCR request: {exc}")
+    return JSONResponse(
+        status_code=429,
+        content={"detail": str(exc)},
+        headers={"Retry-After": str(exc.retry_after)},
+    )
+
+
 @app.get("/health")
 def health():
-    try:
-        _ = get_model_list()
-        return {"status": "ok"}
-    except Exception as e:
-        return {"status": "error", "detail": str(e)}
+    # still healthy while starting, so that a slow warm-up does not get the container restarted
+    state = JOB_MANAGER.state
+    return JSONResponse(
+        status_code=503 if state == "failed" else 200,
+        content={"status": state, "ready": state == "ready"},
+    )
 
-@app.post("/ocr/process")
-async def handle_file(payload: IncomingFile, request: Request):
-    
-    raw = await request.body()
 
-    logging.debug("Full request (content skipped): %s\n", strip_content(json.loads(raw)))
-    
+@app.get("/ready")
+def ready():
+    workers = sorted(JOB_MANAGER.warm_up_reports.values(), key=lambda report: report["pid"])
+    state = JOB_MANAGER.state
+    return JSONResponse(
+        status_code=200 if state == "ready" else 503,
+        content={
+            "status": state,
+            "expectedWorkers": JOB_MANAGER.workers,
+            "workers": workers,
+        },
+    )
+
+def _log_received(metadata, size_description):
     logging.debug(
-        "Received file: id=%s, ownerId=%s formatId=%s generation=%s primaryFileId=%s model_id=%s size_b64=%d",
-        payload.id,
-        payload.ownerId,
-        payload.formatId,
-        payload.generation,
-        payload.primaryFileId,
-        payload.processingModelId,
-        len(payload.content),
+        "Received file: id=%s, ownerId=%s formatId=%s generation=%s primaryFileId=%s model_id=%s %s",
+        metadata.id,
+        metadata.ownerId,
+        metadata.formatId,
+        metadata.generation,
+        metadata.primaryFileId,
+        metadata.processingModelId,
+        size_description,
     )
 
+
+def _parse_metadata(fields):
+    try:
+        return FileMetadata(**{k: v if v != "" else None for k, v in fields.items()})
+    except ValidationError as e:
+        raise RequestValidationError(e.errors()) from e
+
+
+def _estimate_size(input_path):
+    try:
+        page_count, page_pixels = estimate_page_pixels(input_path)
+    except Exception as e:
+        # unreadable inputs fail in the job itself, with the format known
+        logging.debug(f"Could not estimate the size of {input_path.name}: {e}")
+        return 1, 0
+    return page_count, JOB_MANAGER.estimate_memory(page_count, page_pixels)
+
+
+async def _check_output_formats(auth_header, formats):
+    # outputs are uploaded under the backend format of the same name, so a missing one would only fail the job
+    # after all of its pages were recognized. The submit must not wait for a slow or unreachable backend: only a
+    # backend an earlier job found is asked, once and briefly, and whatever is left open process_job checks again
+    if BACKEND_URL is None:
+        return
+    found = await BACKEND_CLIENT.find_formats_quickly(BACKEND_URL, auth_header, [str(f) for f in formats])
+    if found is None:
+        return
+    missing = [name for name, item in found.items() if not item]
+    if missing:
+        raise HTTPException(
+            status_code=422, detail=f"Output formats not registered in the backend: {', '.join(missing)}"
+        )
+
+
+async def _submit_job(metadata, input_path, request, priority, debug, pdf_profile, formats):
     auth_header = request.headers.get("authorization")
+    # duplicates dropped, requested order kept
+    formats = list(dict.fromkeys(formats))
+    try:
+        await _check_output_formats(auth_header, formats)
+        page_count, memory = await asyncio.to_thread(_estimate_size, input_path)
+        job = JOB_MANAGER.submit(
+            metadata,
+            auth_header=auth_header,
+            input_path=input_path,
+            memory=memory,
+            owner=metadata.ownerId,
+            priority=priority,
+            cost=page_count,
+            debug=debug,
+            options={"pdfProfile": pdf_profile, "formats": formats},
+        )
+    except BaseException:
+        input_path.unlink(missing_ok=True)
+        raise
+    return {"jobId": job.id, "status": job.status.value}
 
-    backend_base_url = find_correct_backend_url(
-        auth_header=auth_header,
-        format_id=payload.formatId,
-    )
 
-    in_bytes = convert_to_png_bytes(
-        base64.b64decode(payload.content, validate=True),
-        get_format(backend_base_url, auth_header, format_id=payload.formatId),
-        debug=True,
-        debug_indent=1,
-    )
+@app.post("/ocr/process", status_code=202)
+async def handle_file(
+    payload: IncomingFile,
+    request: Request,
+    priority: JobPriority = JobPriority.INTERACTIVE,
+    debug: bool = False,
+    pdf_profile: PdfProfile = PDF_PROFILE,
+    formats: Annotated[list[OutputFormat], Query()] = DEFAULT_OUTPUT_FORMATS,
+):
+    _log_received(payload, f"size_b64={len(payload.content)}")
+    JOB_MANAGER.check_admission()
+    input_path = await asyncio.to_thread(spool_base64, payload.content)
+    metadata = FileMetadata(**payload.model_dump(exclude={"content"}))
+    return await _submit_job(metadata, input_path, request, priority, debug, pdf_profile, formats)
 
-    out_pdf_bytes, out_docx_bytes = run_ocr(in_bytes, model_id=payload.processingModelId, debug=True, debug_indent=1)
-    logging.info("OCR processing completed")
-    logging.debug("OCR produced output PDF bytes: %d bytes", len(out_pdf_bytes))
-    logging.debug("OCR produced output DOCX bytes: %d bytes", len(out_docx_bytes))
 
-    out_pdf_format = get_format(backend_base_url, auth_header, format_name="pdf")
-    if not out_pdf_format:
-        logging.critical("PDF format not found in backend formats")
-        raise HTTPException(status_code=404, detail="PDF format not found in backend formats")
-    logging.info("Sending OCR result as PDF format (%s) to backend", out_pdf_format)
+@app.post("/ocr/process/upload", status_code=202)
+async def handle_upload(
+    request: Request,
+    priority: JobPriority = JobPriority.INTERACTIVE,
+    debug: bool = False,
+    pdf_profile: PdfProfile = PDF_PROFILE,
+    formats: Annotated[list[OutputFormat], Query()] = DEFAULT_OUTPUT_FORMATS,
+):
+    # reject before the upload is read when the queue is already full
+    JOB_MANAGER.check_admission()
+    content_type = request.headers.get("content-type", "")
+    if content_type.startswith("multipart/form-data"):
+        async with request.form() as form:
+            metadata = _parse_metadata({name: form.get(name) for name in FileMetadata.model_fields})
+            upload = form.get("file")
+            if not isinstance(upload, UploadFile):
+                raise HTTPException(status_code=422, detail="Missing 'file' part in multipart body")
+            input_path = await asyncio.to_thread(spool_fileobj, upload.file)
+    else:
+        metadata = _parse_metadata({name: request.headers.get(header) for name, header in METADATA_HEADERS.items()})
+        input_path = await spool_stream(request.stream())
 
-    result = send_file(
-        backend_url=backend_base_url,
-        auth_token=auth_header,
-        owner_id=payload.ownerId,
-        format_id=out_pdf_format["id"],
-        generation=payload.generation,
-        content_bytes=out_pdf_bytes,
-        primary_file_id=payload.id,
-    )
+    _log_received(metadata, f"size={input_path.stat().st_size}")
+    return await _submit_job(metadata, input_path, request, priority, debug, pdf_profile, formats)
 
-    logging.info("Sent OCR result back to backend, got response: %s", strip_content(result))
 
+def _get_job_or_404(job_id):
+    job = JOB_MANAGER.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail=f"Job {job_id} not found")
+    return job
 
-    out_docx_format = get_format(backend_base_url, auth_header, format_name="docx")
-    if not out_docx_format:
-        logging.critical("DOCX format not found in backend formats")
-        raise HTTPException(status_code=404, detail="DOCX format not found in backend formats")
-    logging.info("Sending OCR result as DOCX format (%s) to backend", out_docx_format)
 
-    result = send_file(
-        backend_url=backend_base_url,
-        auth_token=auth_header,
-        owner_id=payload.ownerId,
-        format_id=out_docx_format["id"],
-        generation=payload.generation,
-        content_bytes=out_docx_bytes,
-        primary_file_id=payload.id,
+@app.get("/ocr/jobs/{job_id}")
+def job_status(job_id: str):
+    return _get_job_or_404(job_id).info()
+
+
+@app.get("/ocr/jobs/{job_id}/events")
+async def job_events(job_id: str, request: Request):
+    job = _get_job_or_404(job_id)
+    try:
+        last_id = int(request.headers.get("last-event-id", "-1"))
+    except ValueError:
+        last_id = -1
+
+    async def stream():
+        async for entry in JOB_MANAGER.iter_events(job, last_id=last_id):
+            yield f"id: {entry['id']}\nevent: {entry['event']}\ndata: {json.dumps(entry['data'])}\n\n"
+
+    return StreamingResponse(stream(), media_type="text/event-stream", headers={"Cache-Control": "no-cache"})
+
+
+@app.get("/ocr/jobs/{job_id}/debug")
+def job_debug_artifacts(job_id: str):
+    job = _get_job_or_404(job_id)
+    if not job.debug or not job.scratch_dir.is_dir():
+        return []
+    return sorted(str(path.relative_to(job.scratch_dir)) for path in job.scratch_dir.rglob("*") if path.is_file())
+
+
+@app.get("/ocr/jobs/{job_id}/debug/{name:path}")
+def job_debug_artifact(job_id: str, name: str):
+    job = _get_job_or_404(job_id)
+    if job.debug:
+        path = (job.scratch_dir / name).resolve()
+        if path.is_file() and path.is_relative_to(job.scratch_dir.resolve()):
+            return FileResponse(path)
+    raise HTTPException(status_code=404, detail=f"Debug artifact {name} not found")
+
+
+@app.get("/ocr/jobs/{job_id}/result")
+def job_result(job_id: str):
+    job = _get_job_or_404(job_id)
+    if job.status != JobStatus.DONE:
+        raise HTTPException(status_code=409, detail=f"Job {job_id} is {job.status.value}")
+    return job.result
+
+
+def _get_document_or_409(job_id):
+    job = _get_job_or_404(job_id)
+    if job.document is None:
+        raise HTTPException(status_code=409, detail=f"Job {job_id} has no recognized pages ({job.status.value})")
+    return job
+
+
+@app.get("/ocr/jobs/{job_id}/document")
+def job_document(job_id: str):
+    return {"pages": deserialize_document(_get_document_or_409(job_id).document)}
+
+
+@app.get("/ocr/jobs/{job_id}/render/{output_format}")
+async def job_render(job_id: str, output_format: OutputFormat):
+    job = _get_document_or_409(job_id)
+    start = time.perf_counter()
+    # PyMuPDF is not thread-safe, so the rendering runs in an OCR worker like the one of the job itself
+    outputs = await JOB_MANAGER.run_in_pool(render_document, job.document, [output_format])
+    duration_ms = (time.perf_counter() - start) * 1000
+    content = outputs[output_format]
+    content_type, extension = media_type(output_format, content)
+    return Response(
+        content,
+        media_type=content_type,
+        headers={
+            "Content-Disposition": f'attachment; filename="{job.id}.{extension}"',
+            "Server-Timing": f"render;dur={duration_ms:.1f}",
+        },
     )
-    logging.info("Sent OCR result back to backend, got response: %s", strip_content(result))
 
-    return result
+
+@app.get("/ocr/queue")
+def queue_metrics():
+    return JOB_MANAGER.queue_metrics()
+
+
+@app.delete("/ocr/formats/cache")
+def invalidate_formats_cache():
+    invalidate_formats()
+    return {"status": "invalidated"}
 
 
 @app.get("/ocr/available_models")
 def available_models():
     try:
-        return [{k: v for k, v in model.items() if k != "handle"} for model in get_model_list()]
+        return [{k: model[k] for k in ("name", "id", "description")} for model in get_model_list()]
     except Exception as e:
         logging.critical("Error listing available models: %s", e)
         raise HTTPException(status_code=500, detail="Failed to list available models") from e
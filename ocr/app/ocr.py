@@ -1,21 +1,71 @@
 from __future__ import annotations
 
-import io
 import logging
+import os
+import time
 from pathlib import Path
 
-from PIL import Image
+import fitz
+from PIL import Image, ImageDraw
 
 try:
-    from app.file_converter import initialize_pdf_with_image, insert_text_at_bbox, pdf_to_bytes, pdf_to_docx_bytes
+    from app.disk_cache import DiskLRUCache, file_sha256, image_sha256, make_key
+    from app.exporters import DEFAULT_OUTPUT_FORMATS, EXPORTERS, OutputFormat, pages_to_text
+    from app.file_converter import (
+        PdfProfile,
+        add_page,
+        as_pil_image,
+        encode_page_image,
+        insert_lines,
+        load_page_image,
+        pdf_to_bytes,
+    )
     from app.module_loading import load_module_from_path
-    from app.segmentator import debug_save, segment
+    from app.page_model import deserialize_document
+    from app.preprocessing import (
+        INVERT_THRESHOLD,
+        TARGET_DPI,
+        TRIM_MARGINS,
+        TRIM_PADDING,
+        dark_ratio,
+        invert_image,
+        preprocess_page,
+        to_page_coordinates,
+    )
+    from app.segmentator import MODEL_PATH as SEG_MODEL_PATH
+    from app.segmentator import SEG_WORKING_SIZE, debug_save, segment
+    from app.segmentator import preload as preload_segmentation
+    from app.segmentator import warm_up as warm_up_segmentation
     from app.utils import get_frontline
 except Exception:
     try:
-        from file_converter import initialize_pdf_with_image, insert_text_at_bbox, pdf_to_bytes, pdf_to_docx_bytes
+        from disk_cache import DiskLRUCache, file_sha256, image_sha256, make_key
+        from exporters import DEFAULT_OUTPUT_FORMATS, EXPORTERS, OutputFormat, pages_to_text
+        from file_converter import (
+            PdfProfile,
+            add_page,
+            as_pil_image,
+            encode_page_image,
+            insert_lines,
+            load_page_image,
+            pdf_to_bytes,
+        )
         from module_loading import load_module_from_path
-        from segmentator import debug_save, segment
+        from page_model import deserialize_document
+        from preprocessing import (
+            INVERT_THRESHOLD,
+            TARGET_DPI,
+            TRIM_MARGINS,
+            TRIM_PADDING,
+            dark_ratio,
+            invert_image,
+            preprocess_page,
+            to_page_coordinates,
+        )
+        from segmentator import MODEL_PATH as SEG_MODEL_PATH
+        from segmentator import SEG_WORKING_SIZE, debug_save, segment
+        from segmentator import preload as preload_segmentation
+        from segmentator import warm_up as warm_up_segmentation
         from utils import get_frontline
     except Exception as e:
         raise ImportError("Failed to import necessary modules. Ensure the package structure is correct.") from e
@@ -23,12 +73,21 @@ except Exception:
 logging.getLogger("kraken").setLevel(logging.ERROR)
 logging.getLogger("kraken").propagate = False
 
-logging.getLogger("pdfminer").setLevel(logging.ERROR)
-logging.getLogger("pdfminer").propagate = False
 
 MODEL_LIST = None
 OUT_DIR = Path(__file__).resolve().parent / ".." / "temp"
-INVERT_THRESHOLD = 0.3
+WARM_UP_LINE_WIDTH = 256
+WARM_UP_LINE_HEIGHT = 48
+WARM_UP_TEXT = "Warm-up 0123"
+# recognition code shared by the kraken handlers, hashed into the result cache key with the handler file
+KRAKEN_HANDLER_PATH = Path(__file__).resolve().parent / "kraken_handler.py"
+
+# bump when a change of the recognition pipeline makes the cached results stale
+RESULT_CACHE_VERSION = 4
+RESULT_CACHE = DiskLRUCache(
+    os.getenv("OCR_RESULT_CACHE_DIR", OUT_DIR / "cache" / "results"),
+    max_bytes=int(float(os.getenv("OCR_RESULT_CACHE_MAX_MB", "512")) * 1024 * 1024),
+)
 
 
 def get_model_list():
@@ -48,6 +107,8 @@ def get_model_list():
         name = getattr(module, "NAME", handler_file.stem)
         desc = module.DESCRIPTION
         handle_func = module.handle
+        handle_page_func = getattr(module, "handle_page", None)
+        iter_page_func = getattr(module, "iter_page", None)
 
         models.append(
             {
@@ -55,14 +116,20 @@ def get_model_list():
                 "id": count,
                 "description": desc,
                 "handle": handle_func,
+                "handle_page": handle_page_func,
+                "iter_page": iter_page_func,
+                "load": getattr(module, "load", None),
+                "path": handler_file,
+                "model_path": getattr(module, "MODEL_PATH", None),
             }
         )
         count += 1
     logging.info(f"Total OCR model handlers loaded: {len(models)}")
+    MODEL_LIST = models
     return models
 
 
-def get_model_handler(id, debug=False, debug_indent=0):
+def get_model(id, debug=False, debug_indent=0):
     global MODEL_LIST
     if debug:
         logging.debug(get_frontline(debug_indent) + f"Retrieving handler for model ID: {id}")
@@ -72,67 +139,181 @@ def get_model_handler(id, debug=False, debug_indent=0):
         MODEL_LIST = get_model_list()
         if debug:
             logging.debug(get_frontline(debug_indent) + f"Loaded {len(MODEL_LIST)} models.")
-    default_handler = None
+    default_model = None
     for model in MODEL_LIST:
         if model["id"] == id:
             if debug:
                 logging.debug(get_frontline(debug_indent) + f"Found handler for model ID: {id}")
-            return model["handle"]
+            return model
         if model["id"] == 1:
-            default_handler = model["handle"]
+            default_model = model
     if debug:
         logging.debug(get_frontline(debug_indent) + f"Model ID: {id} not found, using default model ID: 1")
-    return default_handler
+    return default_model
 
 
-def run_ocr(png_bytes, model_id, image_visibility=False, one_liner=False, debug=False, debug_indent=0):
-    if debug:
-        logging.debug(get_frontline(debug_indent) + f"Starting OCR with model ID: {model_id}")
-    im = Image.open(io.BytesIO(png_bytes))
+def get_model_handler(id, debug=False, debug_indent=0):
+    model = get_model(id, debug=debug, debug_indent=debug_indent)
+    return model["handle"] if model is not None else None
+
+
+def _timed(label, fn, *args):
+    start = time.perf_counter()
+    try:
+        fn(*args)
+    except Exception as e:
+        logging.exception(f"Warm-up of {label} failed")
+        return {"loaded": False, "seconds": round(time.perf_counter() - start, 3), "error": str(e)}
+    return {"loaded": True, "seconds": round(time.perf_counter() - start, 3), "error": None}
+
+
+def _warm_up_model(model):
+    # the handlers load their model on first use, unless it was preloaded before the worker was forked
+    # with some ink on it, kraken refuses to binarize a blank image
+    im = Image.new("RGB", (WARM_UP_LINE_WIDTH, WARM_UP_LINE_HEIGHT), "white")
+    ImageDraw.Draw(im).text((8, 8), WARM_UP_TEXT, fill="black", font_size=WARM_UP_LINE_HEIGHT // 2)
+    line = {"index": 0, "bbox": (0, 0, im.width, im.height), "baseline": None, "boundary": None}
+    if model["iter_page"] is not None:
+        list(model["iter_page"](im, [line]))
+    elif model["handle_page"] is not None:
+        model["handle_page"](im, [line])
+    else:
+        model["handle"](im, line)
+
+
+def warm_up():
+    """Loads the segmentation model and every recognizer and runs one dummy inference through each.
+
+    Failures are reported in the returned load state instead of raised, so a broken model does not take
+    the worker down with it.
+    """
+    report = {"segmentation": _timed("segmentation model", warm_up_segmentation), "models": []}
+    try:
+        models = get_model_list()
+    except Exception as e:
+        logging.exception("Loading the OCR model list failed")
+        report["error"] = str(e)
+        return report
+    for model in models:
+        state = _timed(model["name"], _warm_up_model, model)
+        report["models"].append({"id": model["id"], "name": model["name"], **state})
+    return report
+
+
+def _share_memory(model):
+    # kraken wraps the torch module (TorchSeqRecognizer -> TorchVGSLModel -> nn.Module)
+    while model is not None and not hasattr(model, "share_memory"):
+        model = getattr(model, "nn", None)
+    if model is not None:
+        model.share_memory()
+
+
+def preload_models():
+    """Loads the segmentation model and every recognizer into shared memory in the current process.
+
+    Called in the master before the workers are forked; the workers inherit the loaded models and share
+    their weights instead of each loading a copy.
+    """
+    preload_segmentation()
+    for model in get_model_list():
+        if model["load"] is None:
+            continue
+        try:
+            _share_memory(model["load"]())
+        except Exception:
+            logging.exception(f"Preloading {model['name']} failed, it will be loaded by the workers")
 
-    histogram = im.convert("L").histogram()
-    dark_ratio = sum(histogram[:128]) / sum(histogram)
 
-    if dark_ratio > INVERT_THRESHOLD:
+def invert_if_dark(im, debug=False, debug_indent=0):
+    ratio = dark_ratio(im.convert("L").histogram())
+
+    if ratio > INVERT_THRESHOLD:
         if debug:
-            logging.debug(get_frontline(debug_indent) + f"Inverting image (dark ratio: {dark_ratio:.2f})")
-        im = Image.eval(im, lambda x: 255 - x)
+            logging.debug(get_frontline(debug_indent) + f"Inverting image (dark ratio: {ratio:.2f})")
+        im = invert_image(im)
+    return im
+
+
+def _page_baseline(item):
+    # segmentation baselines are relative to the line crop
+    if not item.get("baseline"):
+        return None
+    x0, y0 = item["bbox"][:2]
+    return [[int(x + x0), int(y + y0)] for x, y in item["baseline"]]
 
-    if debug:
-        OUT_DIR.mkdir(parents=True, exist_ok=True)
-        (OUT_DIR / "debug_input.png").write_bytes(png_bytes)
 
+def iter_recognize_lines(im, model_id, one_liner=False, debug=False, debug_indent=0, debug_dir=None):
+    """Recognizes a page step by step, for progress reporting.
+
+    Yields ``("segmentation", {"lines": count})`` and then
+    ``("line", {"index", "text", "bbox", "baseline", "confidence"})`` for every line as soon as it is recognized,
+    with the baseline in page coordinates. With ``debug_dir`` the segmentation overlay is saved there.
+    """
     if not one_liner:
-        lines = segment(im, debug=debug, frontline=get_frontline(debug_indent + 1))
+        lines = segment(im, debug=debug, frontline=get_frontline(debug_indent + 1), return_mode=None)
+        if debug_dir is not None:
+            debug_save(im, lines, save_dir=Path(debug_dir), frontline=get_frontline(debug_indent + 2))
         if debug:
-            debug_save(im, lines, save_dir=OUT_DIR, frontline=get_frontline(debug_indent + 2))
             logging.debug(get_frontline(debug_indent + 1) + "Segmentation finished")
     else:
         lines = [{"bbox": (0, 0, im.width, im.height)}]
 
-    ocr_handler = get_model_handler(model_id, debug=debug, debug_indent=debug_indent + 1)
-    lines_data: list[str] = []
-
-    pdf_path = OUT_DIR / "ocr_overlay.pdf"
-    if debug:
-        logging.debug(
-            get_frontline(debug_indent) + f"Initializing PDF document with image visibility set to: {image_visibility}"
-        )
-    pdf_doc = initialize_pdf_with_image(im, visible_image=image_visibility)
-    if debug:
-        logging.debug(get_frontline(debug_indent) + "PDF document initialized")
+    yield "segmentation", {"lines": len(lines)}
 
-    for item in lines:
-        x0, y0, x1, y1 = item["bbox"]
-        line_im = im.crop((x0, y0, x1, y1))
+    model = get_model(model_id, debug=debug, debug_indent=debug_indent + 1)
 
+    if model["iter_page"] is not None or model["handle_page"] is not None:
         if debug:
-            logging.debug(get_frontline(debug_indent) + f"Running OCR on line with bbox: {item['bbox']}")
-        line_txt = ocr_handler(line_im, item, debug=debug, frontline=get_frontline(debug_indent + 1))
-        if debug:
-            logging.debug(get_frontline(debug_indent) + "OCR result: " + line_txt)
+            logging.debug(get_frontline(debug_indent) + f"Running page-level OCR on {len(lines)} lines")
+        page_func = model["iter_page"] or model["handle_page"]
+        recognized = page_func(im, lines, debug=debug, frontline=get_frontline(debug_indent + 1))
+        for index, (item, rec) in enumerate(zip(lines, recognized, strict=True)):
+            if debug:
+                logging.debug(get_frontline(debug_indent) + "OCR result: " + rec["text"])
+            yield "line", {
+                "index": index,
+                "text": rec["text"],
+                "bbox": item["bbox"],
+                "baseline": _page_baseline(item),
+                "confidence": rec["confidence"],
+            }
+    else:
+        for index, item in enumerate(lines):
+            x0, y0, x1, y1 = item["bbox"]
+            line_im = im.crop((x0, y0, x1, y1))
+
+            if debug:
+                logging.debug(get_frontline(debug_indent) + f"Running OCR on line with bbox: {item['bbox']}")
+            line_txt = model["handle"](line_im, item, debug=debug, frontline=get_frontline(debug_indent + 1))
+            if debug:
+                logging.debug(get_frontline(debug_indent) + "OCR result: " + line_txt)
+
+            yield "line", {
+                "index": index,
+                "text": line_txt,
+                "bbox": item["bbox"],
+                "baseline": _page_baseline(item),
+                "confidence": None,
+            }
+
+
+def _line_result(data):
+    return {key: data[key] for key in ("text", "bbox", "baseline", "confidence")}
+
 
-        lines_data.append({"text": line_txt, "bbox": item["bbox"]})
+def _collect_lines(events, on_event=None):
+    lines_data = []
+    for event, data in events:
+        if on_event is not None:
+            on_event(event, data)
+        if event == "line":
+            lines_data.append(_line_result(data))
+    return lines_data
+
+
+def recognize_lines(im, model_id, one_liner=False, debug=False, debug_indent=0, debug_dir=None):
+    events = iter_recognize_lines(im, model_id, one_liner, debug=debug, debug_indent=debug_indent, debug_dir=debug_dir)
+    lines_data = _collect_lines(events)
 
     # optional sorting for better context for postprocessing - TODO, maybe
     # lines_data.sort(key=lambda x: (x["bbox"][1], x["bbox"][0]))
@@ -140,23 +321,257 @@ def run_ocr(png_bytes, model_id, image_visibility=False, one_liner=False, debug=
     # implement postprocessing later - TODO
     # lines_data = postprocess(lines_data)
 
-    for item in lines_data:
-        insert_text_at_bbox(pdf_doc, item["text"], item["bbox"], visible_image=image_visibility)
+    return lines_data
+
+
+def result_cache_key(im, model, one_liner=False):
+    return make_key(
+        RESULT_CACHE_VERSION,
+        image_sha256(im),
+        model["id"],
+        model["name"],
+        file_sha256(model["path"]),
+        file_sha256(model["model_path"]),
+        file_sha256(KRAKEN_HANDLER_PATH),
+        file_sha256(SEG_MODEL_PATH),
+        # the lines are recognized on the segmentation found at this resolution
+        SEG_WORKING_SIZE,
+        one_liner,
+        # preprocessing settings, the source resolution decides about the downscaling
+        TRIM_MARGINS,
+        TRIM_PADDING,
+        TARGET_DPI,
+        im.info.get("dpi"),
+    )
+
+
+def iter_recognize_page(im, model_id, one_liner=False, debug=False, debug_indent=0, debug_dir=None):
+    """Same events as :func:`iter_recognize_lines`, replayed from the result cache for a known page.
+
+    A page that is recognized runs through :func:`preprocess_page` first, reported as a ``("preprocessing", report)``
+    event; its lines are mapped back to the coordinates of ``im``.
+    """
+    # results are cached by the decoded page content and the exact models that produced them
+    key = None
+    if RESULT_CACHE.enabled:
+        key = result_cache_key(im, get_model(model_id), one_liner=one_liner)
+    # a debug run always segments, so that its overlay is written
+    if key is not None and debug_dir is None:
+        cached = RESULT_CACHE.get(key)
+        if cached is not None:
+            if debug:
+                logging.debug(get_frontline(debug_indent) + f"Using cached OCR result {key[:12]}")
+            yield "segmentation", {"lines": len(cached["lines"])}
+            for index, item in enumerate(cached["lines"]):
+                yield "line", {"index": index, **item}
+            return
+
+    im, report = preprocess_page(im, debug=debug, debug_indent=debug_indent)
+    yield "preprocessing", report
+    lines_data = []
+    events = iter_recognize_lines(
+        im, model_id, one_liner=one_liner, debug=debug, debug_indent=debug_indent, debug_dir=debug_dir
+    )
+    for event, data in events:
+        if event == "line":
+            data = to_page_coordinates(data, report)
+            lines_data.append(_line_result(data))
+        yield event, data
+
+    if key is not None:
+        RESULT_CACHE.put(key, {"lines": lines_data})
 
+
+def recognize_page(im, model_id, one_liner=False, debug=False, debug_indent=0, on_event=None, debug_dir=None):
+    events = iter_recognize_page(
+        im, model_id, one_liner=one_liner, debug=debug, debug_indent=debug_indent, debug_dir=debug_dir
+    )
+    return _collect_lines(events, on_event)
+
+
+def _model_info(model_id):
+    # the model that actually ran, unknown ids fall back to the default one
+    model = get_model(model_id)
+    return None if model is None else {"id": model["id"], "name": model["name"]}
+
+
+def recognize_image(image, model_id, one_liner=False, debug=False, debug_indent=0, on_event=None, debug_dir=None):
+    """Structured OCR result of a single image, without rendering anything.
+
+    Returns the page model ``{"index", "width", "height", "model", "lines"}`` with
+    ``{"text", "bbox", "baseline", "confidence"}`` lines, as taken by :func:`render_outputs` and the exporters.
+    """
     if debug:
-        pdf_doc.save(pdf_path)
-        logging.debug(get_frontline(debug_indent) + f"Saved OCR overlay PDF to: {pdf_path}")
+        logging.debug(get_frontline(debug_indent) + f"Starting OCR with model ID: {model_id}")
+    im = as_pil_image(image)
+
+    if debug_dir is not None:
+        debug_dir = Path(debug_dir)
+        debug_dir.mkdir(parents=True, exist_ok=True)
+        im.save(debug_dir / "debug_input.png")
+
+    lines_data = recognize_page(
+        im,
+        model_id,
+        one_liner=one_liner,
+        debug=debug,
+        debug_indent=debug_indent,
+        on_event=on_event,
+        debug_dir=debug_dir,
+    )
+    return {"index": 0, "width": im.width, "height": im.height, "model": _model_info(model_id), "lines": lines_data}
+
+
+def ocr_png_bytes(image_bytes, model_id=1, one_liner=False):
+    """Recognized text of an encoded image, in reading order."""
+    return pages_to_text([recognize_image(image_bytes, model_id, one_liner=one_liner)]).decode()
+
+
+def run_ocr(
+    image,
+    model_id,
+    image_visibility=False,
+    one_liner=False,
+    debug=False,
+    debug_indent=0,
+    on_event=None,
+    debug_dir=None,
+    pdf_profile=None,
+    formats=DEFAULT_OUTPUT_FORMATS,
+):
+    """OCR of a single image into ``{format: bytes}`` for the requested output ``formats``.
+
+    Debug artifacts (input image, segmentation overlay, output PDF) are only written when ``debug_dir`` is given.
+    The visible image is encoded per ``pdf_profile``, lossless by default.
+    """
+    page = recognize_image(image, model_id, one_liner, debug, debug_indent, on_event, debug_dir)
+    pdf_profile = PdfProfile(pdf_profile or (PdfProfile.LOSSLESS if image_visibility else PdfProfile.TEXT))
+    page["image"] = None
+    if image_visibility and OutputFormat.PDF in formats:
+        page["image"] = encode_page_image(invert_if_dark(as_pil_image(image)), pdf_profile)
+    return render_outputs([page], formats, debug, debug_indent, debug_dir, pdf_profile)
+
+
+# Multi-page documents: the job splits the input into pages, every page runs through ocr_page_file
+# in one of the OCR worker processes (see app/jobs.py), and render_outputs assembles the outputs.
+
+
+def ocr_page_file(
+    input_path,
+    input_format,
+    page_index,
+    model_id,
+    debug=False,
+    debug_indent=0,
+    on_event=None,
+    debug_dir=None,
+    pdf_profile=PdfProfile.TEXT,
+    image_dir=None,
+):
+    """OCR of one page of the input file. Profiles that show the page scan get it back already encoded,
+    under ``"image"``, so the encoding runs in the worker and only the compressed stream is passed around.
+    With ``image_dir`` the stream is written there instead and ``"image_path"`` is returned, so the pages of a
+    document do not pile up in the process collecting them.
+    """
+    if debug:
+        logging.debug(get_frontline(debug_indent) + f"Starting OCR of page {page_index} with model ID: {model_id}")
+    im = load_page_image(Path(input_path), input_format, page_index=page_index, debug=debug, debug_indent=debug_indent)
+
+    if debug_dir is not None:
+        debug_dir = Path(debug_dir) / f"page_{page_index + 1:04d}"
+        debug_dir.mkdir(parents=True, exist_ok=True)
+        im.save(debug_dir / "debug_input.png")
+
+    lines = recognize_page(
+        im,
+        model_id,
+        debug=debug,
+        debug_indent=debug_indent,
+        on_event=None if on_event is None else lambda event, data: on_event(event, {"page": page_index, **data}),
+        debug_dir=debug_dir,
+    )
+    image = image_path = None
+    if pdf_profile != PdfProfile.TEXT:
+        image = encode_page_image(invert_if_dark(im), pdf_profile)
+        if image_dir is not None:
+            image_path = Path(image_dir) / f"page_{page_index + 1:04d}"
+            image_path.write_bytes(image)
+            image = None
+    return {
+        "index": page_index,
+        "width": im.width,
+        "height": im.height,
+        "model": _model_info(model_id),
+        "lines": lines,
+        "image": image,
+        "image_path": image_path,
+    }
+
+
+def _page_image(page):
+    # read one page at a time, the PDF keeps its own copy
+    if page.get("image_path") is not None:
+        return Path(page["image_path"]).read_bytes()
+    return page.get("image")
+
+
+def render_pdf(pages, debug=False, debug_indent=0, debug_dir=None, pdf_profile=PdfProfile.TEXT):
+    pdf_doc = fitz.open()
+    for page_index, page in enumerate(pages):
+        add_page(pdf_doc, page["width"], page["height"], _page_image(page))
+        insert_lines(pdf_doc, page["lines"], page_index=page_index)
+    if debug:
+        logging.debug(get_frontline(debug_indent) + f"Rendered {pdf_doc.page_count} pages")
+    if debug_dir is not None:
+        Path(debug_dir).mkdir(parents=True, exist_ok=True)
+        pdf_doc.save(Path(debug_dir) / "ocr_overlay.pdf")
+    return pdf_to_bytes(pdf_doc, pdf_profile)
+
+
+def render_outputs(
+    pages,
+    formats=DEFAULT_OUTPUT_FORMATS,
+    debug=False,
+    debug_indent=0,
+    debug_dir=None,
+    pdf_profile=PdfProfile.TEXT,
+):
+    """Builds only the requested output ``formats`` of the recognized pages, as ``{format: bytes}``.
+
+    Everything but the PDF is exported straight from the lines, without rendering.
+    """
+    pages = sorted(pages, key=lambda p: p["index"])
+    outputs = {}
+    for output_format in map(OutputFormat, formats):
+        if output_format == OutputFormat.PDF:
+            outputs[output_format] = render_pdf(pages, debug, debug_indent, debug_dir, pdf_profile)
+        else:
+            outputs[output_format] = EXPORTERS[output_format](pages)
+    logging.info(
+        f"Rendered {len(pages)} pages: "
+        + ", ".join(f"{output_format} {len(content)} bytes" for output_format, content in outputs.items())
+        + (f" (PDF profile '{pdf_profile}')" if OutputFormat.PDF in outputs else "")
+    )
+    return outputs
+
 
-    pdf_bytes = pdf_to_bytes(pdf_doc)
-    docx_bytes = pdf_to_docx_bytes(pdf_doc)
-    return pdf_bytes, docx_bytes
+def render_document(document, formats=DEFAULT_OUTPUT_FORMATS):
+    """:func:`render_outputs` of a serialized page model (see :mod:`page_model`), for the OCR worker pool."""
+    return render_outputs(deserialize_document(document), formats)
 
 
 def test_ocr(test_image_path, model_id=1, one_liner=False, debug=True, debug_indent=0):
     if debug:
         logging.debug(get_frontline(debug_indent) + f"Testing OCR on image: {test_image_path}")
-    png_bytes = test_image_path.read_bytes()
-    run_ocr(png_bytes, model_id=model_id, one_liner=one_liner, debug=debug, debug_indent=debug_indent + 1)
+    im = Image.open(test_image_path)
+    run_ocr(
+        im,
+        model_id=model_id,
+        one_liner=one_liner,
+        debug=debug,
+        debug_indent=debug_indent + 1,
+        debug_dir=OUT_DIR if debug else None,
+    )
 
 
 if __name__ == "__main__":
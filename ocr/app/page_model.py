@@ -0,0 +1,44 @@
+"""Compact serialized form of the recognized pages, kept with a job so its outputs can be re-rendered
+without running the OCR again.
+
+A document is gzip-compressed JSON. Lines are stored as ``[text, bbox, baseline, confidence]`` arrays instead
+of dicts, which roughly halves the size before compression. Page images are not stored.
+"""
+
+from __future__ import annotations
+
+import gzip
+import json
+
+# bump on incompatible changes of the layout below
+DOCUMENT_VERSION = 1
+LINE_FIELDS = ("text", "bbox", "baseline", "confidence")
+
+
+def serialize_document(pages):
+    """``pages`` as returned by ``ocr_page_file``, in any order, to the compressed document bytes."""
+    document = {
+        "version": DOCUMENT_VERSION,
+        "pages": [
+            {
+                "index": page["index"],
+                "width": page["width"],
+                "height": page["height"],
+                "model": page.get("model"),
+                "lines": [[line.get(key) for key in LINE_FIELDS] for line in page["lines"]],
+            }
+            for page in sorted(pages, key=lambda p: p["index"])
+        ],
+    }
+    return gzip.compress(json.dumps(document, ensure_ascii=False, separators=(",", ":")).encode(), compresslevel=6)
+
+
+def deserialize_document(data):
+    """The pages of a serialized document, in the page model the exporters and ``render_outputs`` take."""
+    document = json.loads(gzip.decompress(data))
+    if document.get("version") != DOCUMENT_VERSION:
+        raise ValueError(f"Unsupported page model version {document.get('version')}")
+    return [
+        {**page, "lines": [dict(zip(LINE_FIELDS, line, strict=True)) for line in page["lines"]]}
+        for page in document["pages"]
+    ]
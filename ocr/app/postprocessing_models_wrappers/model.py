@@ -2,13 +2,21 @@ from abc import ABC, abstractmethod
 
 from llama_cpp import Llama
 
+try:
+    from app.resources import postprocess_threads
+except Exception:
+    try:
+        from resources import postprocess_threads
+    except Exception as e:
+        raise ImportError("Failed to import necessary modules. Ensure the package structure is correct.") from e
+
 
 class Model(ABC):
-    def __init__(self, filename, n_gpu_layers):
+    def __init__(self, filename, n_gpu_layers, n_threads=None):
         self.llm = Llama(
             model_path=str("models" / "postprocessing_models" / filename),
             n_ctx=4096 * 2,
-            n_threads=32,
+            n_threads=n_threads or postprocess_threads(),
             n_gpu_layers=n_gpu_layers,
             n_batch=512,
             use_mmap=True,
@@ -0,0 +1,121 @@
+from __future__ import annotations
+
+import logging
+import os
+from dataclasses import dataclass, field
+
+try:
+    from app.jobs import OCR_WORKERS
+except Exception:
+    try:
+        from jobs import OCR_WORKERS
+    except Exception as e:
+        raise ImportError("Failed to import necessary modules. Ensure the package structure is correct.") from e
+
+CPU_CORES = int(os.getenv("OCR_CPU_CORES", "0"))
+POSTPROCESS_CORES = int(os.getenv("OCR_POSTPROCESS_CORES", "0"))
+TORCH_INTEROP_THREADS = int(os.getenv("OCR_TORCH_INTEROP_THREADS", "1"))
+CPU_AFFINITY = os.getenv("OCR_CPU_AFFINITY", "0") == "1"
+
+
+def available_cores():
+    if hasattr(os, "sched_getaffinity"):
+        return sorted(os.sched_getaffinity(0))
+    return list(range(os.cpu_count() or 1))
+
+
+@dataclass(frozen=True)
+class CpuAllocation:
+    """Split of the node's cores between the OCR workers and the postprocessor.
+
+    Segmentation and recognition of a page run one after the other in the same worker, so both stages use
+    the worker's ``torch_threads``. ``worker_cores`` are only applied as CPU affinity when ``pin`` is set.
+    """
+
+    workers: int
+    torch_threads: int
+    interop_threads: int
+    postprocess_threads: int
+    worker_cores: list[list[int]] = field(default_factory=list)
+    postprocess_cores: list[int] = field(default_factory=list)
+    pin: bool = False
+
+    def describe(self):
+        text = (
+            f"{self.workers} OCR workers x {self.torch_threads} torch threads "
+            f"(+{self.interop_threads} inter-op), postprocessor {self.postprocess_threads} threads"
+        )
+        if self.pin:
+            text += f", worker cores {self.worker_cores}, postprocessor cores {self.postprocess_cores}"
+        return text
+
+    def apply_to_worker(self, index):
+        """Configures torch threads (and the CPU affinity, if pinning is enabled) of OCR worker ``index``.
+
+        Returns the effective settings, which can differ from the plan, e.g. when torch was already initialized.
+        """
+        import torch
+
+        torch.set_num_threads(self.torch_threads)
+        try:
+            torch.set_num_interop_threads(self.interop_threads)
+        except RuntimeError:
+            # only possible before the first parallel work, e.g. not in a worker forked after preloading
+            pass
+        if self.pin and hasattr(os, "sched_setaffinity"):
+            os.sched_setaffinity(0, self.worker_cores[index % len(self.worker_cores)])
+        effective = {
+            "index": index,
+            "threads": torch.get_num_threads(),
+            "interopThreads": torch.get_num_interop_threads(),
+            "cores": current_cores(),
+        }
+        logging.info(f"OCR worker {index}: {effective['threads']} torch threads, cores {effective['cores']}")
+        return effective
+
+
+def plan_cpu_allocation(
+    workers=OCR_WORKERS,
+    cores=None,
+    max_cores=CPU_CORES,
+    postprocess_cores=POSTPROCESS_CORES,
+    interop_threads=TORCH_INTEROP_THREADS,
+    pin=CPU_AFFINITY,
+):
+    cores = list(cores if cores is not None else available_cores())
+    if max_cores > 0:
+        cores = cores[:max_cores]
+    workers = max(1, workers)
+
+    # the postprocessor gets the last cores, but never all of them
+    reserved = min(max(0, postprocess_cores), len(cores) - 1)
+    post = cores[len(cores) - reserved :] if reserved else []
+    ocr = cores[: len(cores) - reserved]
+
+    per_worker = max(1, len(ocr) // workers)
+    if per_worker * workers <= len(ocr):
+        worker_cores = [ocr[i * per_worker : (i + 1) * per_worker] for i in range(workers)]
+    else:
+        # more workers than cores, they have to share
+        worker_cores = [[ocr[i % len(ocr)]] for i in range(workers)]
+
+    return CpuAllocation(
+        workers=workers,
+        torch_threads=per_worker,
+        interop_threads=max(1, interop_threads),
+        # without reserved cores the postprocessor runs in the slot of an OCR worker
+        postprocess_threads=len(post) or per_worker,
+        worker_cores=worker_cores,
+        postprocess_cores=post,
+        pin=pin,
+    )
+
+
+def current_cores():
+    if hasattr(os, "sched_getaffinity"):
+        return sorted(os.sched_getaffinity(0))
+    return available_cores()
+
+
+def postprocess_threads():
+    return plan_cpu_allocation().postprocess_threads
@@ -1,14 +1,25 @@
 from __future__ import annotations
 
 import logging
+import os
 from io import BytesIO
 from pathlib import Path
+from types import SimpleNamespace
 
 import numpy as np
 import torch
 from kraken import blla
 from kraken.lib import vgsl
-from PIL import Image
+from PIL import Image, ImageDraw
+
+try:
+    from app.disk_cache import DiskLRUCache, file_sha256, image_sha256, make_key
+except Exception:
+    try:
+        from disk_cache import DiskLRUCache, file_sha256, image_sha256, make_key
+    except Exception:
+        # loaded on its own by the model_training scripts, which segment without the cache
+        DiskLRUCache = None
 
 SCRIPT_DIR = Path(__file__).resolve().parent
 MODEL_PATH = SCRIPT_DIR / ".." / "models" / "seg_best_submitted.mlmodel"
@@ -19,6 +30,19 @@ TEXT_DIRECTION = "horizontal-lr"
 PAD = 2
 SAVE_DIR = SCRIPT_DIR / ".." / "temp" / "seg_lines"
 BBOX_LINE_WIDTH = 5
+WARM_UP_SIZE = 256
+# longer page side blla runs at, 0 segments at full resolution. The network sees the page scaled to its input
+# height anyway (900 px for our model), so this mostly saves the polygonization of the lines on huge scans
+SEG_WORKING_SIZE = int(os.getenv("OCR_SEG_WORKING_SIZE", "0"))
+
+# segmentation does not depend on the recognition model, so one entry serves every handler
+SEG_CACHE_VERSION = 2
+SEG_CACHE = None
+if DiskLRUCache is not None:
+    SEG_CACHE = DiskLRUCache(
+        os.getenv("OCR_SEG_CACHE_DIR", SCRIPT_DIR / ".." / "temp" / "cache" / "segmentation"),
+        max_bytes=int(float(os.getenv("OCR_SEG_CACHE_MAX_MB", "256")) * 1024 * 1024),
+    )
 
 
 def silence_segmentation_logs():
@@ -39,6 +63,12 @@ def _ensure_pil_image(img):
     raise TypeError("img must be a PIL.Image.Image or bytes")
 
 
+def _ensure_rgb(img):
+    # convert() copies even when the mode already matches
+    im = _ensure_pil_image(img)
+    return im if im.mode == "RGB" else im.convert("RGB")
+
+
 def _load_seg_model(device, seg_model_path=MODEL_PATH):
     global _SEG_MODEL
     if device is None:
@@ -82,6 +112,35 @@ def _bbox_from_line(line, im_w, im_h):
     return int(x0), int(y0), int(x1), int(y1)
 
 
+def working_image(im, working_size=SEG_WORKING_SIZE):
+    """``im`` downscaled so that its longer side is at most ``working_size``, and the ``(sx, sy)`` scale."""
+    if not working_size or max(im.size) <= working_size:
+        return im, (1.0, 1.0)
+    factor = working_size / max(im.size)
+    size = (max(1, round(im.width * factor)), max(1, round(im.height * factor)))
+    return im.resize(size, Image.Resampling.LANCZOS, reducing_gap=3.0), (size[0] / im.width, size[1] / im.height)
+
+
+def _scale_points(points, sx, sy):
+    if not points:
+        return points
+    return [(int(round(x / sx)), int(round(y / sy))) for x, y in points]
+
+
+def _to_full_resolution(line, sx, sy):
+    if (sx, sy) == (1.0, 1.0):
+        return line
+    bbox = getattr(line, "bbox", None)
+    return SimpleNamespace(
+        bbox=None if bbox is None else (bbox[0] / sx, bbox[1] / sy, bbox[2] / sx, bbox[3] / sy),
+        baseline=_scale_points(getattr(line, "baseline", None), sx, sy),
+        boundary=_scale_points(getattr(line, "boundary", None), sx, sy),
+        type=getattr(line, "type", None),
+        tags=getattr(line, "tags", None),
+        regions=getattr(line, "regions", None),
+    )
+
+
 def segment_lines_from_image(
     img,
     *,
@@ -90,16 +149,19 @@ def segment_lines_from_image(
     pad=0,
     return_mode="pil",
     seg_model_path=MODEL_PATH,
+    working_size=SEG_WORKING_SIZE,
 ):
-    im = _ensure_pil_image(img).convert("RGB")
+    """Lines of the page, segmented at ``working_size`` and returned in full resolution coordinates."""
+    im = _ensure_rgb(img)
     if device is None:
         device = "cuda" if torch.cuda.is_available() else "cpu"
 
     seg_model = _load_seg_model(device=device, seg_model_path=seg_model_path)
+    work_im, (sx, sy) = working_image(im, working_size)
 
     with torch.inference_mode():
         bounds = blla.segment(
-            im,
+            work_im,
             model=seg_model,
             device=device,
             text_direction=text_direction,
@@ -107,6 +169,7 @@ def segment_lines_from_image(
 
     results = []
     for idx, line in enumerate(bounds.lines):
+        line = _to_full_resolution(line, sx, sy)
         x0, y0, x1, y1 = _bbox_from_line(line, im.width, im.height)
 
         if pad:
@@ -115,8 +178,6 @@ def segment_lines_from_image(
             x1 = min(im.width, x1 + pad)
             y1 = min(im.height, y1 + pad)
 
-        crop = im.crop((x0, y0, x1, y1))
-
         base = getattr(line, "baseline", None)
         bound = getattr(line, "boundary", None)
 
@@ -139,95 +200,123 @@ def segment_lines_from_image(
             "tags": list(getattr(line, "tags", []) or []),
             "regions": list(getattr(line, "regions", []) or []),
         }
+        if return_mode == "array":
+            item["array"] = np.array(im.crop((x0, y0, x1, y1)))
+        elif return_mode is not None:
+            item["pil_image"] = im.crop((x0, y0, x1, y1))
+        results.append(item)
+    return results
+
+
+def _to_cache_entry(item):
+    return {
+        "index": item["index"],
+        "bbox": list(item["bbox"]),
+        "baseline": [list(p) for p in item["baseline"]] if item["baseline"] is not None else None,
+        "boundary": [list(p) for p in item["boundary"]] if item["boundary"] is not None else None,
+        "type": item["type"],
+        "tags": [str(t) for t in item["tags"]],
+        "regions": [str(r) for r in item["regions"]],
+    }
+
+
+def _from_cache_entry(entry):
+    return {
+        **entry,
+        "bbox": tuple(entry["bbox"]),
+        "baseline": [tuple(p) for p in entry["baseline"]] if entry["baseline"] is not None else None,
+        "boundary": [tuple(p) for p in entry["boundary"]] if entry["boundary"] is not None else None,
+    }
+
+
+def _attach_crops(im, lines, return_mode):
+    if return_mode is None:
+        return lines
+    im = _ensure_rgb(im)
+    for item in lines:
+        crop = im.crop(item["bbox"])
         if return_mode == "array":
             item["array"] = np.array(crop)
         else:
             item["pil_image"] = crop
-        results.append(item)
-    return results
+    return lines
 
 
-def segment(im, seg_model_path=MODEL_PATH, filter_warnings=False, debug=False, frontline=""):
+def segment(im, seg_model_path=MODEL_PATH, filter_warnings=False, debug=False, frontline="", return_mode="pil"):
+    """Segments ``im`` into lines, reusing the cached segmentation of an identical page.
+
+    ``return_mode=None`` skips the per-line crops for callers that only need the geometry.
+    """
     if filter_warnings:
         silence_segmentation_logs()
 
+    im = _ensure_pil_image(im)
+    key = None
+    if SEG_CACHE is not None and SEG_CACHE.enabled:
+        # hashed before the conversion, the key includes the mode
+        key = make_key(
+            SEG_CACHE_VERSION,
+            image_sha256(im),
+            file_sha256(seg_model_path),
+            TEXT_DIRECTION,
+            PAD,
+            SEG_WORKING_SIZE,
+        )
+        cached = SEG_CACHE.get(key)
+        if cached is not None:
+            if debug:
+                logging.debug(frontline + f"Using cached segmentation {key[:12]}")
+            return _attach_crops(im, [_from_cache_entry(entry) for entry in cached], return_mode)
+
     if debug:
         logging.debug(frontline + "Starting segmentation...")
+    im = _ensure_rgb(im)
     lines = segment_lines_from_image(
         im,
         text_direction=TEXT_DIRECTION,
         pad=PAD,
-        return_mode="pil",
+        return_mode=None,
         seg_model_path=seg_model_path,
     )
 
-    return lines
+    if key is not None:
+        SEG_CACHE.put(key, [_to_cache_entry(item) for item in lines])
+    return _attach_crops(im, lines, return_mode)
+
+
+def preload(seg_model_path=MODEL_PATH):
+    """Loads the segmentation model on the CPU with its weights moved to shared memory.
+
+    Meant for the master process before it forks the OCR workers, which then all use the same copy.
+    """
+    _load_seg_model("cpu", seg_model_path).nn.share_memory()
+
+
+def warm_up(seg_model_path=MODEL_PATH):
+    """Loads the segmentation model and runs it once on a blank page, bypassing the cache."""
+    im = Image.new("RGB", (WARM_UP_SIZE, WARM_UP_SIZE), "white")
+    segment_lines_from_image(im, text_direction=TEXT_DIRECTION, return_mode=None, seg_model_path=seg_model_path)
 
 
 def debug_save(im, lines, save_dir=SAVE_DIR, frontline=""):
-    img_arr = np.array(im.convert("RGB"))
+    """Saves ``segmented_image.png`` with the bboxes (red), baselines (green) and boundaries (blue) drawn in."""
+    im_out = _ensure_pil_image(im).convert("RGB")
+    draw = ImageDraw.Draw(im_out)
 
     logging.info(frontline + f"Found {len(lines)} lines:")
     save_dir.mkdir(parents=True, exist_ok=True)
+    w = BBOX_LINE_WIDTH
     for item in lines:
-        bbox = item["bbox"]
-        x0, y0, x1, y1 = bbox
-        img_arr[y0 - BBOX_LINE_WIDTH : y1 + BBOX_LINE_WIDTH, x0 - BBOX_LINE_WIDTH : x0] = (
-            255,
-            0,
-            0,
-        )
-        img_arr[y0 - BBOX_LINE_WIDTH : y1 + BBOX_LINE_WIDTH, x1 : x1 + BBOX_LINE_WIDTH] = (
-            255,
-            0,
-            0,
-        )
-        img_arr[y0 - BBOX_LINE_WIDTH : y0, x0 - BBOX_LINE_WIDTH : x1 + BBOX_LINE_WIDTH] = (
-            255,
-            0,
-            0,
-        )
-        img_arr[y1 : y1 + BBOX_LINE_WIDTH, x0 - BBOX_LINE_WIDTH : x1 + BBOX_LINE_WIDTH] = (
-            255,
-            0,
-            0,
-        )
+        x0, y0, x1, y1 = item["bbox"]
+        draw.rectangle((x0 - w, y0 - w, x1 + w - 1, y1 + w - 1), outline=(255, 0, 0), width=w)
+
+        # polylines are relative to the line crop
+        for key, color in (("baseline", (0, 255, 0)), ("boundary", (0, 0, 255))):
+            points = item.get(key)
+            if points and len(points) > 1:
+                points = (np.asarray(points, dtype=np.int64) + (x0, y0)).ravel().tolist()
+                draw.line(points, fill=color, width=2 * w + 1, joint="curve")
 
-        baseline = item.get("baseline")
-        if baseline:
-            for (bx0, by0), (bx1, by1) in zip(baseline, baseline[1:], strict=False):
-                gx0, gy0 = int(bx0 + x0), int(by0 + y0)
-                gx1, gy1 = int(bx1 + x0), int(by1 + y0)
-
-                steps = max(abs(gx1 - gx0), abs(gy1 - gy0)) + 1
-                xs = np.linspace(gx0, gx1, steps).astype(int)
-                ys = np.linspace(gy0, gy1, steps).astype(int)
-
-                for xx, yy in zip(xs, ys, strict=False):
-                    if 0 <= yy < img_arr.shape[0] and 0 <= xx < img_arr.shape[1]:
-                        for w_x in range(xx - BBOX_LINE_WIDTH, xx + BBOX_LINE_WIDTH + 1):
-                            for w_y in range(yy - BBOX_LINE_WIDTH, yy + BBOX_LINE_WIDTH + 1):
-                                if 0 <= w_y < img_arr.shape[0] and 0 <= w_x < img_arr.shape[1]:
-                                    img_arr[w_y, w_x] = (0, 255, 0)
-
-        boundary = item.get("boundary")
-        if boundary and len(boundary) > 1:
-            for (bx0, by0), (bx1, by1) in zip(boundary, boundary[1:], strict=False):
-                gx0, gy0 = int(bx0 + x0), int(by0 + y0)
-                gx1, gy1 = int(bx1 + x0), int(by1 + y0)
-
-                steps = max(abs(gx1 - gx0), abs(gy1 - gy0)) + 1
-                xs = np.linspace(gx0, gx1, steps).astype(int)
-                ys = np.linspace(gy0, gy1, steps).astype(int)
-
-                for xx, yy in zip(xs, ys, strict=False):
-                    if 0 <= yy < img_arr.shape[0] and 0 <= xx < img_arr.shape[1]:
-                        for w_x in range(xx - BBOX_LINE_WIDTH, xx + BBOX_LINE_WIDTH + 1):
-                            for w_y in range(yy - BBOX_LINE_WIDTH, yy + BBOX_LINE_WIDTH + 1):
-                                if 0 <= w_y < img_arr.shape[0] and 0 <= w_x < img_arr.shape[1]:
-                                    img_arr[w_y, w_x] = (0, 0, 255)
-
-    im_out = Image.fromarray(img_arr)
     im_out.save(save_dir / "segmented_image.png")
 
     logging.debug(frontline + f"Saved lines to directory: {save_dir.resolve()}")
@@ -0,0 +1,80 @@
+"""Speed / accuracy trade-off of segmenting pages at a reduced working resolution (OCR_SEG_WORKING_SIZE).
+
+Every page of the dataset is segmented at full resolution and at each working size. Reported per size are the
+seconds per page, the score against the ground truth and the agreement with the full resolution segmentation,
+both measured with ``test_seg_model.segmentation_metric``.
+
+Run it from this directory; ``app/segmentator.py`` is loaded on its own, without the segmentation cache.
+"""
+
+from __future__ import annotations
+
+import time
+from pathlib import Path
+
+from PIL import Image
+from test_seg_model import JSON_PATH, SCRIPT_DIR, load_dataset, load_module_from_path, segmentation_metric
+
+SEG_HANDLER_PATH = SCRIPT_DIR / ".." / "app" / "segmentator.py"
+MODEL_PATH = SCRIPT_DIR / ".." / "models" / "seg_best_submitted.mlmodel"
+WORKING_SIZES = [4000, 3000, 2000, 1500, 1200]
+
+
+def benchmark_working_sizes(
+    working_sizes=WORKING_SIZES,
+    model_path: Path = MODEL_PATH,
+    handler_path: Path = SEG_HANDLER_PATH,
+    max_pages: int | None = None,
+    dataset=None,
+):
+    segmentator = load_module_from_path(handler_path)
+    if dataset is None:
+        dataset = load_dataset(JSON_PATH)
+    if max_pages is not None:
+        dataset = dataset[:max_pages]
+
+    def run(image, working_size):
+        start = time.perf_counter()
+        lines = segmentator.segment_lines_from_image(
+            image,
+            text_direction=segmentator.TEXT_DIRECTION,
+            pad=segmentator.PAD,
+            return_mode=None,
+            seg_model_path=model_path,
+            working_size=working_size,
+        )
+        return lines, time.perf_counter() - start
+
+    # loads the model, so that it is not part of the first measurement
+    run(Image.new("RGB", (256, 256), "white"), 0)
+
+    sizes = [0] + [size for size in working_sizes if size]
+    totals = {size: {"seconds": 0.0, "score": 0.0, "agreement": 0.0} for size in sizes}
+    for page_count, item in enumerate(dataset, start=1):
+        image = Image.open(SCRIPT_DIR / item["filepath"]).convert("RGB")
+        full_lines = None
+        for size in sizes:
+            lines, seconds = run(image, size)
+            if full_lines is None:
+                full_lines = lines
+            totals[size]["seconds"] += seconds
+            totals[size]["score"] += segmentation_metric(item["lines"], lines, image)
+            totals[size]["agreement"] += segmentation_metric(full_lines, lines, image)
+        print(f"   Page {page_count} ({image.width}x{image.height})", end="\r")
+
+    page_count = max(1, len(dataset))
+    print(f"After {len(dataset)} pages" + " " * 20)
+    print(f"{'working size':>12} | {'s/page':>7} | {'score':>6} | {'vs full':>7}")
+    for size in sizes:
+        total = totals[size]
+        print(
+            f"{size or 'full':>12} | {total['seconds'] / page_count:7.2f} | {total['score'] / page_count:6.4f} | "
+            f"{total['agreement'] / page_count:7.4f}"
+        )
+    return {size: {key: value / page_count for key, value in total.items()} for size, total in totals.items()}
+
+
+if __name__ == "__main__":
+    if not JSON_PATH.is_file():
+        raise SystemExit(f"Dataset {JSON_PATH} not found, generate it with gen_data.py (see README.md)")
+    benchmark_working_sizes(max_pages=50)
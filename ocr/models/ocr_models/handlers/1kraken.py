@@ -1,39 +1,47 @@
 import logging
+from importlib.util import module_from_spec, spec_from_file_location
 from pathlib import Path
 
 from kraken import binarization, containers, pageseg, rpred
-from kraken.lib.models import load_any
 from PIL import Image
 
+try:
+    from app.kraken_handler import TEXT_DIRECTION, KrakenRecognizer, silence_warnings
+except Exception:
+    try:
+        from kraken_handler import TEXT_DIRECTION, KrakenRecognizer, silence_warnings
+    except Exception:
+        # loaded by file path from model_training, where neither app nor its directory is importable
+        try:
+            _spec = spec_from_file_location(
+                "_kraken_handler", Path(__file__).resolve().parents[3] / "app" / "kraken_handler.py"
+            )
+            _kraken_handler = module_from_spec(_spec)
+            _spec.loader.exec_module(_kraken_handler)
+            TEXT_DIRECTION = _kraken_handler.TEXT_DIRECTION
+            KrakenRecognizer = _kraken_handler.KrakenRecognizer
+            silence_warnings = _kraken_handler.silence_warnings
+        except Exception as e:
+            raise ImportError("Failed to import necessary modules. Ensure the package structure is correct.") from e
+
 NAME = "Kraken OCR Model"
 DESCRIPTION = """Totally different Kraken model"""
 
-MODEL = None
-
 MODEL_PATH = Path(__file__).resolve().parent / ".." / "ocr_best_submitted.mlmodel"
-TEXT_DIRECTION = "horizontal-lr"
-
+RECOGNIZER = KrakenRecognizer(MODEL_PATH)
 
-def load(model_path=MODEL_PATH):
-    global MODEL
-    MODEL = load_any(str(model_path), device="cpu")
-    return MODEL
+load = RECOGNIZER.load
+iter_page = RECOGNIZER.iter_page
+handle_page = RECOGNIZER.handle_page
 
 
 def handle(image, seg_info=None, debug=False, frontline="", filter_warnings=False):
-    global MODEL
-    if MODEL is None:
-        load()
+    model = RECOGNIZER.get_model()
 
     if debug:
         logging.debug(frontline + f"Using model: {MODEL_PATH.name}")
     if filter_warnings:
-        import warnings
-
-        warnings.filterwarnings(
-            "ignore", message="Using legacy polygon extractor, as the model was not trained with the new method."
-        )
-        logging.getLogger("kraken").setLevel(logging.ERROR)
+        silence_warnings()
 
     margin_percentage = 0
     margin = min(image.width, image.height) * margin_percentage
@@ -43,7 +51,7 @@ def handle(image, seg_info=None, debug=False, frontline="", filter_warnings=Fals
     bin_im = binarization.nlbin(new_image)
     output = ""
     try:
-        output = "".join(rec.prediction for rec in list(rpred.rpred(MODEL, bin_im, pageseg.segment(bin_im))))
+        output = "".join(rec.prediction for rec in list(rpred.rpred(model, bin_im, pageseg.segment(bin_im))))
         if len(output) == 0:
             raise Exception("Empty output from automatic segmentation")
         else:
@@ -56,7 +64,7 @@ def handle(image, seg_info=None, debug=False, frontline="", filter_warnings=Fals
             rec.prediction
             for rec in list(
                 rpred.rpred(
-                    MODEL,
+                    model,
                     bin_im,
                     containers.Segmentation(
                         type="baselines",
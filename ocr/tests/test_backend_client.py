@@ -0,0 +1,175 @@
+import asyncio
+
+import httpx
+import pytest
+
+import app.backend_client as backend_client
+
+FORMATS = [{"id": 1, "format": "PNG"}, {"id": 2, "format": "pdf"}, {"id": 3, "format": "docx"}]
+BACKEND_URL = "http://backend"
+
+
+def _async_client(handler, **kwargs):
+    kwargs.setdefault("format_cache", backend_client.FormatCache(ttl=60))
+    return backend_client.AsyncBackendClient(backoff=0, transport=httpx.MockTransport(handler), **kwargs)
+
+
+@pytest.fixture
+def backend():
+    calls = []
+    responses = []
+
+    def handler(request):
+        calls.append(request.headers)
+        return responses.pop(0)
+
+    return handler, calls, responses
+
+
+def _lookups(handler, lookups, cache):
+    async def run():
+        client = _async_client(handler, format_cache=cache)
+        try:
+            results = []
+            for lookup in lookups:
+                if lookup is None:
+                    backend_client.invalidate_formats(cache=cache)
+                else:
+                    results.append(await client.get_format(BACKEND_URL, "token", **lookup))
+            return results
+        finally:
+            await client.aclose()
+
+    return asyncio.run(run())
+
+
+def test_lookups_are_served_from_cache(backend):
+    handler, calls, responses = backend
+    responses.append(httpx.Response(200, json=FORMATS, headers={"ETag": '"v1"'}))
+
+    results = _lookups(
+        handler,
+        [{"format_id": 1}, {"format_name": "pdf"}, {"format_name": "DOCX"}],
+        backend_client.FormatCache(ttl=60),
+    )
+
+    assert [item["id"] for item in results] == [1, 2, 3]
+    assert results[0]["format"] == "PNG"
+    assert len(calls) == 1
+
+
+def test_expired_table_is_revalidated_with_etag(backend):
+    handler, calls, responses = backend
+    responses.extend([httpx.Response(200, json=FORMATS, headers={"ETag": '"v1"'}), httpx.Response(304)])
+
+    results = _lookups(handler, [{"format_id": 1}, {"format_id": 2}], backend_client.FormatCache(ttl=0))
+
+    assert results[1]["format"] == "pdf"
+    assert calls[1]["If-None-Match"] == '"v1"'
+
+
+def test_miss_and_invalidation_refetch(backend):
+    handler, calls, responses = backend
+    responses.extend(
+        [
+            httpx.Response(200, json=FORMATS),
+            httpx.Response(200, json=FORMATS + [{"id": 4, "format": "txt"}]),
+            httpx.Response(200, json=FORMATS),
+        ]
+    )
+
+    results = _lookups(
+        handler,
+        [{"format_id": 1}, {"format_name": "txt"}, None, {"format_id": 1}],
+        backend_client.FormatCache(ttl=60),
+    )
+
+    assert results[1]["id"] == 4
+    assert len(calls) == 3
+
+
+def test_async_client_retries_lookups():
+    statuses = [503, 503, 200]
+
+    def handler(request):
+        return httpx.Response(statuses.pop(0), json=FORMATS)
+
+    async def run():
+        client = _async_client(handler, retries=3)
+        try:
+            return await client.get_format(BACKEND_URL, "token", format_name="pdf")
+        finally:
+            await client.aclose()
+
+    assert asyncio.run(run())["id"] == 2
+    assert statuses == []
+
+
+def test_async_client_does_not_retry_uploads():
+    calls = []
+
+    def handler(request):
+        calls.append(request)
+        return httpx.Response(502)
+
+    async def run():
+        client = _async_client(handler, retries=3)
+        try:
+            await client.send_file(BACKEND_URL, "token", owner_id=1, format_id=2, generation=0, content_bytes=b"%PDF")
+        finally:
+            await client.aclose()
+
+    with pytest.raises(httpx.HTTPStatusError):
+        asyncio.run(run())
+    assert len(calls) == 1
+
+
+def test_circuit_breaker_fails_fast():
+    calls = []
+
+    def handler(request):
+        calls.append(request)
+        raise httpx.ConnectError("connection refused", request=request)
+
+    async def run():
+        client = _async_client(handler, retries=0, breaker_threshold=2, breaker_reset_timeout=60)
+        try:
+            for _ in range(2):
+                with pytest.raises(httpx.ConnectError):
+                    await client.get_format(BACKEND_URL, "token", format_id=1)
+            with pytest.raises(backend_client.BackendUnavailableError):
+                await client.get_format(BACKEND_URL, "token", format_id=1)
+            await client.get_format("http://other-backend", "token", format_id=1)
+        finally:
+            await client.aclose()
+
+    with pytest.raises(httpx.ConnectError):
+        asyncio.run(run())
+    assert len(calls) == 3
+
+
+def test_cancelled_trial_reopens_the_circuit():
+    started = asyncio.Event()
+
+    async def handler(request):
+        if request.url.path.endswith("/formats") and not started.is_set():
+            started.set()
+            await asyncio.sleep(60)
+        return httpx.Response(200, json=FORMATS)
+
+    async def run():
+        client = _async_client(handler, retries=0, breaker_threshold=1, breaker_reset_timeout=0)
+        breaker = client.breaker_for(BACKEND_URL)
+        breaker.record_failure()
+        try:
+            trial = asyncio.create_task(client.get_format(BACKEND_URL, "token", format_id=1))
+            await started.wait()
+            trial.cancel()
+            with pytest.raises(asyncio.CancelledError):
+                await trial
+            assert breaker.state == "half-open"
+            return await client.get_format(BACKEND_URL, "token", format_id=1)
+        finally:
+            await client.aclose()
+
+    assert asyncio.run(run())["format"] == "PNG"
@@ -0,0 +1,56 @@
+import os
+
+from PIL import Image
+
+from app.disk_cache import DiskLRUCache, image_sha256, make_key
+
+
+def test_round_trip_and_disabled(tmp_path):
+    cache = DiskLRUCache(tmp_path, max_bytes=1024)
+    cache.put("a", {"lines": [{"text": "x", "bbox": [0, 0, 1, 1]}]})
+
+    assert cache.get("a") == {"lines": [{"text": "x", "bbox": [0, 0, 1, 1]}]}
+    assert cache.get("missing") is None
+    assert DiskLRUCache(tmp_path, max_bytes=0).get("a") is None
+
+
+def test_least_recently_used_entry_is_evicted(tmp_path):
+    cache = DiskLRUCache(tmp_path, max_bytes=250)
+    for i, key in enumerate(["a", "b"]):
+        cache.put(key, "x" * 100)
+        os.utime(tmp_path / f"{key}.json", (i, i))
+    cache.get("a")
+    cache.put("c", "x" * 100)
+
+    assert cache.get("a") is not None
+    assert cache.get("b") is None
+    assert cache.get("c") is not None
+
+
+def test_put_scans_only_over_budget_or_periodically(tmp_path, monkeypatch):
+    cache = DiskLRUCache(tmp_path, max_bytes=1000, rescan_every=5)
+    scans = []
+    evict = cache.evict
+    monkeypatch.setattr(cache, "evict", lambda: scans.append(1) or evict())
+
+    for key in "abcdef":
+        cache.put(key, "x" * 10)
+    # the first put scans to learn the size, the sixth one because of rescan_every
+    assert len(scans) == 2
+
+    # written by another process, unnoticed until the next scan
+    (tmp_path / "other.json").write_text("x" * 1000)
+    cache.put("g", "x" * 10)
+    assert len(scans) == 2
+    cache.put("h", "x" * 1000)
+    assert len(scans) == 3
+    assert sum(path.stat().st_size for path in tmp_path.glob("*.json")) <= 1000
+
+
+def test_keys_follow_content_and_model():
+    im = Image.new("L", (4, 4), 255)
+    other = Image.new("L", (4, 4), 0)
+
+    assert image_sha256(im) == image_sha256(im.copy())
+    assert image_sha256(im) != image_sha256(other)
+    assert make_key(image_sha256(im), 1) != make_key(image_sha256(im), 2)
@@ -0,0 +1,71 @@
+import io
+import zipfile
+
+from lxml import etree
+
+from app.exporters import (
+    ALTO_NS,
+    EXPORTERS,
+    PAGE_NS,
+    XHTML_NS,
+    OutputFormat,
+    pages_to_alto,
+    pages_to_hocr,
+    pages_to_page_xml,
+    pages_to_text,
+)
+
+
+def _page(index, lines):
+    return {
+        "index": index,
+        "width": 1000,
+        "height": 800,
+        "lines": [{"text": text, "bbox": bbox, "confidence": 0.9} for text, bbox in lines],
+    }
+
+
+PAGES = [
+    _page(0, [("druga linia", (10, 60, 400, 90)), ("Zażółć gęślą", (10, 10, 400, 40)), ("", (10, 100, 20, 110))]),
+    _page(1, [("strona 2", (5, 5, 100, 30))]),
+]
+
+
+def test_text_is_in_reading_order_with_page_breaks():
+    assert pages_to_text(PAGES).decode() == "Zażółć gęślą\ndruga linia\n\fstrona 2\n"
+
+
+def test_hocr_has_line_boxes_and_confidence():
+    root = etree.fromstring(pages_to_hocr(PAGES))
+
+    lines = root.findall(f".//{{{XHTML_NS}}}span[@class='ocr_line']")
+    assert [line.text for line in lines] == ["Zażółć gęślą", "druga linia", "strona 2"]
+    assert lines[0].get("title") == "bbox 10 10 400 40; x_wconf 90"
+    assert len(root.findall(f".//{{{XHTML_NS}}}div[@class='ocr_page']")) == 2
+
+
+def test_alto_has_strings_with_coordinates():
+    root = etree.fromstring(pages_to_alto(PAGES))
+
+    strings = root.findall(f".//{{{ALTO_NS}}}String")
+    assert [s.get("CONTENT") for s in strings] == ["Zażółć gęślą", "druga linia", "strona 2"]
+    assert [strings[0].get(key) for key in ("HPOS", "VPOS", "WIDTH", "HEIGHT", "WC")] == [
+        "10",
+        "10",
+        "390",
+        "30",
+        "0.900",
+    ]
+
+
+def test_page_xml_is_one_document_per_page():
+    root = etree.fromstring(pages_to_page_xml(PAGES[:1]))
+    texts = [u.text for u in root.iter(f"{{{PAGE_NS}}}Unicode")]
+    assert texts == ["Zażółć gęślą", "druga linia"]
+
+    with zipfile.ZipFile(io.BytesIO(pages_to_page_xml(PAGES))) as archive:
+        assert archive.namelist() == ["page_0001.xml", "page_0002.xml"]
+
+
+def test_every_format_but_pdf_has_an_exporter():
+    assert set(EXPORTERS) == set(OutputFormat) - {OutputFormat.PDF}
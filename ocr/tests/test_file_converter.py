@@ -0,0 +1,265 @@
+import io
+
+import fitz
+import numpy as np
+import pytest
+from docx import Document
+from PIL import Image
+
+from app.file_converter import (
+    PDF_RENDER_DPI,
+    PdfProfile,
+    add_page,
+    as_pil_image,
+    count_pages,
+    encode_page_image,
+    find_fontsize,
+    insert_lines,
+    lines_to_docx_bytes,
+    load_page_image,
+    load_pdf_page_image,
+    measure_text_single_line,
+    otsu_threshold,
+    pdf_to_bytes,
+    sort_reading_order,
+)
+
+
+def _line(text, bbox):
+    return {"text": text, "bbox": bbox, "confidence": None}
+
+
+def test_reading_order_is_rows_then_left_to_right():
+    lines = [
+        _line("second row", (10, 60, 200, 90)),
+        _line("right", (300, 12, 500, 42)),
+        _line("left", (10, 10, 200, 40)),
+    ]
+
+    assert [item["text"] for item in sort_reading_order(lines)] == ["left", "right", "second row"]
+
+
+def test_docx_is_built_from_lines():
+    first_page = [_line("b", (0, 50, 10, 60)), _line("a", (0, 0, 10, 10)), _line(" ", (0, 80, 10, 90))]
+    pages = [first_page, [_line("c", (0, 0, 1, 1))]]
+
+    doc = Document(io.BytesIO(lines_to_docx_bytes(pages)))
+
+    texts = [paragraph.text for paragraph in doc.paragraphs if paragraph.text]
+    assert texts == ["a", "b", "c"]
+
+
+def test_fontsize_fits_bbox():
+    text = "Though they may gather some Left-wing"
+    fontsize = find_fontsize(line_height=150, line_width=1900, text=text)
+
+    assert measure_text_single_line(text, fontsize=fontsize)[0] < 1900
+    assert measure_text_single_line(text, fontsize=fontsize + 2)[0] >= 1900
+    assert find_fontsize(line_height=40, line_width=10_000, text=text) == 39
+
+
+def test_lines_are_written_in_one_batch():
+    pdf_doc = fitz.open()
+    pdf_doc.new_page(width=1000, height=300)
+    insert_lines(pdf_doc, [_line("Zażółć gęślą jaźń", (10, 10, 900, 60)), _line("", (10, 100, 900, 150))])
+
+    assert pdf_doc[0].get_text().strip() == "Zażółć gęślą jaźń"
+
+
+def _scan(width=400, height=200):
+    rng = np.random.default_rng(0)
+    page = np.full((height, width), 230, dtype=np.uint8) + rng.integers(0, 20, (height, width), dtype=np.uint8)
+    page[40:60, 20:380] = 30
+    page[100:120, 20:300] = 40
+    return Image.fromarray(page)
+
+
+def test_otsu_threshold_separates_ink_from_paper():
+    # the ink is at most 40, the paper at least 230
+    assert 40 <= otsu_threshold(np.asarray(_scan())) < 230
+
+
+@pytest.mark.parametrize(
+    "profile, image_filter",
+    [
+        (PdfProfile.LOSSLESS, "/FlateDecode"),
+        (PdfProfile.JPEG, "/DCTDecode"),
+        (PdfProfile.JPX, "/JPXDecode"),
+        (PdfProfile.BILEVEL, "/CCITTFaxDecode"),
+    ],
+)
+def test_pdf_profiles_compress_page_image(profile, image_filter):
+    im = _scan()
+    pdf_doc = fitz.open()
+    add_page(pdf_doc, im.width, im.height, encode_page_image(im, profile))
+    insert_lines(pdf_doc, [_line("Zażółć gęślą jaźń", (20, 40, 380, 60))])
+
+    out = fitz.open("pdf", pdf_to_bytes(pdf_doc, profile))
+
+    (xref, *_), = out[0].get_images()
+    assert out.xref_get_key(xref, "Filter") == ("name", image_filter)
+    assert out[0].get_text().strip() == "Zażółć gęślą jaźń"
+
+
+def test_text_profile_has_no_image():
+    assert encode_page_image(_scan(), PdfProfile.TEXT) is None
+
+
+def _pdf_bytes(page_sizes):
+    pdf_doc = fitz.open()
+    for width, height in page_sizes:
+        pdf_doc.new_page(width=width, height=height)
+    return pdf_doc.tobytes()
+
+
+def _frames_bytes(image_format, shades):
+    frames = [Image.new("L", (30, 20), shade) for shade in shades]
+    buf = io.BytesIO()
+    frames[0].save(buf, image_format, save_all=True, append_images=frames[1:])
+    return buf.getvalue()
+
+
+def test_count_pages_of_multi_page_pdf(tmp_path):
+    path = tmp_path / "input.pdf"
+    path.write_bytes(_pdf_bytes([(100, 200), (200, 100), (50, 50)]))
+
+    assert count_pages(path, {"format": "pdf"}) == 3
+    assert count_pages(path.read_bytes(), {"format": "pdf"}) == 3
+
+
+@pytest.mark.parametrize("image_format", ["tiff", "gif"])
+def test_count_pages_of_multi_frame_images(image_format):
+    content = _frames_bytes(image_format, [0, 128, 255])
+
+    assert count_pages(content, {"format": image_format}) == 3
+    assert count_pages(_frames_bytes("png", [0]), {"format": "png"}) == 1
+
+
+def test_count_pages_rejects_unknown_formats():
+    with pytest.raises(ValueError):
+        count_pages(b"", {"format": "xlsx"})
+
+
+def test_load_page_image_loads_the_requested_pdf_page():
+    content = _pdf_bytes([(72, 144), (144, 72)])
+
+    im = load_page_image(content, {"format": "pdf"}, page_index=1)
+
+    assert (im.width, im.height) == (2 * PDF_RENDER_DPI, PDF_RENDER_DPI)
+
+
+@pytest.mark.parametrize("image_format", ["tiff", "gif"])
+def test_load_page_image_loads_the_requested_frame(tmp_path, image_format):
+    path = tmp_path / f"input.{image_format}"
+    path.write_bytes(_frames_bytes(image_format, [0, 128, 255]))
+
+    pages = [load_page_image(path, {"format": image_format}, page_index=i) for i in range(3)]
+
+    assert all(im.mode in ("L", "RGB") and im.size == (30, 20) for im in pages)
+    assert [im.convert("L").getpixel((0, 0)) for im in pages] == [0, 128, 255]
+
+
+def _png_bytes(im):
+    buf = io.BytesIO()
+    im.save(buf, "PNG")
+    return buf.getvalue()
+
+
+def _scanned_pdf(rects, page_size=(200, 100), rotation=0):
+    # every rect shows its own copy of an 800x400 scan
+    pdf_doc = fitz.open()
+    page = pdf_doc.new_page(width=page_size[0], height=page_size[1])
+    for i, rect in enumerate(rects):
+        page.insert_image(fitz.Rect(rect), stream=_png_bytes(_scan(800 + i, 400)))
+    page.set_rotation(rotation)
+    return fitz.open("pdf", pdf_doc.tobytes())
+
+
+def test_full_page_scan_is_extracted_at_its_own_resolution():
+    pdf_doc = _scanned_pdf([(0, 0, 200, 100)])
+
+    im = load_pdf_page_image(pdf_doc, 0, dpi=72)
+
+    assert im.size == (800, 400)
+    # 800 pixels over 200 points
+    assert im.info["dpi"] == (288, 288)
+    assert np.array_equal(np.asarray(im.convert("L")), np.asarray(_scan(800, 400)))
+
+
+@pytest.mark.parametrize(
+    "rects, rotation",
+    [
+        ([(0, 0, 200, 100)], 90),
+        ([(0, 0, 100, 100)], 0),
+        ([(0, 0, 100, 100), (100, 0, 200, 100)], 0),
+    ],
+    ids=["rotated", "partial", "multi-image"],
+)
+def test_other_pages_are_rendered(rects, rotation):
+    pdf_doc = _scanned_pdf(rects, rotation=rotation)
+
+    im = load_pdf_page_image(pdf_doc, 0, dpi=144)
+
+    assert im.info["dpi"] == (144, 144)
+    assert im.size == ((200, 400) if rotation else (400, 200))
+
+
+def test_pages_without_images_render_at_the_configured_dpi():
+    im = load_pdf_page_image(fitz.open("pdf", _pdf_bytes([(72, 36)])), 0)
+
+    assert im.info["dpi"] == (PDF_RENDER_DPI, PDF_RENDER_DPI)
+    assert im.size == (PDF_RENDER_DPI, PDF_RENDER_DPI // 2)
+
+
+def _16bit_scan():
+    # full 16-bit range, clipped to white by a plain convert()
+    return np.arange(0, 65536, 256, dtype=np.uint16).reshape(16, 16)
+
+
+@pytest.mark.parametrize(
+    "image",
+    [
+        _png_bytes(Image.new("RGB", (8, 4), (10, 20, 30))),
+        np.zeros((4, 8, 3), dtype=np.uint8),
+        np.zeros((4, 8), dtype=np.uint8),
+        Image.new("1", (8, 4)),
+        Image.new("RGBA", (8, 4)),
+    ],
+    ids=["bytes", "rgb-array", "gray-array", "bilevel", "rgba"],
+)
+def test_as_pil_image_normalizes_inputs(image):
+    im = as_pil_image(image)
+
+    assert im.size == (8, 4)
+    assert im.mode in ("L", "RGB")
+
+
+def test_as_pil_image_scales_16bit_arrays():
+    im = as_pil_image(_16bit_scan())
+
+    assert im.mode == "L"
+    assert np.array_equal(np.asarray(im), np.arange(256, dtype=np.uint8).reshape(16, 16))
+
+
+def test_as_pil_image_rejects_other_inputs():
+    with pytest.raises(TypeError):
+        as_pil_image("page.png")
+
+
+def test_load_page_image_scales_16bit_tiff(tmp_path):
+    path = tmp_path / "scan.tiff"
+    Image.fromarray(_16bit_scan()).save(path, dpi=(600, 600))
+
+    im = load_page_image(path, {"format": "tiff"})
+
+    assert im.mode == "L"
+    assert im.getextrema() == (0, 255)
+    assert np.array_equal(np.asarray(im), np.arange(256, dtype=np.uint8).reshape(16, 16))
+    assert tuple(round(v) for v in im.info["dpi"]) == (600, 600)
+
+
+def test_load_page_image_decodes_png_bytes():
+    im = load_page_image(_png_bytes(Image.new("P", (8, 4))), {"format": "png"})
+
+    assert im.size == (8, 4)
+    assert im.mode == "RGB"
@@ -0,0 +1,30 @@
+import base64
+import binascii
+
+import pytest
+
+import app.ingest as ingest
+
+
+@pytest.mark.parametrize(
+    "value", ["", "aGVsbG8=", "aGVsbG8h", "aGk=", "+/+/", "aGVsbG8", "aGVs bG8=", "aGk===", "a=Gk"]
+)
+def test_base64_validation_matches_b64decode(value):
+    try:
+        base64.b64decode(value, validate=True)
+        expected = True
+    except binascii.Error:
+        expected = False
+
+    assert ingest.is_valid_base64(value) == expected
+
+
+def test_spool_base64_decodes_in_chunks(tmp_path, monkeypatch):
+    monkeypatch.setattr(ingest, "SPOOL_DIR", tmp_path)
+    monkeypatch.setattr(ingest, "CHUNK_SIZE", 30)
+    data = bytes(range(256)) * 3
+
+    path = ingest.spool_base64(base64.b64encode(data).decode())
+
+    assert path.parent == tmp_path
+    assert path.read_bytes() == data
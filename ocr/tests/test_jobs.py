@@ -0,0 +1,361 @@
+import asyncio
+import os
+
+import pytest
+
+import app.jobs as jobs_module
+from app.jobs import FairJobQueue, Job, JobManager, JobPriority, JobRejectedError, JobStatus, warm_up_ok
+
+
+async def _sum_in_pool(job, manager):
+    return await manager.run_in_pool(sum, job.payload)
+
+
+async def _fail(job, manager):
+    raise ValueError("broken input")
+
+
+async def _run_jobs(handler, payloads, workers=1):
+    manager = JobManager(handler, workers=workers)
+    await manager.start()
+    try:
+        jobs = [manager.submit(payload) for payload in payloads]
+        while not all(job.finished for job in jobs):
+            await asyncio.sleep(0.01)
+        return manager, jobs
+    finally:
+        await manager.stop()
+
+
+def test_jobs_are_processed_in_pool():
+    manager, jobs = asyncio.run(_run_jobs(_sum_in_pool, [[1, 2, 3], [10, 20]], workers=2))
+
+    assert [job.status for job in jobs] == [JobStatus.DONE, JobStatus.DONE]
+    assert [job.result for job in jobs] == [6, 30]
+    assert all(job.payload is None for job in jobs)
+    assert manager.get(jobs[0].id) is jobs[0]
+
+
+def test_failed_job_keeps_error():
+    _, (job,) = asyncio.run(_run_jobs(_fail, [None]))
+
+    assert job.status == JobStatus.FAILED
+    assert job.error == "broken input"
+    assert job.info()["status"] == "failed"
+
+
+def test_map_in_pool_keeps_order_and_window():
+    in_flight = []
+
+    async def handler(job, manager):
+        original = manager.run_in_pool
+
+        async def tracked(fn, *args):
+            in_flight.append(1)
+            assert len(in_flight) <= manager.pages_in_flight
+            try:
+                return await original(fn, *args)
+            finally:
+                in_flight.pop()
+
+        manager.run_in_pool = tracked
+        return await manager.map_in_pool(pow, ((base, 2) for base in job.payload))
+
+    async def run():
+        manager = JobManager(handler, workers=2, pages_in_flight=2)
+        await manager.start()
+        try:
+            job = manager.submit(list(range(6)))
+            while not job.finished:
+                await asyncio.sleep(0.01)
+            return job
+        finally:
+            await manager.stop()
+
+    job = asyncio.run(run())
+    assert job.status == JobStatus.DONE
+    assert job.result == [0, 1, 4, 9, 16, 25]
+
+
+def _warm_up():
+    return {"segmentation": {"loaded": True}, "models": [{"id": 1, "loaded": True}]}
+
+
+def _failing_warm_up():
+    return {"segmentation": {"loaded": True}, "models": [{"id": 1, "loaded": False, "error": "Image is empty"}]}
+
+
+def test_ready_after_every_worker_warmed_up():
+    async def run():
+        manager = JobManager(_sum_in_pool, workers=2, warm_up=_warm_up)
+        await manager.start()
+        try:
+            while not manager.ready:
+                await asyncio.sleep(0.01)
+            return manager.warm_up_reports
+        finally:
+            await manager.stop()
+
+    reports = asyncio.run(run())
+    assert len(reports) == 2
+    assert all(report["models"] == [{"id": 1, "loaded": True}] for report in reports.values())
+
+
+def test_failed_warm_up_is_not_ready():
+    async def run():
+        manager = JobManager(_sum_in_pool, workers=2, warm_up=_failing_warm_up)
+        await manager.start()
+        try:
+            while len(manager.warm_up_reports) < 2:
+                await asyncio.sleep(0.01)
+            return manager.ready, manager.state
+        finally:
+            await manager.stop()
+
+    assert asyncio.run(run()) == (False, "failed")
+
+
+def _die():
+    # like an OOM kill of the worker process
+    os._exit(1)
+
+
+async def _sum_or_die_in_pool(job, manager):
+    return await manager.run_in_pool(_die) if job.payload == "die" else await manager.run_in_pool(sum, job.payload)
+
+
+def test_dead_worker_fails_its_job_and_the_pool_is_replaced():
+    async def run():
+        manager = JobManager(_sum_or_die_in_pool, workers=2, warm_up=_warm_up)
+        await manager.start()
+        try:
+            dead = manager.submit("die")
+            while not dead.finished:
+                await asyncio.sleep(0.01)
+            later = manager.submit([1, 2])
+            while not (later.finished and manager.ready):
+                await asyncio.sleep(0.01)
+            return dead, later, manager.pool_restarts, manager.state
+        finally:
+            await manager.stop()
+
+    dead, later, restarts, state = asyncio.run(run())
+    assert dead.status == JobStatus.FAILED
+    assert later.status == JobStatus.DONE and later.result == 3
+    assert (restarts, state) == (1, "ready")
+
+
+def _die_warming_up():
+    os._exit(1)
+
+
+def test_pool_breaking_during_warm_up_fails_the_state():
+    async def run():
+        manager = JobManager(_sum_in_pool, workers=1, warm_up=_die_warming_up)
+        await manager.start()
+        try:
+            while manager.pool_error is None:
+                await asyncio.sleep(0.01)
+            return manager.state
+        finally:
+            await manager.stop()
+
+    assert asyncio.run(run()) == "failed"
+
+
+@pytest.mark.parametrize(
+    "report, ok",
+    [
+        ({"segmentation": {"loaded": True}, "models": [{"loaded": True}, {"loaded": True}]}, True),
+        ({"segmentation": {"loaded": True}, "models": [{"loaded": True}, {"loaded": False}]}, False),
+        ({"segmentation": {"loaded": False}, "models": [{"loaded": True}]}, False),
+        ({"segmentation": {"loaded": True}, "models": [], "error": "no handlers"}, False),
+        ({"error": "warm-up crashed"}, False),
+    ],
+)
+def test_warm_up_ok_needs_every_model_loaded(report, ok):
+    assert warm_up_ok(report) is ok
+
+
+_PRELOADED = []
+
+
+def _preload():
+    _PRELOADED.append("model")
+
+
+def _read_preloaded():
+    return list(_PRELOADED)
+
+
+def test_forked_workers_inherit_preloaded_models():
+    async def run():
+        manager = JobManager(_sum_in_pool, workers=2, start_method="fork", preload=_preload)
+        await manager.start()
+        try:
+            return await manager.run_in_pool(_read_preloaded)
+        finally:
+            await manager.stop()
+
+    assert asyncio.run(run()) == ["model"]
+    _PRELOADED.clear()
+
+
+def test_workers_apply_cpu_allocation():
+    from app.resources import plan_cpu_allocation
+
+    async def run():
+        allocation = plan_cpu_allocation(workers=2, cores=[0, 1], max_cores=0, postprocess_cores=0)
+        manager = JobManager(_sum_in_pool, workers=2, warm_up=_warm_up, cpu_allocation=allocation)
+        await manager.start()
+        try:
+            while not manager.ready:
+                await asyncio.sleep(0.01)
+            return manager.warm_up_reports
+        finally:
+            await manager.stop()
+
+    reports = asyncio.run(run())
+    assert sorted(report["cpu"]["index"] for report in reports.values()) == [0, 1]
+    assert all(report["cpu"]["threads"] == 1 for report in reports.values())
+
+
+def test_admission_limits_queue_depth_and_memory():
+    release = None
+
+    async def blocked(job, manager):
+        await release.wait()
+
+    async def run():
+        nonlocal release
+        release = asyncio.Event()
+        manager = JobManager(blocked, workers=1, max_running=1, max_queued=1, memory_budget=100)
+        await manager.start()
+        try:
+            running = manager.submit(None, memory=60)
+            while running.status != JobStatus.RUNNING:
+                await asyncio.sleep(0.01)
+            with pytest.raises(JobRejectedError, match="memory budget"):
+                manager.submit(None, memory=50)
+            manager.submit(None, memory=40)
+            with pytest.raises(JobRejectedError, match="queue is full") as queue_full:
+                manager.submit(None)
+            release.set()
+            return queue_full.value
+        finally:
+            await manager.stop()
+
+    queue_full = asyncio.run(run())
+    assert queue_full.retry_after >= 1
+
+
+def test_fair_queue_interleaves_owners_and_prefers_interactive():
+    def job(name, owner, priority=JobPriority.INTERACTIVE):
+        return Job(id=name, payload=None, auth_header=None, owner=owner, priority=priority)
+
+    async def run():
+        queue = FairJobQueue(weights={"heavy": 2})
+        for i in range(4):
+            queue.put_nowait(job(f"a{i}", "archive"))
+        queue.put_nowait(job("bulk", "other", JobPriority.BULK))
+        queue.put_nowait(job("b0", "user"))
+        queue.put_nowait(job("h0", "heavy"))
+        queue.put_nowait(job("h1", "heavy"))
+        depth = queue.depth()
+        return depth, [(await queue.get()).id for _ in range(queue.qsize())]
+
+    depth, order = asyncio.run(run())
+    assert depth["owners"]["archive"] == 4
+    assert depth["priorities"] == {"interactive": 7, "bulk": 1}
+    # finish tags: archive 1, 2, 3, 4; user 1; heavy (weight 2) 0.5, 1; ties keep arrival order
+    assert order == ["h0", "a0", "b0", "h1", "a1", "a2", "a3", "bulk"]
+
+
+def _emit_lines(on_event, count):
+    for index in range(count):
+        on_event("line", {"index": index})
+    return count
+
+
+def test_events_from_workers_arrive_before_job_is_done():
+    async def handler(job, manager):
+        return await manager.run_in_pool(_emit_lines, manager.job_events(job), 3)
+
+    async def run():
+        manager = JobManager(handler, workers=1)
+        await manager.start()
+        try:
+            job = manager.submit(None)
+            events = [entry async for entry in manager.iter_events(job)]
+            replayed = [entry async for entry in manager.iter_events(job)]
+            return events, replayed
+        finally:
+            await manager.stop()
+
+    events, replayed = asyncio.run(run())
+    assert [entry["event"] for entry in events] == ["status", "status", "line", "line", "line", "done"]
+    assert [entry["data"]["index"] for entry in events if entry["event"] == "line"] == [0, 1, 2]
+    # line events are dropped from the history once the job is done
+    assert [(entry["id"], entry["event"]) for entry in replayed] == [(0, "status"), (1, "status"), (5, "done")]
+
+
+def test_flush_gives_up_without_reader(monkeypatch):
+    monkeypatch.setattr(jobs_module, "FLUSH_TIMEOUT", 0.05)
+
+    async def run():
+        manager = JobManager(_sum_in_pool, workers=1)
+        await manager.start()
+        try:
+            # the reader thread stops at the sentinel, so no flush marker is ever delivered
+            manager._events.put(None)
+            manager._events_reader.join(timeout=5)
+            job = manager.submit([1, 2])
+
+            async def events():
+                return [entry["event"] async for entry in manager.iter_events(job)]
+
+            return await asyncio.wait_for(events(), 5)
+        finally:
+            await manager.stop()
+
+    assert asyncio.run(run()) == ["status", "status", "done"]
+
+
+async def _write_debug_artifact(job, manager):
+    job.scratch_dir.mkdir(parents=True)
+    (job.scratch_dir / "debug_input.png").write_bytes(b"png")
+
+
+def test_debug_artifacts_are_removed_without_further_submits(tmp_path, monkeypatch):
+    monkeypatch.setattr(jobs_module, "EVICT_INTERVAL", 0.01)
+
+    async def run():
+        manager = JobManager(_write_debug_artifact, workers=1, result_ttl=0, scratch_root=tmp_path)
+        await manager.start()
+        try:
+            job = manager.submit(None, debug=True)
+            while job.id in manager.jobs:
+                await asyncio.sleep(0.01)
+            return job
+        finally:
+            await manager.stop()
+
+    job = asyncio.run(run())
+    assert job.status == JobStatus.DONE
+    assert not job.scratch_dir.exists()
+
+
+def test_debug_artifacts_are_removed_on_stop(tmp_path):
+    async def run():
+        manager = JobManager(_write_debug_artifact, workers=1, scratch_root=tmp_path)
+        await manager.start()
+        try:
+            job = manager.submit(None, debug=True)
+            while not job.finished:
+                await asyncio.sleep(0.01)
+            assert job.scratch_dir.is_dir()
+        finally:
+            await manager.stop()
+        return job
+
+    assert not asyncio.run(run()).scratch_dir.exists()
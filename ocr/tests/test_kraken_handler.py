@@ -0,0 +1,91 @@
+from types import SimpleNamespace
+
+import pytest
+from PIL import Image
+
+import app.kraken_handler as kraken_handler
+
+
+def test_baseline_line_offsets_crop_coordinates_to_the_page():
+    line = kraken_handler.baseline_line(
+        0,
+        {
+            "index": 3,
+            "bbox": (100, 200, 300, 240),
+            "baseline": [(0, 30), (199, 30)],
+            "boundary": [(0, 0), (199, 0), (199, 39), (0, 39)],
+        },
+    )
+
+    assert line.id == "3"
+    assert [tuple(p) for p in line.baseline] == [(100, 230), (299, 230)]
+    assert [tuple(p) for p in line.boundary] == [(100, 200), (299, 200), (299, 239), (100, 239)]
+
+
+def test_baseline_line_without_polygon_uses_the_bbox():
+    line = kraken_handler.baseline_line(2, {"bbox": (10, 20, 110, 60), "baseline": None, "boundary": None})
+
+    assert line.id == "2"
+    assert [tuple(p) for p in line.baseline] == [(10, 59), (109, 59)]
+    assert [tuple(p) for p in line.boundary] == [(10, 20), (109, 20), (109, 59), (10, 59), (10, 20)]
+
+
+@pytest.fixture
+def fake_rpred(monkeypatch):
+    calls = []
+    records = []
+
+    def rpred(model, im, segmentation):
+        calls.append(segmentation)
+        yield from records
+
+    monkeypatch.setattr(kraken_handler.binarization, "nlbin", lambda im: im)
+    monkeypatch.setattr(kraken_handler.rpred, "rpred", rpred)
+    return calls, records
+
+
+def _lines(count):
+    return [
+        {"index": i, "bbox": (0, 10 * i, 100, 10 * i + 10), "baseline": None, "boundary": None} for i in range(count)
+    ]
+
+
+def _record(text, confidences):
+    return SimpleNamespace(prediction=text, confidences=confidences)
+
+
+def test_iter_page_maps_records_to_lines_by_position(fake_rpred):
+    calls, records = fake_rpred
+    records += [_record("first", [0.5, 1.0]), _record("second", []), _record("extra", [1.0])]
+    recognizer = kraken_handler.KrakenRecognizer("unused.mlmodel")
+    recognizer.model = object()
+
+    results = recognizer.handle_page(Image.new("L", (100, 20), 255), _lines(2))
+
+    assert results == [{"text": "first", "confidence": 0.75}, {"text": "second", "confidence": None}]
+    assert [line.id for line in calls[0].lines] == ["0", "1"]
+    assert calls[0].line_orders == [[0, 1]]
+
+
+def test_iter_page_pads_short_output_with_empty_lines(fake_rpred):
+    _, records = fake_rpred
+    records.append(_record("only", [1.0]))
+    recognizer = kraken_handler.KrakenRecognizer("unused.mlmodel")
+    recognizer.model = object()
+
+    results = recognizer.handle_page(Image.new("L", (100, 30), 255), _lines(3))
+
+    assert results == [
+        {"text": "only", "confidence": 1.0},
+        {"text": "", "confidence": None},
+        {"text": "", "confidence": None},
+    ]
+
+
+def test_iter_page_without_lines_runs_nothing(fake_rpred):
+    calls, _ = fake_rpred
+    recognizer = kraken_handler.KrakenRecognizer("unused.mlmodel")
+    recognizer.model = object()
+
+    assert recognizer.handle_page(Image.new("L", (10, 10), 255), []) == []
+    assert calls == []
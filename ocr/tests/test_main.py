@@ -0,0 +1,95 @@
+import asyncio
+
+import httpx
+import pytest
+from fastapi import HTTPException
+
+import app.main as main_module
+from app.backend_client import AsyncBackendClient, FormatCache
+from app.exporters import OutputFormat
+
+FORMATS = [
+    {"id": 1, "format": "PNG"},
+    {"id": 2, "format": "pdf"},
+    {"id": 3, "format": "docx"},
+    {"id": 4, "format": "txt"},
+]
+
+
+@pytest.fixture
+def backend(monkeypatch):
+    requests = []
+    responses = []
+
+    def handler(request):
+        requests.append(request)
+        response = responses.pop(0) if responses else httpx.Response(200, json=FORMATS)
+        if isinstance(response, Exception):
+            raise response
+        return response
+
+    client = AsyncBackendClient(backoff=10, format_cache=FormatCache(ttl=60), transport=httpx.MockTransport(handler))
+    monkeypatch.setattr(main_module, "BACKEND_CLIENT", client)
+    monkeypatch.setattr(main_module, "BACKEND_URL", "http://backend")
+    return requests, responses
+
+
+def _check(*checks):
+    async def run():
+        try:
+            for formats in checks:
+                await main_module._check_output_formats("token", formats)
+        finally:
+            await main_module.BACKEND_CLIENT.aclose()
+
+    asyncio.run(run())
+
+
+def test_registered_output_formats_are_accepted(backend):
+    _check([OutputFormat.PDF, OutputFormat.DOCX, OutputFormat.TXT])
+
+
+def test_unregistered_output_formats_are_rejected(backend):
+    with pytest.raises(HTTPException) as rejected:
+        _check([OutputFormat.TXT, OutputFormat.ALTO, OutputFormat.HOCR])
+
+    assert rejected.value.status_code == 422
+    assert "alto, hocr" in rejected.value.detail
+
+
+def test_cached_formats_are_checked_without_a_request(backend):
+    requests, _ = backend
+
+    _check([OutputFormat.PDF], [OutputFormat.TXT, OutputFormat.DOCX])
+
+    assert len(requests) == 1
+
+
+def test_unreachable_backend_is_asked_once_without_retries(backend):
+    requests, responses = backend
+    responses.append(httpx.ConnectError("refused"))
+
+    # would sleep for the backoff of 10s on a retry
+    _check([OutputFormat.PDF])
+
+    assert len(requests) == 1
+
+
+def test_check_is_skipped_while_the_circuit_is_open(backend):
+    requests, _ = backend
+    breaker = main_module.BACKEND_CLIENT.breaker_for("http://backend")
+    for _ in range(breaker.threshold):
+        breaker.record_failure()
+
+    _check([OutputFormat.ALTO])
+
+    assert requests == []
+
+
+def test_check_is_skipped_before_a_backend_was_found(backend, monkeypatch):
+    requests, _ = backend
+    monkeypatch.setattr(main_module, "BACKEND_URL", None)
+
+    _check([OutputFormat.ALTO])
+
+    assert requests == []
@@ -0,0 +1,60 @@
+import asyncio
+import gzip
+import json
+
+import pytest
+
+from app.exporters import pages_to_text
+from app.jobs import JobManager
+from app.ocr import render_document
+from app.page_model import deserialize_document, serialize_document
+
+
+def _page(index, texts):
+    return {
+        "index": index,
+        "width": 1000,
+        "height": 800,
+        "model": {"id": 1, "name": "kraken"},
+        "lines": [
+            {"text": text, "bbox": [10, 40 * i, 400, 40 * i + 30], "baseline": [[10, 40 * i + 25]], "confidence": 0.9}
+            for i, text in enumerate(texts)
+        ],
+        "image": b"not stored",
+    }
+
+
+def test_document_round_trip_keeps_the_page_model():
+    pages = [_page(1, ["strona 2"]), _page(0, ["Zażółć gęślą", "jaźń"])]
+
+    restored = deserialize_document(serialize_document(pages))
+
+    assert [page["index"] for page in restored] == [0, 1]
+    assert restored[0]["lines"] == _page(0, ["Zażółć gęślą", "jaźń"])["lines"]
+    assert restored[0]["model"] == {"id": 1, "name": "kraken"}
+    assert "image" not in restored[0]
+    assert pages_to_text(restored).decode() == "Zażółć gęślą\njaźń\n\fstrona 2\n"
+
+
+def test_document_is_compact():
+    pages = [_page(i, [f"line {j} of page {i}" for j in range(40)]) for i in range(10)]
+    as_dicts = json.dumps([{k: v for k, v in page.items() if k != "image"} for page in pages]).encode()
+
+    assert len(serialize_document(pages)) < len(as_dicts) / 5
+
+
+def test_unknown_document_version_is_rejected():
+    with pytest.raises(ValueError):
+        deserialize_document(gzip.compress(b'{"version": 0, "pages": []}'))
+
+
+def test_stored_document_renders_in_a_worker_process():
+    async def run():
+        manager = JobManager(None, workers=1)
+        await manager.start()
+        try:
+            return await manager.run_in_pool(render_document, serialize_document([_page(0, ["jaźń"])]), ["txt"])
+        finally:
+            await manager.stop()
+
+    assert asyncio.run(run()) == {"txt": "jaźń\n".encode()}
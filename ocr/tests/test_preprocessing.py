@@ -0,0 +1,59 @@
+import numpy as np
+from PIL import Image
+
+from app.preprocessing import content_box, invert_image, preprocess_page, to_page_coordinates
+
+
+def _scan(dark=False, dpi=None):
+    page = np.full((400, 300), 230, dtype=np.uint8)
+    # two lines of "text", as dashes
+    page[100:120, 50:250:4] = 20
+    page[200:220, 50:200:4] = 20
+    # scanner border along the top and the left edge
+    page[:10, :] = 0
+    page[:, :8] = 0
+    im = Image.fromarray(255 - page if dark else page).convert("RGB")
+    if dpi:
+        im.info["dpi"] = (dpi, dpi)
+    return im
+
+
+def test_content_box_ignores_scanner_borders():
+    ink = np.asarray(_scan().convert("L")) < 128
+
+    assert content_box(ink, padding=4) == (46, 96, 251, 224)
+
+
+def test_dark_page_is_inverted_and_trimmed():
+    out, report = preprocess_page(_scan(dark=True), trim=True)
+
+    assert report["inverted"]
+    assert out.mode == "L"
+    assert report["offset"] == (34, 84)
+    # dark text on a light background again
+    assert np.asarray(out)[100 - 84, 102 - 34] < 128 < np.asarray(out)[0, 0]
+    assert set(report["timings"]) == {"grayscale", "histogram", "trim", "invert"}
+
+
+def test_over_resolved_scan_is_downscaled_and_lines_map_back():
+    out, report = preprocess_page(_scan(dpi=600), target_dpi=300, trim=False)
+
+    assert out.size == (150, 200)
+    assert out.info["dpi"] == (300, 300)
+    line = {"text": "a", "bbox": (25, 50, 125, 60), "baseline": [[25, 58], [125, 58]], "confidence": None}
+    mapped = to_page_coordinates(line, report)
+    assert mapped["bbox"] == (50, 100, 250, 120)
+    assert mapped["baseline"] == [[50, 116], [250, 116]]
+
+
+def test_scan_at_target_resolution_is_kept():
+    out, report = preprocess_page(_scan(dpi=310), target_dpi=300, trim=False)
+
+    assert out.size == (300, 400)
+    assert "downscale" not in report["timings"]
+
+
+def test_invert_image_keeps_mode():
+    im = Image.new("RGB", (2, 2), (10, 20, 30))
+
+    assert invert_image(im).getpixel((0, 0)) == (245, 235, 225)
@@ -0,0 +1,114 @@
+import io
+
+import fitz
+import pytest
+from PIL import Image
+
+import app.ocr as ocr_module
+from app.disk_cache import DiskLRUCache
+
+
+def _iter_page(image, lines, debug=False, frontline=""):
+    for line in lines:
+        yield {"text": f"line {line['index']}", "confidence": 0.5}
+
+
+SEGMENTED = [
+    {"index": 0, "bbox": (10, 60, 200, 90), "baseline": [(0, 25), (190, 25)], "boundary": None},
+    {"index": 1, "bbox": (10, 10, 200, 40), "baseline": None, "boundary": None},
+]
+
+
+@pytest.fixture
+def fake_ocr(monkeypatch, tmp_path):
+    model = {
+        "name": "fake",
+        "id": 1,
+        "handle": None,
+        "handle_page": None,
+        "iter_page": _iter_page,
+        "path": None,
+        "model_path": None,
+    }
+    monkeypatch.setattr(ocr_module, "MODEL_LIST", [model])
+    monkeypatch.setattr(ocr_module, "segment", lambda im, **kwargs: [dict(line) for line in SEGMENTED])
+    monkeypatch.setattr(ocr_module, "RESULT_CACHE", DiskLRUCache(tmp_path, max_bytes=0))
+
+
+def test_recognize_image_returns_structured_lines_without_fitz(fake_ocr, monkeypatch):
+    def no_fitz(*args, **kwargs):
+        raise AssertionError("fitz document opened")
+
+    monkeypatch.setattr(fitz, "open", no_fitz)
+
+    page = ocr_module.recognize_image(Image.new("L", (300, 100), 255), model_id=1)
+
+    assert (page["width"], page["height"]) == (300, 100)
+    assert page["lines"][0] == {
+        "text": "line 0",
+        "bbox": (10, 60, 200, 90),
+        "baseline": [[10, 85], [200, 85]],
+        "confidence": 0.5,
+    }
+    assert page["lines"][1]["baseline"] is None
+
+
+def test_ocr_png_bytes_is_text_in_reading_order(fake_ocr):
+    buf = io.BytesIO()
+    Image.new("L", (300, 100), 255).save(buf, "PNG")
+
+    assert ocr_module.ocr_png_bytes(buf.getvalue()) == "line 1\nline 0\n"
+
+
+def test_run_ocr_renders_requested_formats(fake_ocr):
+    outputs = ocr_module.run_ocr(Image.new("L", (300, 100), 255), model_id=1, formats=["txt", "pdf"])
+
+    assert outputs["txt"] == b"line 1\nline 0\n"
+    assert "line 0" in fitz.open("pdf", outputs["pdf"])[0].get_text()
+
+
+def _iter_page_rejecting_blank(image, lines, debug=False, frontline=""):
+    # like kraken's nlbin
+    low, high = image.convert("L").getextrema()
+    if low == high:
+        raise ValueError("Image is empty")
+    yield from _iter_page(image, lines)
+
+
+def test_warm_up_runs_recognizers_on_an_inked_line(monkeypatch):
+    model = {"name": "fake", "id": 1, "iter_page": _iter_page_rejecting_blank, "handle_page": None, "handle": None}
+    monkeypatch.setattr(ocr_module, "MODEL_LIST", [model])
+    monkeypatch.setattr(ocr_module, "warm_up_segmentation", lambda: None)
+
+    report = ocr_module.warm_up()
+
+    assert report["segmentation"]["loaded"]
+    assert report["models"][0]["loaded"], report["models"][0]["error"]
+
+
+def test_result_cache_key_depends_on_the_segmentation_working_size(monkeypatch):
+    model = {"name": "fake", "id": 1, "path": __file__, "model_path": __file__}
+    im = Image.new("L", (300, 100), 255)
+    monkeypatch.setattr(ocr_module, "SEG_MODEL_PATH", __file__)
+
+    monkeypatch.setattr(ocr_module, "SEG_WORKING_SIZE", 0)
+    full_resolution = ocr_module.result_cache_key(im, model)
+    monkeypatch.setattr(ocr_module, "SEG_WORKING_SIZE", 1200)
+
+    assert ocr_module.result_cache_key(im, model) != full_resolution
+
+
+def test_page_scans_are_passed_through_the_image_dir(fake_ocr, tmp_path):
+    input_path = tmp_path / "page.png"
+    Image.new("L", (300, 100), 255).save(input_path)
+    image_dir = tmp_path / "pages"
+    image_dir.mkdir()
+
+    page = ocr_module.ocr_page_file(input_path, {"format": "png"}, 0, 1, pdf_profile="jpeg", image_dir=image_dir)
+
+    assert page["image"] is None
+    assert page["image_path"] == image_dir / "page_0001"
+    assert page["image_path"].read_bytes()[:2] == b"\xff\xd8"
+    pdf = fitz.open("pdf", ocr_module.render_outputs([page], ["pdf"], pdf_profile="jpeg")["pdf"])
+    assert len(pdf[0].get_images()) == 1
+    assert "line 0" in pdf[0].get_text()
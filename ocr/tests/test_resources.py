@@ -0,0 +1,26 @@
+from app.resources import plan_cpu_allocation
+
+
+def test_cores_are_split_between_workers_and_postprocessor():
+    allocation = plan_cpu_allocation(workers=3, cores=range(8), max_cores=0, postprocess_cores=2, pin=True)
+
+    assert allocation.torch_threads == 2
+    assert allocation.worker_cores == [[0, 1], [2, 3], [4, 5]]
+    assert allocation.postprocess_cores == [6, 7]
+    assert allocation.postprocess_threads == 2
+
+
+def test_more_workers_than_cores_share_them():
+    allocation = plan_cpu_allocation(workers=4, cores=[0, 1], max_cores=0, postprocess_cores=4)
+
+    assert allocation.torch_threads == 1
+    assert allocation.postprocess_cores == [1]
+    assert allocation.worker_cores == [[0], [0], [0], [0]]
+
+
+def test_core_limit_and_postprocessor_in_worker_slot():
+    allocation = plan_cpu_allocation(workers=2, cores=range(16), max_cores=8, postprocess_cores=0)
+
+    assert allocation.torch_threads == 4
+    assert allocation.postprocess_threads == 4
+    assert allocation.postprocess_cores == []
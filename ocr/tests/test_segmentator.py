@@ -0,0 +1,113 @@
+from types import SimpleNamespace
+
+from PIL import Image
+
+from app import segmentator
+from app.disk_cache import DiskLRUCache
+
+
+def test_segmentation_is_cached_without_crops(tmp_path, monkeypatch):
+    calls = []
+
+    def fake_segment_lines(img, **kwargs):
+        calls.append(kwargs["return_mode"])
+        return [
+            {
+                "index": 0,
+                "bbox": (1, 2, 5, 6),
+                "baseline": [(0, 3), (4, 3)],
+                "boundary": None,
+                "type": "baselines",
+                "tags": ["type"],
+                "regions": ["r1"],
+            }
+        ]
+
+    monkeypatch.setattr(segmentator, "segment_lines_from_image", fake_segment_lines)
+    monkeypatch.setattr(segmentator, "SEG_CACHE", DiskLRUCache(tmp_path, max_bytes=1024 * 1024))
+    im = Image.new("RGB", (8, 8), "white")
+
+    first = segmentator.segment(im, return_mode=None)
+    second = segmentator.segment(im.copy())
+
+    assert calls == [None]
+    assert second[0]["bbox"] == first[0]["bbox"] == (1, 2, 5, 6)
+    assert second[0]["baseline"] == [(0, 3), (4, 3)]
+    assert "pil_image" not in first[0]
+    assert second[0]["pil_image"].size == (4, 4)
+
+
+def test_debug_save_draws_polylines_relative_to_bbox(tmp_path):
+    im = Image.new("RGB", (100, 60), "white")
+    lines = [{"bbox": (20, 20, 80, 40), "baseline": [(0, 15), (59, 15)], "boundary": None}]
+
+    segmentator.debug_save(im, lines, save_dir=tmp_path)
+
+    out = Image.open(tmp_path / "segmented_image.png")
+    assert out.getpixel((50, 35)) == (0, 255, 0)
+    assert out.getpixel((17, 30)) == (255, 0, 0)
+    assert out.getpixel((50, 5)) == (255, 255, 255)
+    assert im.getpixel((50, 35)) == (255, 255, 255)
+
+
+def test_reduced_resolution_segmentation_maps_lines_back(monkeypatch):
+    seen = []
+
+    def fake_blla_segment(im, **kwargs):
+        seen.append(im.size)
+        line = SimpleNamespace(
+            baseline=[(10, 40), (190, 40)],
+            boundary=[(10, 30), (190, 30), (190, 45), (10, 45)],
+            type="baselines",
+            tags=None,
+            regions=None,
+        )
+        return SimpleNamespace(lines=[line])
+
+    monkeypatch.setattr(segmentator, "_load_seg_model", lambda **kwargs: None)
+    monkeypatch.setattr(segmentator.blla, "segment", fake_blla_segment)
+
+    lines = segmentator.segment_lines_from_image(
+        Image.new("RGB", (1000, 500), "white"), return_mode=None, working_size=200
+    )
+
+    assert seen == [(200, 100)]
+    # bbox on the full page, polylines relative to the bbox
+    assert lines[0]["bbox"] == (50, 150, 950, 225)
+    assert lines[0]["baseline"] == [(0, 50), (900, 50)]
+    assert lines[0]["boundary"][2] == (900, 75)
+
+
+def test_segment_converts_the_page_to_rgb_once(tmp_path, monkeypatch):
+    conversions = []
+    convert = Image.Image.convert
+
+    def counting_convert(self, mode=None, *args, **kwargs):
+        conversions.append((self.mode, mode))
+        return convert(self, mode, *args, **kwargs)
+
+    def fake_segment_lines(img, **kwargs):
+        assert img.mode == "RGB"
+        return [
+            {
+                "index": 0,
+                "bbox": (0, 0, 4, 4),
+                "baseline": None,
+                "boundary": None,
+                "type": None,
+                "tags": [],
+                "regions": [],
+            }
+        ]
+
+    monkeypatch.setattr(segmentator, "segment_lines_from_image", fake_segment_lines)
+    monkeypatch.setattr(segmentator, "SEG_CACHE", DiskLRUCache(tmp_path, max_bytes=1024 * 1024))
+    monkeypatch.setattr(Image.Image, "convert", counting_convert)
+
+    lines = segmentator.segment(Image.new("L", (8, 8), 255))
+    assert conversions == [("L", "RGB")]
+    assert lines[0]["pil_image"].mode == "RGB"
+
+    conversions.clear()
+    segmentator.segment(Image.new("RGB", (8, 8), "white"), return_mode="array")
+    assert conversions == []